@@ -1,4 +1,10 @@
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Final
+
+import awkward as ak
+import numpy as np
+from jaxtyping import Float, Int
 
 # Order of detection result
 # 0,   1,     2,    3
@@ -93,3 +99,210 @@ def generate_diamond_corners(
         ArUcoMarker(ids[2], tl_to_square(tl_2_x, tl_2_y, params.marker_leghth)),
         ArUcoMarker(ids[3], tl_to_square(tl_3_x, tl_3_y, params.marker_leghth)),
     )
+
+
+# Array-backed geometry
+#
+# Everything below builds whole object models in one vectorized pass instead
+# of one `ArUcoMarker` of tuples at a time; `generate_diamond_corners` is kept
+# for the notebooks.
+
+NDArray = np.ndarray
+
+# README "Diamond" section; face names follow `calculate_box_coord_naive.ipynb`
+DIAMOND_SETS: Final[dict[str, tuple[int, int, int, int]]] = {
+    "a": (16, 17, 18, 19),
+    "b": (20, 21, 22, 23),
+    "c": (24, 25, 26, 27),
+}
+# 97mm marker, 127mm chess square
+DIAMOND_PARAMS: Final[DiamondBoardParameter] = DiamondBoardParameter(0.097, 0.127)
+
+# top-left of each marker of a diamond in (chess square, chess square) units,
+# in the order of `generate_diamond_corners`: top, left, right, bottom
+_DIAMOND_CELLS: Final[NDArray] = np.array(
+    [(1, 0), (0, 1), (2, 1), (1, 2)], dtype=np.float64
+)
+# TL, TR, BR, BL of a unit square
+_UNIT_SQUARE: Final[NDArray] = np.array(
+    [(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.float64
+)
+
+
+def diamond_corners_array(params: DiamondBoardParameter) -> Float[NDArray, "4 4 2"]:
+    """
+    the 4 marker quads of one diamond face, as `generate_diamond_corners`
+    lays them out (origin at the top-left of the face)
+    """
+    tl = (
+        params.border_length
+        + params.marker_border_length
+        + _DIAMOND_CELLS * params.chess_length
+    )
+    return tl[:, np.newaxis, :] + _UNIT_SQUARE[np.newaxis] * params.marker_leghth
+
+
+def box_face_transforms(
+    params: DiamondBoardParameter,
+) -> dict[str, Float[NDArray, "4 4"]]:
+    """
+    face (x, y, 0) -> box coordinates; the closed form of the rotations and
+    translations in `calculate_box_coord_naive.ipynb`
+
+    `a` lies in z = 0, `b` in y = 0 and `c` in x = 0; every face normal
+    points into the box.
+    """
+    s = params.total_side_length
+    b = params.border_length
+    return {
+        "a": np.eye(4),
+        "b": np.array(
+            [
+                [1, 0, 0, 0],
+                [0, 0, 1, 0],
+                [0, -1, 0, s],
+                [0, 0, 0, 1],
+            ],
+            dtype=np.float64,
+        ),
+        "c": np.array(
+            [
+                [0, 0, 1, 0],
+                [-1, 0, 0, s - b],
+                [0, -1, 0, s],
+                [0, 0, 0, 1],
+            ],
+            dtype=np.float64,
+        ),
+    }
+
+
+@dataclass
+class ObjectModel:
+    """
+    Marker corners of a rigid object, one row per marker.
+
+    Use `match` to turn a frame's detections into PnP correspondences; it
+    indexes a dense id table into preallocated buffers, so there is no dict
+    lookup, concatenation or per-marker allocation per frame.
+    """
+
+    names: list[str]
+    """
+    face labels, indexed by `faces`
+    """
+    faces: Int[NDArray, "M"]
+    ids: Int[NDArray, "M"]
+    corners: Float[NDArray, "M 4 3"]
+    """
+    float32, in meter
+    """
+
+    def __post_init__(self):
+        assert self.corners.shape == (len(self.ids), 4, 3)
+        assert len(np.unique(self.ids)) == len(self.ids), "duplicated marker id"
+        self.corners = np.ascontiguousarray(self.corners, dtype=np.float32)
+        # one slot past the largest id maps every unknown id (`clip`) to -1
+        self.lookup = np.full(int(self.ids.max(initial=-1)) + 2, -1, dtype=np.intp)
+        self.lookup[self.ids] = np.arange(len(self.ids))
+        self._reserve(len(self.ids))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _reserve(self, n: int):
+        if getattr(self, "_rows", None) is not None and len(self._rows) >= n:
+            return
+        self._rows = np.empty(n, dtype=np.intp)
+        self._valid = np.empty(n, dtype=bool)
+        self._hits = np.empty(n, dtype=np.intp)
+        self._object = np.empty((n, 4, 3), dtype=np.float32)
+        self._image = np.empty((n, 4, 2), dtype=np.float32)
+
+    def match(
+        self,
+        ids: Int[NDArray, "N 1"],
+        corners: Float[NDArray, "N 1 4 2"],
+    ) -> tuple[Float[NDArray, "K*4 3"], Float[NDArray, "K*4 2"], Int[NDArray, "K"]]:
+        """
+        object and image points of the detected markers that belong to the
+        model, plus their model rows
+
+        The returned arrays are views of internal buffers, valid until the
+        next call.
+        """
+        ids = np.reshape(ids, -1)
+        n = len(ids)
+        self._reserve(n)
+        rows = self._rows[:n]
+        np.take(self.lookup, ids, mode="clip", out=rows)
+        valid = self._valid[:n]
+        np.greater_equal(rows, 0, out=valid)
+        k = int(np.count_nonzero(valid))
+        hits = self._hits[:k]
+        np.compress(valid, rows, out=hits)
+        object_points = self._object[:k]
+        np.take(self.corners, hits, axis=0, out=object_points)
+        image_points = self._image[:k]
+        np.compress(
+            valid,
+            np.reshape(np.asarray(corners, dtype=np.float32), (-1, 4, 2)),
+            axis=0,
+            out=image_points,
+        )
+        return object_points.reshape(-1, 3), image_points.reshape(-1, 2), hits
+
+    def to_parquet(self, path: Path):
+        """
+        one `MarkerFace` record (`name`, `ids`, `corners`) per face, the
+        format of `output/object_points.parquet`
+        """
+        rows = [
+            {
+                "name": name,
+                "ids": self.ids[self.faces == i],
+                "corners": self.corners[self.faces == i],
+            }
+            for i, name in enumerate(self.names)
+        ]
+        ak.to_parquet(ak.Array(rows), path)
+
+    @staticmethod
+    def from_parquet(path: Path) -> "ObjectModel":
+        faces = ak.from_parquet(path)
+        names = [str(n) for n in faces["name"].to_list()]
+        counts = ak.to_numpy(ak.num(faces["ids"], axis=1))
+        return ObjectModel(
+            names=names,
+            faces=np.repeat(np.arange(len(names)), counts),
+            ids=ak.to_numpy(ak.flatten(faces["ids"])).astype(np.int64),
+            corners=ak.to_numpy(ak.flatten(faces["corners"], axis=1)).reshape(
+                -1, 4, 3
+            ),
+        )
+
+
+def build_diamond_box_model(
+    params: DiamondBoardParameter = DIAMOND_PARAMS,
+    sets: dict[str, tuple[int, int, int, int]] = DIAMOND_SETS,
+) -> ObjectModel:
+    """
+    the object model of diamond faces mounted on a box, in one batched
+    transform of every marker corner
+    """
+    transforms = box_face_transforms(params)
+    names = list(sets)
+    # (F, 4, 4, 2) -> homogeneous (F, 4, 4, 4)
+    local = np.broadcast_to(diamond_corners_array(params), (len(names), 4, 4, 2))
+    homo = np.concatenate(
+        [local, np.zeros((*local.shape[:-1], 1)), np.ones((*local.shape[:-1], 1))],
+        axis=-1,
+    )
+    mats = np.stack([transforms[name] for name in names])
+    corners = np.einsum("fij,fmcj->fmci", mats, homo)[..., :3]
+    return ObjectModel(
+        names=names,
+        faces=np.repeat(np.arange(len(names)), 4),
+        ids=np.array([sets[name] for name in names], dtype=np.int64).reshape(-1),
+        corners=corners.reshape(-1, 4, 3),
+    )
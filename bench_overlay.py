@@ -0,0 +1,95 @@
+import time
+from typing import Callable
+
+import click
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from loguru import logger
+
+from overlay import BLUE, GREEN, GREY, RED, YELLOW, OverlayMode, OverlayRenderer
+
+NDArray = np.ndarray
+
+
+def per_marker_draw(frame: MatLike, markers: NDArray, ids: NDArray) -> MatLike:
+    """
+    the drawing loop `find_extrinsic_object.py` used before `overlay.py`
+    """
+    for cs, id in zip(markers, ids):
+        center = np.mean(cs, axis=0).astype(int)
+        cv2.circle(frame, tuple(center), 5, GREY, -1)
+        cv2.putText(
+            frame,
+            str(int(id)),
+            tuple(center),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            GREY,
+            2,
+        )
+        color_map = [RED, GREEN, BLUE, YELLOW]
+        for color, corners in zip(color_map, cs):
+            corners = corners.astype(int)
+            frame = cv2.circle(frame, corners, 5, color, -1)
+    return frame
+
+
+def random_markers(
+    count: int, width: int, height: int, seed: int = 0
+) -> tuple[NDArray, NDArray]:
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform((50, 50), (width - 50, height - 50), (count, 2))
+    side = rng.uniform(15, 40, (count, 1, 1))
+    square = np.array([(-1, -1), (1, -1), (1, 1), (-1, 1)], dtype=np.float64)
+    markers = centers[:, np.newaxis, :] + square[np.newaxis] * side
+    markers += rng.normal(0, 2, markers.shape)
+    return markers.astype(np.float32), np.arange(count, dtype=np.int32)
+
+
+def bench(fn: Callable[[MatLike], object], frame: MatLike, repeat: int) -> float:
+    """
+    ms per call, best of `repeat` (the frame is copied outside the timing)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        canvas = frame.copy()
+        start = time.perf_counter()
+        fn(canvas)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+# runs with scale < 1 include the downscale of the frame, which the live
+# tools get back in a cheaper `imshow`
+@click.command(help="Compare per-marker drawing with the batched overlay renderer")
+@click.option("--markers", "count", type=int, default=60, show_default=True)
+@click.option("--width", type=int, default=1920, show_default=True)
+@click.option("--height", type=int, default=1080, show_default=True)
+@click.option("--repeat", type=int, default=50, show_default=True)
+def main(count: int, width: int, height: int, repeat: int):
+    frame = np.full((height, width, 3), 64, dtype=np.uint8)
+    markers, ids = random_markers(count, width, height)
+    baseline = bench(lambda f: per_marker_draw(f, markers, ids), frame, repeat)
+    logger.info("{:>24}: {:7.3f}ms", "per-marker (old)", baseline)
+    for mode, scale in (
+        (OverlayMode.FULL, 1.0),
+        (OverlayMode.LITE, 1.0),
+        (OverlayMode.FULL, 0.5),
+        (OverlayMode.LITE, 0.5),
+        (OverlayMode.NONE, 1.0),
+    ):
+        renderer = OverlayRenderer(mode, scale=scale)
+        ms = bench(
+            lambda f: renderer.markers(renderer.begin(f), markers, ids), frame, repeat
+        )
+        logger.info(
+            "{:>24}: {:7.3f}ms ({:.1f}x)",
+            f"{mode.value} scale={scale}",
+            ms,
+            baseline / ms if ms > 0 else float("inf"),
+        )
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,397 @@
+"""
+Latency and accuracy of every `pnp_solvers.SOLVERS` entry (with and without
+LM refinement) on our correspondence counts, planar (one face) vs multi-face,
+and the policy that follows from it: per scene, the cheapest solver whose
+error is within reach of the best one.
+
+```
+python bench_pnp.py --save
+python bench_pnp.py --log aruco_20241206163609.detlog --calibration output/usbcam_cal.parquet
+```
+
+Synthetic scenes know the true pose and rank by rotation error; recorded
+scenes (detection logs, see `detection_log.py`) rank by reprojection RMS.
+"""
+
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+
+import click
+import cv2
+import numpy as np
+from loguru import logger
+
+from aruco_box import ObjectModel, build_diamond_box_model
+from detection_log import read_detection_log
+from object_registry import ObjectRegistry
+from pnp_solvers import (
+    IDENTITY_CAMERA_MATRIX,
+    POLICY_PATH,
+    SOLVERS,
+    PnPPolicy,
+    PnPRule,
+    is_planar,
+)
+from undistort import POINT_CRITERIA, read_camera_calibration
+
+NDArray = np.ndarray
+
+# focal length (px) of the synthetic camera, to express errors in pixels
+SYNTHETIC_FOCAL = 900.0
+# synthetic views see every used marker at most this obliquely
+MAX_OBLIQUITY_DEG = 70.0
+# a solve this far off (degrees) counts as failed (flipped planar pose)
+FAILURE_DEG = 5.0
+# adequate: p95 error within this factor (plus slack) of the best solver
+ADEQUATE_FACTOR = 1.25
+ADEQUATE_SLACK_DEG = 0.02
+ADEQUATE_SLACK_PX = 0.05
+# and failing at most this much more often
+ADEQUATE_FAILURE_MARGIN = 0.01
+
+
+@dataclass
+class Scene:
+    planar: bool
+    object_points: NDArray
+    image_points: NDArray
+    rvec: Optional[NDArray] = None
+    tvec: Optional[NDArray] = None
+    """
+    true pose, known for synthetic scenes only
+    """
+
+
+@dataclass
+class SolverStats:
+    solver: str
+    planar: bool
+    points: int
+    scenes: int
+    median_us: float
+    p95_us: float
+    failure_rate: float
+    p50_error: float
+    p95_error: float
+    """
+    rotation error in degrees (synthetic) or reprojection RMS in px (recorded)
+    """
+
+
+def look_at(camera: NDArray, target: NDArray, rng: np.random.Generator) -> tuple[NDArray, NDArray]:
+    z = target - camera
+    z /= np.linalg.norm(z)
+    x = np.cross(rng.normal(size=3), z)
+    x /= np.linalg.norm(x)
+    y = np.cross(z, x)
+    R = np.stack([x, y, z])
+    rvec, _ = cv2.Rodrigues(R)
+    return rvec.ravel(), -R @ camera
+
+
+def facing_camera(markers: NDArray, rvec: NDArray, tvec: NDArray) -> bool:
+    """
+    every marker seen from the front, no more oblique than `MAX_OBLIQUITY_DEG`
+    """
+    R, _ = cv2.Rodrigues(rvec)
+    cam = markers @ R.T + tvec
+    # corners run TL, TR, BR, BL; the normal points away from a camera that
+    # sees the marker from the front
+    normal = np.cross(cam[:, 1] - cam[:, 0], cam[:, 3] - cam[:, 0])
+    center = cam.mean(axis=1)
+    cos = np.sum(normal * center, axis=1) / (
+        np.linalg.norm(normal, axis=1) * np.linalg.norm(center, axis=1)
+    )
+    return bool(np.all(cos > np.cos(np.radians(MAX_OBLIQUITY_DEG))))
+
+
+def synthetic_scenes(
+    model: ObjectModel,
+    markers: int,
+    planar: bool,
+    count: int,
+    noise_px: float,
+    rng: np.random.Generator,
+) -> Iterator[Scene]:
+    corners = model.corners.astype(np.float64)
+    center = corners.reshape(-1, 3).mean(axis=0)
+    faces = np.unique(model.faces)
+    for _ in range(count):
+        if planar:
+            rows = np.flatnonzero(model.faces == rng.choice(faces))
+            if len(rows) < markers:
+                return
+            rows = rng.choice(rows, markers, replace=False)
+        else:
+            while True:
+                rows = rng.choice(len(model), markers, replace=False)
+                if len(np.unique(model.faces[rows])) > 1:
+                    break
+        while True:
+            direction = rng.normal(size=3)
+            direction /= np.linalg.norm(direction)
+            camera = center + direction * rng.uniform(0.5, 2.5)
+            rvec, tvec = look_at(camera, center, rng)
+            if facing_camera(corners[rows], rvec, tvec):
+                break
+        object_points = corners[rows].reshape(-1, 3)
+        projected, _ = cv2.projectPoints(
+            object_points, rvec, tvec, IDENTITY_CAMERA_MATRIX, None
+        )
+        image_points = projected.reshape(-1, 2) + rng.normal(
+            0, noise_px / SYNTHETIC_FOCAL, (len(object_points), 2)
+        )
+        yield Scene(planar, object_points, image_points, rvec, tvec)
+
+
+def recorded_scenes(
+    logs: tuple[Path, ...], calibration: Path, objects: Path
+) -> Iterator[Scene]:
+    camera_matrix, dist = read_camera_calibration(calibration)
+    registry = ObjectRegistry.from_toml(objects)
+    for log in logs:
+        _meta, frames = read_detection_log(log)
+        for f in frames:
+            for det in f.detections:
+                for obj in registry.objects:
+                    if obj.dictionary != det.dictionary:
+                        continue
+                    object_points, image_points, rows = obj.model.match(
+                        det.ids, det.corners
+                    )
+                    if len(rows) < obj.min_markers:
+                        continue
+                    normalized = cv2.undistortPointsIter(
+                        image_points.reshape(-1, 1, 2),
+                        camera_matrix,
+                        dist,
+                        None,
+                        None,
+                        POINT_CRITERIA,
+                    ).reshape(-1, 2)
+                    object_points = object_points.astype(np.float64)
+                    yield Scene(
+                        is_planar(object_points),
+                        object_points,
+                        normalized.astype(np.float64),
+                    )
+    registry.close()
+
+
+def rotation_error_deg(rvec: NDArray, truth: NDArray) -> float:
+    R, _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    T, _ = cv2.Rodrigues(truth)
+    c = (np.trace(R @ T.T) - 1) / 2
+    return float(np.degrees(np.arccos(np.clip(c, -1, 1))))
+
+
+def reprojection_px(scene: Scene, rvec: NDArray, tvec: NDArray, focal: float) -> float:
+    projected, _ = cv2.projectPoints(
+        scene.object_points, rvec, tvec, IDENTITY_CAMERA_MATRIX, None
+    )
+    d = projected.reshape(-1, 2) - scene.image_points
+    return float(np.sqrt(np.mean(np.sum(d * d, axis=1)))) * focal
+
+
+def run_solver(
+    name: str, refine: bool, scenes: list[Scene], focal: float
+) -> Optional[SolverStats]:
+    solver = SOLVERS[name]
+    planar = scenes[0].planar
+    points = len(scenes[0].object_points)
+    if not solver.applicable(points, planar):
+        return None
+    times: list[float] = []
+    errors: list[float] = []
+    failures = 0
+    for s in scenes:
+        start = time.perf_counter_ns()
+        ok, rvec, tvec = solver(s.object_points, s.image_points)
+        if ok and refine:
+            rvec, tvec = cv2.solvePnPRefineLM(
+                s.object_points, s.image_points, IDENTITY_CAMERA_MATRIX, None, rvec, tvec
+            )
+        times.append((time.perf_counter_ns() - start) / 1e3)
+        if not ok:
+            failures += 1
+            continue
+        if s.rvec is not None:
+            err = rotation_error_deg(rvec, s.rvec)
+            if err > FAILURE_DEG:
+                failures += 1
+                continue
+        else:
+            err = reprojection_px(s, rvec, tvec, focal)
+        errors.append(err)
+    e = np.array(errors) if errors else np.array([np.inf])
+    t = np.array(times)
+    return SolverStats(
+        solver=name + ("+lm" if refine else ""),
+        planar=planar,
+        points=points,
+        scenes=len(scenes),
+        median_us=float(np.median(t)),
+        p95_us=float(np.percentile(t, 95)),
+        failure_rate=failures / len(scenes),
+        p50_error=float(np.median(e)),
+        p95_error=float(np.percentile(e, 95)),
+    )
+
+
+def pick(stats: list[SolverStats], slack: float) -> SolverStats:
+    """
+    the cheapest adequate solver of one scene: within reach of the most
+    reliable solver (lowest failure rate, then lowest error) on both failure
+    rate and error; the lowest-error solver if none is
+    """
+    best = min(stats, key=lambda s: (s.failure_rate, s.p95_error))
+    adequate = [
+        s
+        for s in stats
+        if s.p95_error <= best.p95_error * ADEQUATE_FACTOR + slack
+        and s.failure_rate <= best.failure_rate + ADEQUATE_FAILURE_MARGIN
+    ]
+    if not adequate:
+        # an unmeasured (NaN) error ranks last
+        return min(stats, key=lambda s: (np.isnan(s.p95_error), s.p95_error))
+    return min(adequate, key=lambda s: s.median_us)
+
+
+def rules_from(picks: list[SolverStats]) -> list[PnPRule]:
+    """
+    one rule per run of point counts sharing the same pick; the largest count
+    measured also covers everything above it
+    """
+    rules: list[PnPRule] = []
+    for planar in (True, False):
+        runs = sorted((p for p in picks if p.planar == planar), key=lambda p: p.points)
+        for i, p in enumerate(runs):
+            name, _, lm = p.solver.partition("+")
+            last = i == len(runs) - 1
+            max_points = (1 << 30) if last else p.points
+            if rules and rules[-1].planar == planar and (
+                rules[-1].solver,
+                rules[-1].refine,
+            ) == (name, bool(lm)):
+                rules[-1] = PnPRule(planar, max_points, name, bool(lm))
+            else:
+                rules.append(PnPRule(planar, max_points, name, bool(lm)))
+    return rules
+
+
+def log_table(stats: list[SolverStats], unit: str):
+    for s in stats:
+        logger.info(
+            "{:>8} {:>3} pts {:>16}: {:7.1f} us (p95 {:7.1f}), err p50 {:.3f} p95 {:.3f} {}, {:.1%} failed",
+            "planar" if s.planar else "multi",
+            s.points,
+            s.solver,
+            s.median_us,
+            s.p95_us,
+            s.p50_error,
+            s.p95_error,
+            unit,
+            s.failure_rate,
+        )
+
+
+@click.command(help="benchmark the PnP solvers and derive the solver policy")
+@click.option(
+    "--model",
+    "model_ref",
+    type=str,
+    default="diamond",
+    show_default=True,
+    help='object model parquet, or "diamond"',
+)
+@click.option("--trials", type=int, default=300, show_default=True)
+@click.option("--noise", type=float, default=0.5, show_default=True, help="px")
+@click.option("--max-markers", type=int, default=6, show_default=True)
+@click.option(
+    "--log",
+    "logs",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    multiple=True,
+    help="detection logs to benchmark on instead of synthetic scenes",
+)
+@click.option("--calibration", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option(
+    "--objects",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=Path("objects.toml"),
+    show_default=True,
+)
+@click.option("--save", is_flag=True, help=f"write the derived policy to {POLICY_PATH}")
+@click.option("--seed", type=int, default=0)
+def main(
+    model_ref: str,
+    trials: int,
+    noise: float,
+    max_markers: int,
+    logs: tuple[Path, ...],
+    calibration: Optional[Path],
+    objects: Path,
+    save: bool,
+    seed: int,
+):
+    groups: dict[tuple[bool, int], list[Scene]] = {}
+    if logs:
+        if calibration is None:
+            raise click.UsageError("--log needs --calibration")
+        focal = float(np.asarray(read_camera_calibration(calibration)[0])[0, 0])
+        for scene in recorded_scenes(logs, calibration, objects):
+            key = (scene.planar, len(scene.object_points))
+            groups.setdefault(key, []).append(scene)
+        unit, slack = "px", ADEQUATE_SLACK_PX
+    else:
+        focal = SYNTHETIC_FOCAL
+        model = (
+            build_diamond_box_model()
+            if model_ref == "diamond"
+            else ObjectModel.from_parquet(Path(model_ref))
+        )
+        rng = np.random.default_rng(seed)
+        for planar in (True, False):
+            for markers in range(1 if planar else 2, max_markers + 1):
+                scenes = list(
+                    synthetic_scenes(model, markers, planar, trials, noise, rng)
+                )
+                if scenes:
+                    groups[(planar, markers * 4)] = scenes
+        unit, slack = "deg", ADEQUATE_SLACK_DEG
+    if not groups:
+        raise click.ClickException("no scene to benchmark")
+
+    picks: list[SolverStats] = []
+    everything: list[SolverStats] = []
+    for (planar, points), scenes in sorted(groups.items(), key=lambda kv: (not kv[0][0], kv[0][1])):
+        stats = [
+            s
+            for name in SOLVERS
+            for refine in (False, True)
+            if (s := run_solver(name, refine, scenes, focal)) is not None
+        ]
+        log_table(stats, unit)
+        chosen = pick(stats, slack)
+        logger.info(
+            "=> {} {} pts: {} ({} scenes)",
+            "planar" if planar else "multi",
+            points,
+            chosen.solver,
+            len(scenes),
+        )
+        picks.append(chosen)
+        everything.extend(stats)
+
+    policy = PnPPolicy(rules_from(picks))
+    for r in policy.rules:
+        logger.info("rule: {}", r)
+    if save:
+        path = policy.save(metrics=[asdict(s) for s in everything])
+        logger.info("Saved PnP policy to {}", path)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
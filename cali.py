@@ -6,9 +6,22 @@ from enum import Enum
 from pathlib import Path
 from loguru import logger
 from itertools import chain
-from typing import Optional, Sequence, TypedDict, cast
+from typing import Iterable, Iterator, Optional, Sequence, TypedDict, cast
 import awkward as ak
 
+from calib_diagnostics import (
+    calibrate_with_pruning,
+    diagnostics_path_for,
+    log_summary,
+    save_view_errors,
+)
+from detector_params import load_detector_parameters
+from frame_filter import FrameFilter
+from frame_ring import imap_ordered
+from pnp_solvers import load_pnp_policy
+from stage_timing import StageTimer
+from undistort import UndistortMaps, load_or_build_maps
+
 
 class ArucoDictionary(Enum):
     Dict_4X4_50 = aruco.DICT_4X4_50
@@ -35,9 +48,43 @@ class ArucoDictionary(Enum):
 
 
 IMAGE_FOLDER = Path("dumped/batch_three/c")
+# calibrate from a recording instead of `IMAGE_FOLDER`
+VIDEO_SOURCE: Optional[Path] = None
+# every n-th frame of `VIDEO_SOURCE` is considered at all
+VIDEO_STRIDE = 1
 OUTPUT_FOLDER = Path("output")
 DICTIONARY = ArucoDictionary.Dict_4X4_50
 CALIBRATION_PARQUET: Optional[Path] = OUTPUT_FOLDER / "c-af_03.parquet"
+# picks `output/detector_params/<name>.json` (see `tune_detector_params.py`)
+CAMERA_NAME: Optional[str] = "c"
+# 10x7
+# minus 1 when dealing with normal chessboard
+# 115mm square
+# 90mm marker
+BOARD_SIZE = (10, 7)
+SQUARE_LENGTH = 0.115
+MARKER_LENGTH = 0.09
+# detection processes fed through `frame_ring`; 0 detects in this process
+WORKERS = 0
+# drop blurred frames and frames nearly identical to the last kept one of
+# `VIDEO_SOURCE` before detection (see `frame_filter.py`)
+FILTER_FRAMES = True
+# also filter `IMAGE_FOLDER` (in file name order); off, so hand-picked
+# images are never dropped
+FILTER_IMAGE_FOLDER = False
+FILTER_MIN_SHARPNESS = 50.0
+FILTER_RELATIVE_SHARPNESS = 0.5
+FILTER_MIN_CHANGE = 4.0
+FILTER_MAX_SKIP = 0
+# drop views whose reprojection RMS is an outlier and re-solve, at most
+# this many rounds; 0 keeps every view
+PRUNE_ROUNDS = 5
+PRUNE_MIN_VIEWS = 10
+TIMING_ENABLED = True
+TIMING_DUMP: Optional[Path] = OUTPUT_FOLDER / "cali_timing.json"
+
+# corners, ids, marker corners, marker ids
+BoardDetection = tuple[MatLike, MatLike, Sequence[MatLike], MatLike]
 
 
 class CameraParams(TypedDict):
@@ -47,24 +94,115 @@ class CameraParams(TypedDict):
     translation_vectors: MatLike
 
 
+def create_board() -> aruco.CharucoBoard:
+    dictionary = aruco.getPredefinedDictionary(DICTIONARY.value)
+    return aruco.CharucoBoard(BOARD_SIZE, SQUARE_LENGTH, MARKER_LENGTH, dictionary)
+
+
+def create_detector() -> aruco.CharucoDetector:
+    return aruco.CharucoDetector(
+        create_board(), detectorParams=load_detector_parameters(CAMERA_NAME)
+    )
+
+
+def board_detection_worker():
+    """
+    per-frame function of a `frame_ring` worker process
+    """
+    return create_detector().detectBoard
+
+
+def read_images(
+    paths: Iterable[Path], timer: StageTimer
+) -> Iterator[tuple[Path, MatLike]]:
+    for path in paths:
+        with timer.span("imread"):
+            img = cv2.imread(str(path))
+        if img is None:
+            logger.warning(f"Failed to read {path}")
+            continue
+        yield path, img
+
+
+def read_video(
+    path: Path, timer: StageTimer, stride: int = 1
+) -> Iterator[tuple[Path, MatLike]]:
+    """
+    frames of a recording, keyed as `<stem>_<frame index>` so outputs are
+    named like those of an image folder
+    """
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        logger.error(f"Failed to open {path}")
+        return
+    index = 0
+    try:
+        while True:
+            with timer.span("decode"):
+                if index % stride != 0:
+                    ok = cap.grab()
+                    img = None
+                else:
+                    ok, img = cap.read()
+            if not ok:
+                break
+            if img is not None:
+                yield path.with_name(f"{path.stem}_{index:06d}"), img
+            index += 1
+    finally:
+        cap.release()
+
+
+def detect_boards(
+    frames: Iterable[tuple[Path, MatLike]], timer: StageTimer
+) -> Iterator[tuple[Path, MatLike, BoardDetection]]:
+    """
+    `detectBoard` over the frames, in order, across `WORKERS` processes
+    """
+    if WORKERS > 0:
+        yield from imap_ordered(frames, board_detection_worker, workers=WORKERS)
+        return
+    detector = create_detector()
+    for path, img in frames:
+        with timer.span("detectBoard"):
+            detection = detector.detectBoard(img)
+        yield path, img, detection
+
+
 def main():
     OUTPUT_FOLDER.mkdir(exist_ok=True)
-    images = chain(
-        IMAGE_FOLDER.glob("*.jpeg"),
-        IMAGE_FOLDER.glob("*.png"),
-        IMAGE_FOLDER.glob("*.jpg"),
-    )
-    border_num_x = 10
-    border_num_y = 7
-    dictionary = aruco.getPredefinedDictionary(DICTIONARY.value)
-    board = aruco.CharucoBoard((border_num_x, border_num_y), 0.115, 0.09, dictionary)
-    detector = aruco.CharucoDetector(board)
+    board = create_board()
     all_ch_corners: list[MatLike] = []
     all_ch_ids: list[MatLike] = []
     all_image_points: list[MatLike] = []
     all_object_points: list[MatLike] = []
+    all_view_names: list[str] = []
     last_shape = np.array((0, 0))
     calibration: Optional[ak.Record] = None
+    maps: Optional[UndistortMaps] = None
+    pnp_policy = load_pnp_policy()
+    timer = StageTimer(enabled=TIMING_ENABLED, camera=CAMERA_NAME or "default")
+    frames: Iterable[tuple[Path, MatLike]]
+    if VIDEO_SOURCE is not None:
+        frames = read_video(VIDEO_SOURCE, timer, VIDEO_STRIDE)
+    else:
+        images = sorted(
+            chain(
+                IMAGE_FOLDER.glob("*.jpeg"),
+                IMAGE_FOLDER.glob("*.png"),
+                IMAGE_FOLDER.glob("*.jpg"),
+            )
+        )
+        frames = read_images(images, timer)
+    frame_filter: Optional[FrameFilter] = None
+    if FILTER_FRAMES and (VIDEO_SOURCE is not None or FILTER_IMAGE_FOLDER):
+        frame_filter = FrameFilter(
+            FILTER_MIN_SHARPNESS,
+            FILTER_RELATIVE_SHARPNESS,
+            FILTER_MIN_CHANGE,
+            FILTER_MAX_SKIP,
+        )
+        frames = frame_filter.filter(frames)
 
     def has_cal():
         return CALIBRATION_PARQUET is not None and CALIBRATION_PARQUET.exists()
@@ -76,13 +214,8 @@ def main():
             logger.info(f"Loaded calibration parameters: {calibration}")
     except Exception as e:
         logger.error(f"Failed to load calibration parameters: {e}")
-    for img_path in images:
-        img = cv2.imread(str(img_path))
+    for img_path, img, detection in detect_boards(frames, timer):
         last_shape = img.shape
-        # 10x7
-        # minus 1 when dealing with normal chessboard
-        # 115mm square
-        # 90mm marker
         # https://docs.opencv.org/3.4/df/d4a/tutorial_charuco_detection.html
         # https://docs.opencv.org/4.x/df/d4a/tutorial_charuco_detection.html
         # https://docs.opencv.org/4.x/da/d13/tutorial_aruco_calibration.html
@@ -92,56 +225,91 @@ def main():
         # https://github.com/opencv/opencv/issues/22083
         # OpenCV 4.10.x
         # pylint: disable-next=unpacking-non-sequence
-        ch_corners, ch_ids, markers_corners, marker_ids = detector.detectBoard(img)
+        ch_corners, ch_ids, markers_corners, marker_ids = detection
         # https://docs.opencv.org/4.10.0/d9/df5/classcv_1_1aruco_1_1CharucoDetector.html
         if ch_corners is not None:
             # https://docs.opencv.org/4.x/d4/db2/classcv_1_1aruco_1_1Board.html
-            aruco.drawDetectedCornersCharuco(img, ch_corners, ch_ids, (0, 255, 0))
+            with timer.span("draw"):
+                aruco.drawDetectedCornersCharuco(img, ch_corners, ch_ids, (0, 255, 0))
             all_ch_corners.append(ch_corners)
             all_ch_ids.append(ch_ids)
-            # pylint: disable-next=unpacking-non-sequence
-            op, ip = board.matchImagePoints(cast(Sequence[MatLike], ch_corners), ch_ids)
+            with timer.span("matchImagePoints"):
+                # pylint: disable-next=unpacking-non-sequence
+                op, ip = board.matchImagePoints(
+                    cast(Sequence[MatLike], ch_corners), ch_ids
+                )
             all_object_points.append(op)
             all_image_points.append(ip)
-            if calibration is not None:
-                mtx = cast(MatLike, ak.to_numpy(calibration["camera_matrix"]))
-                dist = cast(
-                    MatLike, ak.to_numpy(calibration["distortion_coefficients"])
-                )
-                ret, rvec, tvec = cv2.solvePnP(op, ip, mtx, dist)
-                if ret:
-                    img = cv2.drawFrameAxes(img, mtx, dist, rvec, tvec, 0.1)
+            all_view_names.append(img_path.stem)
+            if calibration is not None and CALIBRATION_PARQUET is not None:
+                image_size = (img.shape[1], img.shape[0])
+                if maps is None or maps.image_size != image_size:
+                    maps = load_or_build_maps(CALIBRATION_PARQUET, image_size)
+                mtx = maps.camera_matrix
+                dist = maps.distortion_coefficients
+                result = pnp_policy.solve(op, maps.undistort_points(ip))
+                timer.record(f"solvePnP[{result.solver}]", result.elapsed_ms)
+                rvec, tvec = result.rvec, result.tvec
+                if result.ok:
+                    with timer.span("drawFrameAxes"):
+                        img = cv2.drawFrameAxes(img, mtx, dist, rvec, tvec, 0.1)
                 else:
                     logger.warning(f"Failed to draw frame axes in {img_path}")
         else:
             logger.warning(f"Failed to detect Charuco board in {img_path}")
             continue
         if markers_corners is not None:
-            aruco.drawDetectedMarkers(img, markers_corners, marker_ids)
+            with timer.span("drawDetectedMarkers"):
+                aruco.drawDetectedMarkers(img, markers_corners, marker_ids)
         output_path = OUTPUT_FOLDER / (f"{img_path.stem}_output.jpg")
         logger.info(f"Saving to {output_path}")
-        cv2.imwrite(str(output_path), img)
+        with timer.span("imwrite"):
+            cv2.imwrite(str(output_path), img)
 
     # compute calibration
     if calibration is None and len(all_image_points) > 0:
-        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
-            all_object_points, all_image_points, (last_shape[0], last_shape[1]), None, None  # type: ignore
-        )  # type: ignore
+        # calibrateCamera takes (width, height)
+        image_size = (last_shape[1], last_shape[0])
+        with timer.span("calibrateCamera"):
+            result = calibrate_with_pruning(
+                all_object_points,
+                all_image_points,
+                image_size,
+                max_rounds=PRUNE_ROUNDS,
+                min_views=PRUNE_MIN_VIEWS,
+            )
+        mtx, dist = result.camera_matrix, result.distortion_coefficients
         logger.info(f"Camera matrix: {mtx}")
         logger.info(f"Distortion coefficients: {dist}")
-        logger.info(f"Rotation vectors: {rvecs}")
-        logger.info(f"Translation vectors: {tvecs}")
+        log_summary(all_view_names, result)
         parameters = {
             "camera_matrix": mtx,
             "distortion_coefficients": dist,
-            "rotation_vectors": rvecs,
-            "translation_vectors": tvecs,
+            "rotation_vectors": result.rvecs,
+            "translation_vectors": result.tvecs,
+            # the vectors are of the kept views; this maps them to the inputs
+            "kept_views": result.kept,
+            "rms": result.rms,
         }
         ak.to_parquet([parameters], CALIBRATION_PARQUET)
+        if CALIBRATION_PARQUET is not None:
+            views_path = save_view_errors(
+                diagnostics_path_for(CALIBRATION_PARQUET), all_view_names, result
+            )
+            logger.info("Saved per-view reprojection errors to {}", views_path)
     else:
         logger.warning(
             "no calibration data calculated; either no images or already calibrated"
         )
+    if frame_filter is not None:
+        detect_ms = next(
+            (s.mean_ms for s in timer.stats() if s.stage == "detectBoard"), None
+        )
+        frame_filter.report(detect_ms)
+    if TIMING_ENABLED:
+        timer.log()
+        if TIMING_DUMP is not None:
+            timer.dump(TIMING_DUMP)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,398 @@
+"""
+Per-view and per-corner reprojection errors of a `calibrateCamera` solve,
+computed for all views at once, and iterative pruning of outlier views.
+"""
+
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Final, Optional, Sequence
+
+import awkward as ak
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from jaxtyping import Float, Int
+from loguru import logger
+
+NDArray = np.ndarray
+
+# a view is an outlier when its RMS exceeds median + MAD_SCALE * MAD
+MAD_SCALE: Final[float] = 3.0
+# ... and this many pixels; keeps a very consistent set from losing views
+# over sub-pixel noise
+MIN_OUTLIER_RMS_PX: Final[float] = 0.5
+# 1 / Φ⁻¹(3/4), makes the MAD a consistent estimator of σ
+MAD_TO_SIGMA: Final[float] = 1.4826
+
+
+def diagnostics_path_for(calibration_path: Path) -> Path:
+    """
+    `output/c-af_03.parquet` -> `output/c-af_03.views.parquet`
+    """
+    return calibration_path.with_name(f"{calibration_path.stem}.views.parquet")
+
+
+def rodrigues_batch(rvecs: Float[NDArray, "V 3"]) -> Float[NDArray, "V 3 3"]:
+    """
+    `cv2.Rodrigues` over many rotation vectors
+    """
+    theta = np.linalg.norm(rvecs, axis=1)
+    small = theta < 1e-12
+    k = rvecs / np.where(small, 1.0, theta)[:, np.newaxis]
+    kx, ky, kz = k[:, 0], k[:, 1], k[:, 2]
+    zero = np.zeros_like(kx)
+    cross = np.stack(
+        [
+            np.stack([zero, -kz, ky], axis=1),
+            np.stack([kz, zero, -kx], axis=1),
+            np.stack([-ky, kx, zero], axis=1),
+        ],
+        axis=1,
+    )
+    c = np.cos(theta)[:, np.newaxis, np.newaxis]
+    s = np.sin(theta)[:, np.newaxis, np.newaxis]
+    outer = k[:, :, np.newaxis] * k[:, np.newaxis, :]
+    R = c * np.eye(3) + (1 - c) * outer + s * cross
+    R[small] = np.eye(3)
+    return R
+
+
+def project_points_batch(
+    object_points: Float[NDArray, "N 3"],
+    view_index: Int[NDArray, "N"],
+    rvecs: Float[NDArray, "V 3"],
+    tvecs: Float[NDArray, "V 3"],
+    camera_matrix: MatLike,
+    distortion_coefficients: MatLike,
+) -> Float[NDArray, "N 2"]:
+    """
+    `cv2.projectPoints` of every view in one pass; point `i` belongs to view
+    `view_index[i]`
+
+    Supports the rational and thin prism terms (up to 12 coefficients); the
+    tilted model is rejected.
+    """
+    dist = np.zeros(12)
+    d = np.asarray(distortion_coefficients, dtype=np.float64).ravel()
+    if len(d) > 12:
+        if np.any(d[12:] != 0):
+            raise ValueError("tilted sensor distortion model is not supported")
+        d = d[:12]
+    dist[: len(d)] = d
+    k1, k2, p1, p2, k3, k4, k5, k6, s1, s2, s3, s4 = dist
+    mtx = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+
+    R = rodrigues_batch(rvecs)[view_index]
+    cam = np.einsum("nij,nj->ni", R, object_points) + tvecs[view_index]
+    x = cam[:, 0] / cam[:, 2]
+    y = cam[:, 1] / cam[:, 2]
+    r2 = x * x + y * y
+    r4 = r2 * r2
+    r6 = r4 * r2
+    radial = (1 + k1 * r2 + k2 * r4 + k3 * r6) / (1 + k4 * r2 + k5 * r4 + k6 * r6)
+    xy2 = 2 * x * y
+    xd = x * radial + p1 * xy2 + p2 * (r2 + 2 * x * x) + s1 * r2 + s2 * r4
+    yd = y * radial + p1 * (r2 + 2 * y * y) + p2 * xy2 + s3 * r2 + s4 * r4
+    u = mtx[0, 0] * xd + mtx[0, 1] * yd + mtx[0, 2]
+    v = mtx[1, 1] * yd + mtx[1, 2]
+    return np.stack([u, v], axis=1)
+
+
+@dataclass
+class ViewErrors:
+    corner_errors: Float[NDArray, "N"]
+    """
+    reprojection error of every corner, in pixels, views concatenated
+    """
+    view_index: Int[NDArray, "N"]
+    view_rms: Float[NDArray, "V"]
+    view_max: Float[NDArray, "V"]
+    rms: float
+    """
+    overall RMS, as `calibrateCamera` reports it
+    """
+
+
+@dataclass
+class Observations:
+    """
+    the views' correspondences concatenated once, so every round of pruning
+    works on flat arrays
+    """
+
+    object_points: Float[NDArray, "N 3"]
+    image_points: Float[NDArray, "N 2"]
+    view_index: Int[NDArray, "N"]
+    counts: Int[NDArray, "V"]
+
+    @staticmethod
+    def stack(
+        object_points: Sequence[MatLike], image_points: Sequence[MatLike]
+    ) -> "Observations":
+        ops = [np.reshape(op, (-1, 3)) for op in object_points]
+        counts = np.array([len(op) for op in ops], dtype=np.int64)
+        return Observations(
+            object_points=np.concatenate(ops).astype(np.float64),
+            image_points=np.concatenate(
+                [np.reshape(ip, (-1, 2)) for ip in image_points]
+            ).astype(np.float64),
+            view_index=np.repeat(np.arange(len(counts)), counts),
+            counts=counts,
+        )
+
+    def errors(
+        self,
+        rvecs: Sequence[MatLike],
+        tvecs: Sequence[MatLike],
+        camera_matrix: MatLike,
+        distortion_coefficients: MatLike,
+    ) -> ViewErrors:
+        projected = project_points_batch(
+            self.object_points,
+            self.view_index,
+            np.reshape(np.asarray(rvecs, dtype=np.float64), (-1, 3)),
+            np.reshape(np.asarray(tvecs, dtype=np.float64), (-1, 3)),
+            camera_matrix,
+            distortion_coefficients,
+        )
+        sq = np.sum((projected - self.image_points) ** 2, axis=1)
+        finite_sq = sq[np.isfinite(sq)]
+        counts = self.counts
+        view_sq = np.bincount(self.view_index, weights=sq, minlength=len(counts))
+        # views are contiguous, so per-view maxima are one `reduceat`
+        view_max = np.zeros(len(counts))
+        nonempty = counts > 0
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        if len(starts) > 0:
+            view_max[nonempty] = np.maximum.reduceat(sq, starts)
+        return ViewErrors(
+            corner_errors=np.sqrt(sq),
+            view_index=self.view_index,
+            view_rms=np.sqrt(view_sq / np.maximum(counts, 1)),
+            view_max=np.sqrt(view_max),
+            rms=float(np.sqrt(np.sum(finite_sq) / max(1, len(finite_sq)))),
+        )
+
+    def subset(self, views: Int[NDArray, "M"]) -> "Observations":
+        mask = np.zeros(len(self.counts), dtype=bool)
+        mask[views] = True
+        sel = mask[self.view_index]
+        counts = self.counts[views]
+        return Observations(
+            object_points=self.object_points[sel],
+            image_points=self.image_points[sel],
+            view_index=np.repeat(np.arange(len(counts)), counts),
+            counts=counts,
+        )
+
+
+def reprojection_errors(
+    object_points: Sequence[MatLike],
+    image_points: Sequence[MatLike],
+    rvecs: Sequence[MatLike],
+    tvecs: Sequence[MatLike],
+    camera_matrix: MatLike,
+    distortion_coefficients: MatLike,
+) -> ViewErrors:
+    return Observations.stack(object_points, image_points).errors(
+        rvecs, tvecs, camera_matrix, distortion_coefficients
+    )
+
+
+def outlier_views(
+    view_rms: Float[NDArray, "V"],
+    mad_scale: float = MAD_SCALE,
+    min_rms: float = MIN_OUTLIER_RMS_PX,
+) -> NDArray:
+    """
+    boolean mask of views whose RMS is far above the others' (median + MAD)
+    """
+    median = np.median(view_rms)
+    mad = np.median(np.abs(view_rms - median)) * MAD_TO_SIGMA
+    threshold = max(median + mad_scale * mad, min_rms)
+    return view_rms > threshold
+
+
+@dataclass
+class PrunedCalibration:
+    rms: float
+    camera_matrix: NDArray
+    distortion_coefficients: NDArray
+    rvecs: list[NDArray]
+    """
+    of the kept views only, in input order; `kept` maps them back
+    """
+    tvecs: list[NDArray]
+    kept: NDArray
+    """
+    boolean mask over the input views
+    """
+    errors: ViewErrors
+    """
+    of every input view, against the final intrinsics; dropped views are
+    re-posed with `solvePnP` so their errors stay comparable, and are NaN
+    where that fails
+    """
+    rms_history: list[float] = field(default_factory=list)
+    solve_ms: list[float] = field(default_factory=list)
+
+
+def calibrate_with_pruning(
+    object_points: Sequence[MatLike],
+    image_points: Sequence[MatLike],
+    image_size: tuple[int, int],
+    flags: int = 0,
+    max_rounds: int = 5,
+    min_views: int = 5,
+    mad_scale: float = MAD_SCALE,
+    min_rms: float = MIN_OUTLIER_RMS_PX,
+) -> PrunedCalibration:
+    """
+    `calibrateCamera`, then repeatedly drop outlier views and re-solve until
+    no view is an outlier
+
+    Re-solves are warm-started from the previous intrinsics and poses
+    (`CALIB_USE_INTRINSIC_GUESS | CALIB_USE_EXTRINSIC_GUESS`), so each takes
+    a few LM iterations instead of a full initialization.
+
+    Args:
+        image_size: (width, height)
+        min_views: never prune below this many views
+    """
+    n = len(object_points)
+    observations = Observations.stack(object_points, image_points)
+    kept = np.ones(n, dtype=bool)
+    history: list[float] = []
+    solve_ms: list[float] = []
+
+    def solve(idx: NDArray, guess: Optional[tuple], solve_flags: int):
+        start = time.perf_counter()
+        if guess is None:
+            result = cv2.calibrateCamera(
+                [object_points[i] for i in idx],
+                [image_points[i] for i in idx],
+                image_size,
+                None,  # type: ignore
+                None,  # type: ignore
+                flags=solve_flags,
+            )
+        else:
+            mtx, dist, rvecs, tvecs = guess
+            result = cv2.calibrateCamera(
+                [object_points[i] for i in idx],
+                [image_points[i] for i in idx],
+                image_size,
+                mtx.copy(),
+                dist.copy(),
+                rvecs,
+                tvecs,
+                flags=solve_flags
+                | cv2.CALIB_USE_INTRINSIC_GUESS
+                | cv2.CALIB_USE_EXTRINSIC_GUESS,
+            )
+        solve_ms.append((time.perf_counter() - start) * 1e3)
+        return result
+
+    idx = np.flatnonzero(kept)
+    rms, mtx, dist, rvecs, tvecs = solve(idx, None, flags)
+    history.append(float(rms))
+    for _ in range(max_rounds):
+        errors = observations.subset(idx).errors(rvecs, tvecs, mtx, dist)
+        bad = outlier_views(errors.view_rms, mad_scale, min_rms)
+        # drop the worst first if there are more than we can afford
+        budget = len(idx) - min_views
+        if budget <= 0 or not np.any(bad):
+            break
+        order = np.argsort(-errors.view_rms)
+        worst = [i for i in order if bad[i]][:budget]
+        drop = np.zeros(len(idx), dtype=bool)
+        drop[worst] = True
+        logger.info(
+            "Dropping {} outlier view(s) with RMS {}",
+            int(drop.sum()),
+            ", ".join(f"{e:.2f}" for e in errors.view_rms[drop]),
+        )
+        kept[idx[drop]] = False
+        keep_local = np.flatnonzero(~drop)
+        idx = idx[keep_local]
+        guess = (
+            mtx,
+            dist,
+            tuple(rvecs[i] for i in keep_local),
+            tuple(tvecs[i] for i in keep_local),
+        )
+        rms, mtx, dist, rvecs, tvecs = solve(idx, guess, flags)
+        history.append(float(rms))
+
+    # poses of the dropped views against the final intrinsics; a view
+    # `solvePnP` cannot pose keeps a NaN pose, so its errors are NaN
+    all_rvecs: list[NDArray] = [np.full((3, 1), np.nan)] * n
+    all_tvecs: list[NDArray] = [np.full((3, 1), np.nan)] * n
+    for j, i in enumerate(idx):
+        all_rvecs[i], all_tvecs[i] = rvecs[j], tvecs[j]
+    for i in np.flatnonzero(~kept):
+        ok, rvec, tvec = cv2.solvePnP(object_points[i], image_points[i], mtx, dist)
+        if ok:
+            all_rvecs[i], all_tvecs[i] = rvec, tvec
+        else:
+            logger.warning("Could not re-pose dropped view {}", i)
+    errors = observations.errors(all_rvecs, all_tvecs, mtx, dist)
+    return PrunedCalibration(
+        rms=float(rms),
+        camera_matrix=mtx,
+        distortion_coefficients=dist,
+        rvecs=list(rvecs),
+        tvecs=list(tvecs),
+        kept=kept,
+        errors=errors,
+        rms_history=history,
+        solve_ms=solve_ms,
+    )
+
+
+def save_view_errors(
+    path: Path, names: Sequence[str], result: PrunedCalibration
+) -> Path:
+    """
+    one record per view: name, kept, rms, max and the per-corner errors
+    """
+    e = result.errors
+    counts = np.bincount(e.view_index, minlength=len(names))
+    records = ak.zip(
+        {
+            "name": list(names),
+            "kept": result.kept,
+            "rms": e.view_rms,
+            "max": e.view_max,
+            "corner_errors": ak.unflatten(e.corner_errors, counts),
+        },
+        depth_limit=1,
+    )
+    ak.to_parquet(records, path)
+    return path
+
+
+def log_summary(names: Sequence[str], result: PrunedCalibration, worst: int = 5):
+    e = result.errors
+    logger.info(
+        "Calibration RMS {} over {} rounds ({}/{} views kept), solves {} ms",
+        " -> ".join(f"{r:.3f}" for r in result.rms_history),
+        len(result.rms_history),
+        int(result.kept.sum()),
+        len(result.kept),
+        ", ".join(f"{t:.0f}" for t in result.solve_ms),
+    )
+    posed = np.flatnonzero(np.isfinite(e.view_rms))
+    if len(posed) < len(e.view_rms):
+        logger.info(
+            "  {} dropped view(s) could not be re-posed", len(e.view_rms) - len(posed)
+        )
+    for i in posed[np.argsort(-e.view_rms[posed])][:worst]:
+        logger.info(
+            "  {} rms={:.3f} max={:.3f}{}",
+            names[i],
+            e.view_rms[i],
+            e.view_max[i],
+            "" if result.kept[i] else " (dropped)",
+        )
@@ -2,8 +2,17 @@ import cv2
 from datetime import datetime
 from loguru import logger
 from pathlib import Path
+from typing import Optional
+
+from cali import create_board
+from detector_params import load_detector_parameters
+from online_calibration import OnlineCalibrator
 
 BASE_PATH = Path("dumped/cam")
+# `c` starts/stops calibrating in the background (stopping writes the result
+# here), `w` writes the latest result of the running or last stopped one
+CALIBRATION_OUTPUT = Path("output") / "cam_online.parquet"
+CAMERA_NAME: Optional[str] = None
 
 def gen():
     API = cv2.CAP_AVFOUNDATION
@@ -16,8 +25,17 @@ def gen():
         yield frame
 
 def main():
+    calibrator: Optional[OnlineCalibrator] = None
+    # kept after `c` stops it, so `w` can still write its result
+    stopped: Optional[OnlineCalibrator] = None
     for frame in gen():
-        cv2.imshow("frame", frame)
+        if calibrator is not None:
+            calibrator.submit(frame)
+            # the detection thread may still be reading `frame`
+            preview = calibrator.draw(frame.copy())
+        else:
+            preview = frame
+        cv2.imshow("frame", preview)
         k = cv2.waitKey(1)
         if k == ord("q"):
             break
@@ -26,8 +44,35 @@ def main():
             filename = BASE_PATH / f"capture_{now.strftime('%Y%m%d%H%M%S')}.jpg"
             logger.warning(f"Saving to {filename}")
             cv2.imwrite(str(filename), frame)
+        elif k == ord("c"):
+            if calibrator is None:
+                calibrator = OnlineCalibrator(
+                    create_board(),
+                    (frame.shape[1], frame.shape[0]),
+                    load_detector_parameters(CAMERA_NAME),
+                )
+                calibrator.start()
+                logger.info("Online calibration started")
+            else:
+                calibrator.stop()
+                logger.info(
+                    "Online calibration stopped ({} of {} frames skipped by detection)",
+                    calibrator.skipped,
+                    calibrator.submitted,
+                )
+                calibrator.save(CALIBRATION_OUTPUT)
+                stopped, calibrator = calibrator, None
+        elif k == ord("w"):
+            latest = calibrator if calibrator is not None else stopped
+            if latest is not None:
+                latest.save(CALIBRATION_OUTPUT)
+            else:
+                logger.warning("No online calibration; press `c` to start one")
         else:
             ...
+    if calibrator is not None:
+        calibrator.stop()
+        calibrator.save(CALIBRATION_OUTPUT)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,383 @@
+"""
+Recording of what the live loop saw, instead of a re-encoded annotated
+video: per-frame marker ids and corners, solved poses and timestamps are
+appended to a compact binary log by a background thread; raw frames, when
+wanted, go through a `FrameRing` to a separate encoder process.
+
+Overlays are re-rendered from the log afterwards:
+
+```
+python detection_log.py info aruco_20241206163609.detlog
+python detection_log.py render aruco_20241206163609.detlog \
+    --calibration output/usbcam_cal.parquet --output overlay.mp4
+```
+
+A log is a JSON header followed by length-prefixed frame records, so a log
+cut short (crash, power loss) is readable up to its last complete record.
+"""
+
+import multiprocessing as mp
+import queue
+import struct
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Final, Iterator, Optional, Sequence
+
+import click
+import cv2
+import numpy as np
+import orjson
+from loguru import logger
+
+from frame_ring import FrameRing, FrameRingSpec
+from object_registry import Detections, ObjectPose
+from overlay import OverlayMode, OverlayRenderer
+from undistort import read_camera_calibration
+
+NDArray = np.ndarray
+
+LOG_MAGIC: Final[bytes] = b"DLG1"
+# magic, header bytes; the JSON header follows
+FILE_HEADER: Final[struct.Struct] = struct.Struct("<4sI")
+# record bytes (excluding this field), frame id, capture ns, video frame index
+# (-1: not recorded), detection groups, poses
+FRAME_HEADER: Final[struct.Struct] = struct.Struct("<IQqqHH")
+# dictionary, markers; followed by int32 ids and float32 (markers, 4, 2) corners
+GROUP_HEADER: Final[struct.Struct] = struct.Struct("<iI")
+# object id, rvec, tvec, quality, points
+POSE_ENTRY: Final[struct.Struct] = struct.Struct("<H3d3dfH")
+NOT_RECORDED: Final[int] = -1
+# raw frames in flight to the encoder before new ones are dropped
+ENCODER_SLOTS: Final[int] = 8
+
+
+@dataclass
+class LoggedFrame:
+    frame_id: int
+    capture_ns: int
+    video_index: int
+    """
+    frame of the raw recording, or `NOT_RECORDED`
+    """
+    detections: list[Detections]
+    poses: list[tuple[int, NDArray, NDArray, float, int]]
+    """
+    (object id, rvec, tvec, quality, points)
+    """
+
+
+def pack_frame(
+    frame_id: int,
+    capture_ns: int,
+    video_index: int,
+    detections: Sequence[Detections],
+    poses: Sequence[ObjectPose],
+) -> bytes:
+    parts: list[bytes] = []
+    for det in detections:
+        ids = np.ascontiguousarray(det.ids, dtype="<i4")
+        parts.append(GROUP_HEADER.pack(det.dictionary, len(ids)))
+        parts.append(ids.tobytes())
+        parts.append(np.ascontiguousarray(det.corners, dtype="<f4").tobytes())
+    for p in poses:
+        r = np.ravel(p.rvec)
+        t = np.ravel(p.tvec)
+        parts.append(
+            POSE_ENTRY.pack(p.object_id, *r, *t, p.quality, p.points)
+        )
+    body = b"".join(parts)
+    header = FRAME_HEADER.pack(
+        FRAME_HEADER.size - 4 + len(body),
+        frame_id,
+        capture_ns,
+        video_index,
+        len(detections),
+        len(poses),
+    )
+    return header + body
+
+
+def unpack_frame(buffer: memoryview) -> LoggedFrame:
+    _size, frame_id, capture_ns, video_index, groups, poses = (
+        FRAME_HEADER.unpack_from(buffer)
+    )
+    offset = FRAME_HEADER.size
+    detections: list[Detections] = []
+    for _ in range(groups):
+        dictionary, n = GROUP_HEADER.unpack_from(buffer, offset)
+        offset += GROUP_HEADER.size
+        ids = np.frombuffer(buffer, "<i4", n, offset).astype(np.int32)
+        offset += 4 * n
+        corners = np.frombuffer(buffer, "<f4", n * 8, offset).reshape(n, 4, 2)
+        offset += 32 * n
+        detections.append(Detections(dictionary, corners.astype(np.float32), ids))
+    out_poses = []
+    for _ in range(poses):
+        object_id, r0, r1, r2, t0, t1, t2, quality, points = POSE_ENTRY.unpack_from(
+            buffer, offset
+        )
+        offset += POSE_ENTRY.size
+        out_poses.append(
+            (object_id, np.array([r0, r1, r2]), np.array([t0, t1, t2]), quality, points)
+        )
+    return LoggedFrame(frame_id, capture_ns, video_index, detections, out_poses)
+
+
+class DetectionLog:
+    """
+    Append-only writer; `append` only hands the frame's arrays to the writer
+    thread, packing and file I/O happen there.
+    """
+
+    written: int
+
+    def __init__(self, path: Path, meta: Optional[dict[str, Any]] = None):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file: BinaryIO = path.open("wb")
+        header = orjson.dumps(meta or {})
+        self._file.write(FILE_HEADER.pack(LOG_MAGIC, len(header)))
+        self._file.write(header)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.written = 0
+        self._thread = threading.Thread(
+            target=self._run, name="detection-log", daemon=True
+        )
+        self._thread.start()
+
+    def append(
+        self,
+        frame_id: int,
+        capture_ns: int,
+        detections: list[Detections],
+        poses: list[ObjectPose],
+        video_index: int = NOT_RECORDED,
+    ):
+        # `detect` returns fresh arrays every frame, nothing to copy
+        self._queue.put((frame_id, capture_ns, video_index, detections, poses))
+
+    def _run(self):
+        while (item := self._queue.get()) is not None:
+            self._file.write(pack_frame(*item))
+            self.written += 1
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def read_detection_log(path: Path) -> tuple[dict[str, Any], Iterator[LoggedFrame]]:
+    """
+    (header, frames); stops quietly at a truncated last record
+    """
+    data = memoryview(path.read_bytes())
+    magic, header_size = FILE_HEADER.unpack_from(data)
+    if magic != LOG_MAGIC:
+        raise ValueError(f"{path} is not a detection log")
+    offset = FILE_HEADER.size
+    meta = orjson.loads(bytes(data[offset : offset + header_size]))
+    offset += header_size
+
+    def frames() -> Iterator[LoggedFrame]:
+        pos = offset
+        while pos + 4 <= len(data):
+            (size,) = struct.unpack_from("<I", data, pos)
+            end = pos + 4 + size
+            if end > len(data):
+                logger.warning("{}: truncated record at byte {}", path, pos)
+                return
+            yield unpack_frame(data[pos:end])
+            pos = end
+
+    return meta, frames()
+
+
+def _encoder_main(
+    spec: FrameRingSpec, path: str, fourcc: str, fps: float, tasks: Any
+):
+    ring = FrameRing.attach(spec)
+    height, width = spec.shape[:2]
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter.fourcc(*fourcc), fps, (width, height)
+    )
+    try:
+        while (slot := tasks.get()) is not None:
+            writer.write(ring.frames[slot])
+            ring.release(slot)
+    finally:
+        writer.release()
+        ring.close()
+
+
+class FrameRecorder:
+    """
+    Raw frames to a `cv2.VideoWriter` in another process; the frame is copied
+    once into shared memory and the caller never waits for the encoder. A
+    frame arriving while every slot is busy is dropped and gets no video
+    index.
+    """
+
+    recorded: int
+    dropped: int
+
+    def __init__(
+        self,
+        path: Path,
+        frame_shape: tuple[int, ...],
+        fps: float,
+        fourcc: str = "mp4v",
+        slots: int = ENCODER_SLOTS,
+    ):
+        self.path = path
+        self._ring = FrameRing.create(slots, frame_shape)
+        ctx = mp.get_context()
+        self._tasks = ctx.Queue()
+        self._process = ctx.Process(
+            target=_encoder_main,
+            args=(self._ring.spec, str(path), fourcc, fps, self._tasks),
+            daemon=True,
+            name="frame-encoder",
+        )
+        self._process.start()
+        self.recorded = 0
+        self.dropped = 0
+
+    def submit(self, frame: NDArray) -> int:
+        """
+        Returns:
+            the frame's index in the video, or `NOT_RECORDED`
+        """
+        slot = self._ring.acquire()
+        if slot is None or frame.shape != self._ring.spec.shape:
+            self.dropped += 1
+            return NOT_RECORDED
+        self._ring.frames[slot] = frame
+        self._ring.publish(slot, self.recorded)
+        self._tasks.put(slot)
+        self.recorded += 1
+        return self.recorded - 1
+
+    def close(self):
+        self._tasks.put(None)
+        self._process.join(timeout=30)
+        if self._process.is_alive():
+            logger.warning("Frame encoder did not exit; terminating")
+            self._process.terminate()
+        self._ring.close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help="summarize a detection log")
+@click.argument("log", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def info(log: Path):
+    meta, frames = read_detection_log(log)
+    count = markers = poses = recorded = 0
+    first_ns = last_ns = 0
+    for f in frames:
+        if count == 0:
+            first_ns = f.capture_ns
+        last_ns = f.capture_ns
+        count += 1
+        markers += sum(len(d.ids) for d in f.detections)
+        poses += len(f.poses)
+        recorded += f.video_index != NOT_RECORDED
+    duration = (last_ns - first_ns) / 1e9
+    logger.info("{}: {}", log, meta)
+    logger.info(
+        "{} frames over {:.1f} s ({:.1f} fps), {} markers, {} poses, {} raw frames; {:.0f} bytes/frame",
+        count,
+        duration,
+        (count - 1) / duration if duration > 0 else 0.0,
+        markers,
+        poses,
+        recorded,
+        log.stat().st_size / max(count, 1),
+    )
+
+
+@cli.command(help="re-render the overlay of a detection log")
+@click.argument("log", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option(
+    "--calibration",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+)
+@click.option(
+    "--video",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="raw recording; defaults to the one named in the log, else a blank canvas",
+)
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path), required=True)
+@click.option(
+    "--overlay",
+    type=click.Choice([m.value for m in OverlayMode]),
+    default=OverlayMode.FULL.value,
+    show_default=True,
+)
+@click.option("--axis-length", type=float, default=0.4, show_default=True)
+@click.option("--fps", type=float, help="output rate; defaults to the logged rate")
+def render(
+    log: Path,
+    calibration: Path,
+    video: Optional[Path],
+    output: Path,
+    overlay: str,
+    axis_length: float,
+    fps: Optional[float],
+):
+    meta, frames = read_detection_log(log)
+    camera_matrix, dist = read_camera_calibration(calibration)
+    if video is None and meta.get("video"):
+        candidate = log.parent / str(meta["video"])
+        video = candidate if candidate.exists() else None
+    cap = cv2.VideoCapture(str(video)) if video is not None else None
+    width, height = meta["frame_size"]
+    renderer = OverlayRenderer(OverlayMode(overlay))
+    writer: Optional[cv2.VideoWriter] = None
+    next_index = 0
+    raw: Optional[NDArray] = None
+    rendered = 0
+    for f in frames:
+        if cap is not None and f.video_index != NOT_RECORDED:
+            # the recording holds a subset of the logged frames, in order
+            while next_index <= f.video_index:
+                ok, raw = cap.read()
+                if not ok:
+                    raw = None
+                    break
+                next_index += 1
+        base = (
+            raw
+            if raw is not None and f.video_index != NOT_RECORDED
+            else np.zeros((height, width, 3), dtype=np.uint8)
+        )
+        canvas = renderer.begin(base)
+        for det in f.detections:
+            renderer.markers(canvas, det.corners, det.ids)
+        for _object_id, rvec, tvec, _quality, _points in f.poses:
+            renderer.axes(canvas, camera_matrix, dist, rvec, tvec, axis_length)
+        if writer is None:
+            rate = fps or float(meta.get("fps", 30.0))
+            writer = cv2.VideoWriter(
+                str(output),
+                cv2.VideoWriter.fourcc(*"mp4v"),
+                rate,
+                canvas.shape[:2][::-1],
+            )
+        writer.write(canvas)
+        rendered += 1
+    if writer is not None:
+        writer.release()
+    if cap is not None:
+        cap.release()
+    logger.info("Rendered {} frames to {}", rendered, output)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,94 @@
+from pathlib import Path
+from typing import Any, Final, Optional
+
+import orjson
+from cv2 import aruco
+from loguru import logger
+
+PROFILE_FOLDER: Final[Path] = Path("output") / "detector_params"
+
+# `DetectorParameters` fields a profile may set; anything else in a profile
+# file is metadata (metrics of the tuning run) and ignored when loading
+TUNABLE_KEYS: Final[tuple[str, ...]] = (
+    "adaptiveThreshWinSizeMin",
+    "adaptiveThreshWinSizeMax",
+    "adaptiveThreshWinSizeStep",
+    "adaptiveThreshConstant",
+    "minMarkerPerimeterRate",
+    "maxMarkerPerimeterRate",
+    "polygonalApproxAccuracyRate",
+    "minCornerDistanceRate",
+    "minDistanceToBorder",
+    "minMarkerDistanceRate",
+    "cornerRefinementMethod",
+    "cornerRefinementWinSize",
+    "cornerRefinementMaxIterations",
+    "cornerRefinementMinAccuracy",
+    "perspectiveRemovePixelPerCell",
+    "perspectiveRemoveIgnoredMarginPerCell",
+    "maxErroneousBitsInBorderRate",
+    "errorCorrectionRate",
+    "useAruco3Detection",
+    "minSideLengthCanonicalImg",
+    "minMarkerLengthRatioOriginalImg",
+)
+
+
+def profile_path(camera: str) -> Path:
+    return PROFILE_FOLDER / f"{camera}.json"
+
+
+def parameters_to_dict(params: aruco.DetectorParameters) -> dict[str, Any]:
+    return {key: getattr(params, key) for key in TUNABLE_KEYS}
+
+
+def parameters_from_dict(values: dict[str, Any]) -> aruco.DetectorParameters:
+    """
+    default `DetectorParameters` overridden by the tunable keys in `values`
+    """
+    params = aruco.DetectorParameters()
+    for key in TUNABLE_KEYS:
+        if key in values:
+            # the bindings are strict about int vs float vs bool
+            current = getattr(params, key)
+            setattr(params, key, type(current)(values[key]))
+    return params
+
+
+def save_detector_profile(
+    camera: str,
+    params: aruco.DetectorParameters,
+    metrics: Optional[dict[str, Any]] = None,
+    path: Optional[Path] = None,
+) -> Path:
+    """
+    Args:
+        metrics: stored next to the parameters for reference, e.g. ms/frame
+    """
+    if path is None:
+        path = profile_path(camera)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    profile: dict[str, Any] = {"camera": camera, "parameters": parameters_to_dict(params)}
+    if metrics is not None:
+        profile["metrics"] = metrics
+    path.write_bytes(orjson.dumps(profile, option=orjson.OPT_INDENT_2))
+    return path
+
+
+def load_detector_parameters(
+    camera: Optional[str], path: Optional[Path] = None
+) -> aruco.DetectorParameters:
+    """
+    the tuned profile of `camera` (see `tune_detector_params.py`), or the
+    OpenCV defaults when there is none
+    """
+    if path is None:
+        if camera is None:
+            return aruco.DetectorParameters()
+        path = profile_path(camera)
+    if not path.exists():
+        logger.info("No detector profile at {}; using defaults", path)
+        return aruco.DetectorParameters()
+    profile = orjson.loads(path.read_bytes())
+    logger.info("Loaded detector profile {}", path)
+    return parameters_from_dict(profile["parameters"])
@@ -4,11 +4,15 @@ from cv2 import aruco
 from datetime import datetime
 from loguru import logger
 from pathlib import Path
-from typing import cast, Final
+from typing import cast, Final, Optional
 import awkward as ak
 from cv2.typing import MatLike
 import numpy as np
 
+from detector_params import load_detector_parameters
+from overlay import RED, OverlayMode, OverlayRenderer
+from stage_timing import StageTimer
+
 NDArray = np.ndarray
 # CALIBRATION_PARQUET = Path("output") / "usbcam_cal.parquet"
 CALIBRATION_PARQUET = None
@@ -17,17 +21,22 @@ CALIBRATION_PARQUET = None
 DICTIONARY: Final[int] = aruco.DICT_APRILTAG_36H11
 # 400mm
 MARKER_LENGTH: Final[float] = 0.4
-RED = (0, 0, 255)
-GREEN = (0, 255, 0)
-BLUE = (255, 0, 0)
-YELLOW = (0, 255, 255)
+# picks `output/detector_params/<name>.json` (see `tune_detector_params.py`)
+CAMERA_NAME: Optional[str] = None
+# per-stage latency; `t` toggles the on-frame overlay
+TIMING_ENABLED: Final[bool] = True
+TIMING_DUMP: Optional[Path] = Path("output") / "find_aruco_points_timing.json"
+# `OverlayMode.LITE` skips the id labels; scale < 1 draws on a smaller preview
+OVERLAY_MODE: Final[OverlayMode] = OverlayMode.FULL
+OVERLAY_SCALE: Final[float] = 1.0
 
 
-def gen():
+def gen(timer: StageTimer):
     API = cv2.CAP_AVFOUNDATION
     cap = cv2.VideoCapture(0, API)
     while True:
-        ret, frame = cap.read()
+        with timer.span("decode"):
+            ret, frame = cap.read()
         if not ret:
             logger.warning("Failed to grab frame")
             break
@@ -48,46 +57,47 @@ def main():
         else cast(MatLike, ak.to_numpy(cal["distortion_coefficients"]))
     )
     detector = aruco.ArucoDetector(
-        dictionary=aruco_dict, detectorParams=aruco.DetectorParameters()
+        dictionary=aruco_dict, detectorParams=load_detector_parameters(CAMERA_NAME)
     )
 
-    for frame in gen():
-        grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # pylint: disable-next=unpacking-non-sequence
-        markers, ids, rejected = detector.detectMarkers(grey)
+    overlay = OverlayRenderer(OVERLAY_MODE, scale=OVERLAY_SCALE, id_color=RED)
+    timer = StageTimer(enabled=TIMING_ENABLED, camera=CAMERA_NAME or "default")
+    show_timing = False
+
+    for frame in gen(timer):
+        with timer.span("cvtColor"):
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        with timer.span("detectMarkers"):
+            # pylint: disable-next=unpacking-non-sequence
+            markers, ids, rejected = detector.detectMarkers(grey)
         # `markers` is [N, 1, 4, 2]
         # `ids` is [N, 1]
-        if ids is not None:
-            markers = np.reshape(markers, (-1, 4, 2))
-            ids = np.reshape(ids, (-1, 1))
-            # logger.info("markers={}, ids={}", np.array(markers).shape, np.array(ids).shape)
-            for m, i in zip(markers, ids):
-                center = np.mean(m, axis=0).astype(int)
-                # logger.info("id={}, center={}", i, center)
-                cv2.circle(frame, tuple(center), 5, RED, -1)
-                cv2.putText(
-                    frame,
-                    str(i),
-                    tuple(center),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    1,
-                    RED,
-                    2,
-                )
-                # BGR
-                color_map = [RED, GREEN, BLUE, YELLOW]
-                for color, corners in zip(color_map, m):
-                    corners = corners.astype(int)
-                    frame = cv2.circle(frame, corners, 5, color, -1)
-        cv2.imshow("frame", frame)
-        if (k := cv2.waitKey(1)) == ord("q"):
+        with timer.span("draw"):
+            canvas = overlay.begin(frame)
+            if ids is not None:
+                markers = np.reshape(markers, (-1, 4, 2))
+                ids = np.reshape(ids, (-1,))
+                # logger.info("markers={}, ids={}", np.array(markers).shape, np.array(ids).shape)
+                overlay.markers(canvas, markers, ids)
+            if show_timing:
+                timer.draw(canvas)
+        with timer.span("imshow"):
+            cv2.imshow("frame", canvas)
+            k = cv2.waitKey(1)
+        timer.maybe_log()
+        if k == ord("q"):
             logger.info("Exiting")
             break
         elif k == ord("s"):
             now = datetime.now().strftime("%Y%m%d%H%M%S")
             file_name = f"aruco_{now}.png"
             logger.info("Saving to {}", file_name)
-            cv2.imwrite(file_name, frame)
+            with timer.span("imwrite"):
+                cv2.imwrite(file_name, canvas)
+        elif k == ord("t"):
+            show_timing = not show_timing
+    if TIMING_ENABLED and TIMING_DUMP is not None:
+        timer.dump(TIMING_DUMP)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+"""
+Pose of the diamond box (see `aruco_box.build_diamond_box_model`) from a live
+camera or, in batch, from a recording.
+"""
+
+import time
+from pathlib import Path
+from typing import Final, Iterator, Optional
+
+import awkward as ak
+import click
+import cv2
+import numpy as np
+from cv2 import aruco
+from cv2.typing import MatLike
+from loguru import logger
+
+from aruco_box import ObjectModel, build_diamond_box_model
+from detector_params import load_detector_parameters
+from overlay import OverlayMode, OverlayRenderer
+from pnp_solvers import PnPPolicy, load_pnp_policy
+from pose_stream import PosePublisher, pose_quality
+from stage_timing import StageTimer
+from undistort import UndistortMaps, load_or_build_maps
+
+NDArray = np.ndarray
+DICTIONARY: Final[int] = aruco.DICT_4X4_50
+# one marker (4 coplanar corners) already gives a pose, but a flippy one
+MIN_MARKERS: Final[int] = 2
+AXIS_LENGTH: Final[float] = 0.1
+
+
+def frames_of(source: cv2.VideoCapture, timer: StageTimer) -> Iterator[MatLike]:
+    while True:
+        with timer.span("decode"):
+            ret, frame = source.read()
+        if not ret:
+            break
+        yield frame
+
+
+def solve_box_pose(
+    model: ObjectModel,
+    maps: UndistortMaps,
+    ids: Optional[MatLike],
+    corners: MatLike,
+    timer: StageTimer,
+    policy: PnPPolicy,
+) -> Optional[tuple[NDArray, NDArray, NDArray, float]]:
+    """
+    Returns:
+        rvec, tvec, the model rows used and the reprojection RMS in pixels,
+        or `None`
+    """
+    if ids is None:
+        return None
+    with timer.span("match"):
+        object_points, image_points, rows = model.match(ids, corners)
+    if len(rows) < MIN_MARKERS:
+        return None
+    with timer.span("undistortPoints"):
+        # normalized coordinates: the distortion model is applied once per
+        # corner, not inside the solver
+        normalized = maps.undistort_points(image_points)
+    result = policy.solve(object_points, normalized)
+    timer.record(f"solvePnP[{result.solver}]", result.elapsed_ms)
+    if not result.ok:
+        return None
+    rvec, tvec = result.rvec, result.tvec
+    quality = pose_quality(
+        object_points, normalized, rvec, tvec, maps.camera_matrix[0, 0]
+    )
+    return rvec, tvec, rows.copy(), quality
+
+
+@click.command(help="estimate the pose of the diamond box per frame")
+@click.option(
+    "--video",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="batch mode: read this recording instead of the camera",
+)
+@click.option("--camera-index", type=int, default=0, show_default=True)
+@click.option(
+    "--calibration",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=Path("output") / "usbcam_cal.parquet",
+    show_default=True,
+)
+@click.option("--camera", type=str, help="detector profile name")
+@click.option(
+    "--model",
+    "model_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="object model parquet; built from the README diamond sets if omitted",
+)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="write the per-frame poses to this parquet",
+)
+@click.option(
+    "--publish",
+    type=str,
+    help="send every pose to this pose stream, e.g. udp://127.0.0.1:5700",
+)
+@click.option("--camera-id", type=int, default=0, show_default=True)
+@click.option("--object-id", type=int, default=0, show_default=True)
+@click.option("--show/--no-show", default=True, show_default=True)
+@click.option(
+    "--overlay",
+    "overlay_mode",
+    type=click.Choice([m.value for m in OverlayMode]),
+    default=OverlayMode.LITE.value,
+    show_default=True,
+)
+def main(
+    video: Optional[Path],
+    camera_index: int,
+    calibration: Path,
+    camera: Optional[str],
+    model_path: Optional[Path],
+    output: Optional[Path],
+    publish: Optional[str],
+    camera_id: int,
+    object_id: int,
+    show: bool,
+    overlay_mode: str,
+):
+    model = (
+        ObjectModel.from_parquet(model_path)
+        if model_path is not None
+        else build_diamond_box_model()
+    )
+    logger.info("Object model: {} markers on faces {}", len(model), model.names)
+    detector = aruco.ArucoDetector(
+        aruco.getPredefinedDictionary(DICTIONARY),
+        detectorParams=load_detector_parameters(camera),
+    )
+    policy = load_pnp_policy()
+    source = (
+        cv2.VideoCapture(str(video))
+        if video is not None
+        else cv2.VideoCapture(camera_index)
+    )
+    timer = StageTimer(camera=camera or "default")
+    overlay = OverlayRenderer(
+        OverlayMode(overlay_mode) if show else OverlayMode.NONE
+    )
+    maps: Optional[UndistortMaps] = None
+    publisher = PosePublisher(publish, camera_id) if publish is not None else None
+    records: list[dict] = []
+    solved = 0
+    start = time.perf_counter()
+    try:
+        for index, frame in enumerate(frames_of(source, timer)):
+            capture_ns = time.monotonic_ns()
+            if maps is None:
+                maps = load_or_build_maps(calibration, frame.shape[:2][::-1])
+            with timer.span("cvtColor"):
+                grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            with timer.span("detectMarkers"):
+                # pylint: disable-next=unpacking-non-sequence
+                corners, ids, _rejected = detector.detectMarkers(grey)
+            pose = solve_box_pose(model, maps, ids, corners, timer, policy)
+            if pose is not None:
+                rvec, tvec, rows, quality = pose
+                solved += 1
+                if publisher is not None:
+                    with timer.span("publish"):
+                        publisher.publish(
+                            index,
+                            capture_ns,
+                            rvec,
+                            tvec,
+                            quality,
+                            len(rows) * 4,
+                            object_id,
+                        )
+                if output is not None:
+                    faces = np.unique(model.faces[rows])
+                    records.append(
+                        {
+                            "frame": index,
+                            "rvec": rvec.reshape(3),
+                            "tvec": tvec.reshape(3),
+                            "ids": model.ids[rows],
+                            "faces": [model.names[f] for f in faces],
+                            "quality": quality,
+                        }
+                    )
+            if not show:
+                timer.maybe_log()
+                continue
+            with timer.span("draw"):
+                canvas = overlay.begin(frame)
+                if ids is not None:
+                    overlay.markers(canvas, corners, ids)
+                if pose is not None:
+                    overlay.axes(
+                        canvas,
+                        maps.camera_matrix,
+                        maps.distortion_coefficients,
+                        pose[0],
+                        pose[1],
+                        AXIS_LENGTH,
+                    )
+            cv2.imshow("box", canvas)
+            if cv2.waitKey(1) == ord("q"):
+                break
+            timer.maybe_log()
+    finally:
+        source.release()
+        if publisher is not None:
+            publisher.close()
+        if show:
+            cv2.destroyAllWindows()
+    elapsed = time.perf_counter() - start
+    logger.info("Box pose solved in {} frames ({:.1f} s)", solved, elapsed)
+    timer.log()
+    if output is not None and records:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        ak.to_parquet(ak.Array(records), output)
+        logger.info("Saved {} poses to {}", len(records), output)
+    elif output is not None:
+        logger.warning("No box pose solved; nothing saved to {}", output)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -1,22 +1,45 @@
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Final, Optional, TypedDict, cast
+from typing import Final, Optional, TypedDict
 
-import awkward as ak
 import cv2
 import numpy as np
-from cv2 import aruco
-from cv2.typing import MatLike
 from jaxtyping import Int, Num
 from loguru import logger
 
+from detection_log import DetectionLog, FrameRecorder, NOT_RECORDED
+from detector_params import load_detector_parameters
+from object_registry import ObjectRegistry
+from overlay import OverlayMode, OverlayRenderer
+from pnp_solvers import load_pnp_policy
+from pose_stream import DEFAULT_ADDRESS, PosePublisher
+from stage_timing import StageTimer
+from undistort import UndistortMaps, load_or_build_maps, read_camera_calibration
+
 NDArray = np.ndarray
 CALIBRATION_PARQUET = Path("output") / "usbcam_cal.parquet"
-# OBJECT_POINTS_PARQUET = Path("output") / "object_points.parquet"
-OBJECT_POINTS_PARQUET = Path("output") / "standard_box_markers.parquet"
-DICTIONARY: Final[int] = aruco.DICT_4X4_50
+# picks `output/detector_params/<name>.json` (see `tune_detector_params.py`)
+CAMERA_NAME: Optional[str] = "usbcam"
+# objects (and their dictionaries) to track, see `object_registry.py`
+OBJECTS_TOML = Path("objects.toml")
+# solve the objects of a frame on this many threads; 0 solves inline
+SOLVE_WORKERS: Final[int] = 0
 # 400mm
 MARKER_LENGTH: Final[float] = 0.4
+# per-stage latency; `t` toggles the on-frame overlay
+TIMING_ENABLED: Final[bool] = True
+TIMING_DUMP: Optional[Path] = Path("output") / "find_extrinsic_object_timing.json"
+# `OverlayMode.LITE` skips the id labels; scale < 1 draws on a smaller preview
+OVERLAY_MODE: Final[OverlayMode] = OverlayMode.FULL
+OVERLAY_SCALE: Final[float] = 1.0
+# every solved pose goes out as a `pose_stream.POSE_RECORD`; `None` disables
+POSE_STREAM: Optional[str] = DEFAULT_ADDRESS
+CAMERA_ID: Final[int] = 0
+# `r` logs detections and poses (see `detection_log.py`); raw frames are also
+# encoded, in another process, when enabled
+RECORD_RAW_FRAMES: Final[bool] = False
+RECORD_FPS: Final[float] = 30.0
 
 
 class MarkerFace(TypedDict):
@@ -39,134 +62,165 @@ class MarkerFace(TypedDict):
     """
 
 
-def gen():
+def gen(timer: StageTimer):
     API = cv2.CAP_AVFOUNDATION
     cap = cv2.VideoCapture(0, API)
     while True:
-        ret, frame = cap.read()
+        with timer.span("decode"):
+            ret, frame = cap.read()
         if not ret:
             logger.warning("Failed to grab frame")
             break
         yield frame
 
 
+def stop_recording(
+    recording: DetectionLog, recorder: Optional[FrameRecorder]
+) -> tuple[None, None]:
+    recording.close()
+    logger.info("Logged {} frames to {}", recording.written, recording.path)
+    if recorder is not None:
+        recorder.close()
+        logger.info(
+            "Recorded {} raw frames to {} ({} dropped)",
+            recorder.recorded,
+            recorder.path,
+            recorder.dropped,
+        )
+    return None, None
+
+
 def main():
-    aruco_dict = aruco.getPredefinedDictionary(DICTIONARY)
-    cal = ak.from_parquet(CALIBRATION_PARQUET)[0]
-    camera_matrix = cast(MatLike, ak.to_numpy(cal["camera_matrix"]))
-    distortion_coefficients = cast(MatLike, ak.to_numpy(cal["distortion_coefficients"]))
-    ops = ak.from_parquet(OBJECT_POINTS_PARQUET)
-    detector = aruco.ArucoDetector(
-        dictionary=aruco_dict, detectorParams=aruco.DetectorParameters()
+    camera_matrix, distortion_coefficients = read_camera_calibration(
+        CALIBRATION_PARQUET
     )
+    # built (or loaded from next to the calibration) once the frame size is known
+    maps: Optional[UndistortMaps] = None
+    show_undistorted = False
+    registry = ObjectRegistry.from_toml(
+        OBJECTS_TOML,
+        load_detector_parameters(CAMERA_NAME),
+        SOLVE_WORKERS,
+        load_pnp_policy(),
+    )
+    recording: Optional[DetectionLog] = None
+    recorder: Optional[FrameRecorder] = None
 
-    total_ids = cast(NDArray, ak.to_numpy(ops["ids"])).flatten()
-    total_corners = cast(NDArray, ak.to_numpy(ops["corners"])).reshape(-1, 4, 3)
-    ops_map: dict[int, NDArray] = dict(zip(total_ids, total_corners))
-    logger.info("ops_map={}", ops_map)
-    writer: Optional[cv2.VideoWriter] = None
-
-    for frame in gen():
-        grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # pylint: disable-next=unpacking-non-sequence
-        markers, ids, rejected = detector.detectMarkers(grey)
-        # `markers` is [N, 1, 4, 2]
-        # `ids` is [N, 1]
-        if ids is not None:
-            markers = np.reshape(markers, (-1, 4, 2))
-            ids = np.reshape(ids, (-1, 1))
-            # logger.info("markers={}, ids={}", np.array(markers).shape, np.array(ids).shape)
-            ips_map: dict[int, NDArray] = {}
-            for cs, id in zip(markers, ids):
-                id = int(id)
-                cs = cast(NDArray, cs)
-                ips_map[id] = cs
-                center = np.mean(cs, axis=0).astype(int)
-                GREY = (128, 128, 128)
-                # logger.info("id={}, center={}", id, center)
-                cv2.circle(frame, tuple(center), 5, GREY, -1)
-                cv2.putText(
-                    frame,
-                    str(id),
-                    tuple(center),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    1,
-                    GREY,
-                    2,
-                )
-                # BGR
-                RED = (0, 0, 255)
-                GREEN = (0, 255, 0)
-                BLUE = (255, 0, 0)
-                YELLOW = (0, 255, 255)
-                color_map = [RED, GREEN, BLUE, YELLOW]
-                for color, corners in zip(color_map, cs):
-                    corners = corners.astype(int)
-                    frame = cv2.circle(frame, corners, 5, color, -1)
-            # https://docs.opencv.org/4.x/d9/d0c/group__calib3d.html#ga50620f0e26e02caa2e9adc07b5fbf24e
-            ops: NDArray = np.empty((0, 3), dtype=np.float32)
-            ips: NDArray = np.empty((0, 2), dtype=np.float32)
-            for id, ip in ips_map.items():
-                try:
-                    op = ops_map[id]
-                    assert ip.shape == (4, 2), f"corners.shape={ip.shape}"
-                    assert op.shape == (4, 3), f"op.shape={op.shape}"
-                    ops = np.concatenate((ops, op), axis=0)
-                    ips = np.concatenate((ips, ip), axis=0)
-                except KeyError:
-                    logger.warning("No object points for id={}", id)
-                    continue
-            assert len(ops) == len(ips), f"len(ops)={len(ops)} != len(ips)={len(ips)}"
-            if len(ops) > 0:
-                # https://docs.opencv.org/4.x/d5/d1f/calib3d_solvePnP.html
-                # https://docs.opencv.org/4.x/d5/d1f/calib3d_solvePnP.html#calib3d_solvePnP_flags
-                ret, rvec, tvec = cv2.solvePnP(
-                    objectPoints=ops,
-                    imagePoints=ips,
-                    cameraMatrix=camera_matrix,
-                    distCoeffs=distortion_coefficients,
-                    flags=cv2.SOLVEPNP_SQPNP,
-                )
-                # ret, rvec, tvec, inliners = cv2.solvePnPRansac(
-                #     objectPoints=ops,
-                #     imagePoints=ips,
-                #     cameraMatrix=camera_matrix,
-                #     distCoeffs=distortion_coefficients,
-                #     flags=cv2.SOLVEPNP_SQPNP,
-                # )
-                if ret:
-                    cv2.drawFrameAxes(
-                        frame,
-                        camera_matrix,
-                        distortion_coefficients,
-                        rvec,
-                        tvec,
-                        MARKER_LENGTH,
-                    )
+    overlay = OverlayRenderer(OVERLAY_MODE, scale=OVERLAY_SCALE)
+    timer = StageTimer(enabled=TIMING_ENABLED, camera=CAMERA_NAME or "default")
+    show_timing = False
+    publisher = (
+        PosePublisher(POSE_STREAM, CAMERA_ID) if POSE_STREAM is not None else None
+    )
+
+    for frame_id, frame in enumerate(gen(timer)):
+        capture_ns = time.monotonic_ns()
+        if maps is None:
+            maps = load_or_build_maps(CALIBRATION_PARQUET, frame.shape[:2][::-1])
+        video_index = NOT_RECORDED
+        if recorder is not None:
+            with timer.span("record"):
+                video_index = recorder.submit(frame)
+        with timer.span("cvtColor"):
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        detections = registry.detect(grey, timer)
+        # detection runs on the raw frame; the preview (and everything drawn
+        # on it) follows the undistorted image when toggled
+        if show_undistorted:
+            with timer.span("remap"):
+                frame = maps.remap(frame)
+            draw_matrix, draw_distortion = maps.new_camera_matrix, None
+        else:
+            draw_matrix, draw_distortion = camera_matrix, distortion_coefficients
+        canvas = overlay.begin(frame)
+        with timer.span("draw"):
+            for det in detections:
+                if show_undistorted:
+                    drawn_markers = maps.undistort_points_to_pixels(det.corners)
                 else:
-                    logger.warning("Failed to solvePnPRansac")
-        cv2.imshow("frame", frame)
-        if writer is not None:
-            writer.write(frame)
-        if (k := cv2.waitKey(1)) == ord("q"):
+                    drawn_markers = det.corners
+                overlay.markers(canvas, drawn_markers, det.ids)
+        # https://docs.opencv.org/4.x/d5/d1f/calib3d_solvePnP.html
+        # https://docs.opencv.org/4.x/d5/d1f/calib3d_solvePnP.html#calib3d_solvePnP_flags
+        # PnP on normalized coordinates; the distortion model is applied once
+        # per corner instead of inside every solver step
+        poses = registry.solve(detections, maps, timer)
+        if recording is not None:
+            recording.append(frame_id, capture_ns, detections, poses, video_index)
+        for pose in poses:
+            if publisher is not None:
+                with timer.span("publish"):
+                    publisher.publish(
+                        frame_id,
+                        capture_ns,
+                        pose.rvec,
+                        pose.tvec,
+                        pose.quality,
+                        pose.points,
+                        pose.object_id,
+                    )
+            with timer.span("drawFrameAxes"):
+                overlay.axes(
+                    canvas,
+                    draw_matrix,
+                    draw_distortion,
+                    pose.rvec,
+                    pose.tvec,
+                    MARKER_LENGTH,
+                )
+        if show_timing:
+            timer.draw(canvas)
+        with timer.span("imshow"):
+            cv2.imshow("frame", canvas)
+            k = cv2.waitKey(1)
+        timer.maybe_log()
+        if k == ord("q"):
             logger.info("Exiting")
             break
         elif k == ord("s"):
             now = datetime.now().strftime("%Y%m%d%H%M%S")
             file_name = f"aruco_{now}.png"
             logger.info("Saving to {}", file_name)
-            cv2.imwrite(file_name, frame)
+            with timer.span("imwrite"):
+                cv2.imwrite(file_name, canvas)
+        elif k == ord("t"):
+            show_timing = not show_timing
+        elif k == ord("u"):
+            show_undistorted = not show_undistorted
+            logger.info("Undistorted preview {}", "on" if show_undistorted else "off")
         elif k == ord("r"):
-            if writer is not None:
-                writer.release()
-                writer = None
-                logger.info("Recording stopped")
+            if recording is not None:
+                recording, recorder = stop_recording(recording, recorder)
             else:
                 now = datetime.now().strftime("%Y%m%d%H%M%S")
-                file_name = f"aruco_{now}.mp4"
-                logger.info("Recording to {}", file_name)
-                fourcc = cv2.VideoWriter.fourcc(*"mp4v")
-                writer = cv2.VideoWriter(file_name, fourcc, 20.0, frame.shape[:2][::-1])
+                log_path = Path(f"aruco_{now}.detlog")
+                video_path = Path(f"aruco_{now}.mp4") if RECORD_RAW_FRAMES else None
+                recording = DetectionLog(
+                    log_path,
+                    {
+                        "camera": CAMERA_NAME,
+                        "calibration": str(CALIBRATION_PARQUET),
+                        "frame_size": frame.shape[:2][::-1],
+                        "fps": RECORD_FPS,
+                        "video": video_path.name if video_path else None,
+                    },
+                )
+                if video_path is not None:
+                    recorder = FrameRecorder(video_path, frame.shape, RECORD_FPS)
+                logger.info("Recording to {}", log_path)
+    if recording is not None:
+        stop_recording(recording, recorder)
+    if publisher is not None:
+        logger.info(
+            "Published {} poses to {} ({} dropped)",
+            publisher.sent,
+            POSE_STREAM,
+            publisher.dropped,
+        )
+        publisher.close()
+    registry.close()
+    if TIMING_ENABLED and TIMING_DUMP is not None:
+        timer.dump(TIMING_DUMP)
 
 
 if __name__ == "__main__":
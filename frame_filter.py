@@ -0,0 +1,189 @@
+"""
+Cheap pre-filter in front of board detection for video-sourced calibration:
+frames that are motion blurred, or nearly identical to the last accepted
+frame, never reach `detectBoard`.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Final, Iterable, Iterator, Optional, TypeVar
+
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from loguru import logger
+
+NDArray = np.ndarray
+K = TypeVar("K")
+
+# width of the grey thumbnail both scores are computed on
+THUMBNAIL_WIDTH: Final[int] = 320
+# per-frame decay of the recent sharpness peak `relative_sharpness` compares to
+PEAK_DECAY: Final[float] = 0.98
+
+
+@dataclass
+class FrameScore:
+    sharpness: float
+    """
+    variance of the Laplacian of the thumbnail; low means blurred
+    """
+    change: float
+    """
+    mean absolute difference to the last accepted thumbnail, in grey levels;
+    `inf` for the first frame
+    """
+
+
+@dataclass
+class FilterStats:
+    seen: int = 0
+    blurry: int = 0
+    similar: int = 0
+    filter_ms: float = 0.0
+    """
+    total time spent scoring frames
+    """
+
+    @property
+    def accepted(self) -> int:
+        return self.seen - self.blurry - self.similar
+
+    @property
+    def dropped(self) -> int:
+        return self.blurry + self.similar
+
+    def saved_ms(self, detect_ms: float) -> float:
+        """
+        estimated wall time saved, given the mean cost of one detector call
+        """
+        return self.dropped * detect_ms - self.filter_ms
+
+
+class FrameFilter:
+    """
+    Args:
+        min_sharpness: frames whose Laplacian variance is below are dropped
+            as blurred; the scale depends on the scene, so start from the
+            `sharpness` logged with `debug=True`
+        relative_sharpness: frames below this fraction of the recent
+            sharpness peak are dropped as blurred too; motion blur shows up
+            as a drop relative to the still frames around it, whatever the
+            scene's absolute level
+        min_change: frames closer than this (mean grey levels) to the last
+            accepted frame are dropped as redundant
+        max_skip: accept a sharp frame after this many consecutive
+            redundant ones anyway, so a slowly drifting board still gets
+            sampled; 0 disables
+    """
+
+    min_sharpness: float
+    relative_sharpness: float
+    min_change: float
+    max_skip: int
+    debug: bool
+    stats: FilterStats
+    _last: Optional[NDArray]
+    _skipped: int
+    _peak: float
+
+    def __init__(
+        self,
+        min_sharpness: float = 50.0,
+        relative_sharpness: float = 0.5,
+        min_change: float = 4.0,
+        max_skip: int = 0,
+        debug: bool = False,
+    ):
+        self.min_sharpness = min_sharpness
+        self.relative_sharpness = relative_sharpness
+        self.min_change = min_change
+        self.max_skip = max_skip
+        self.debug = debug
+        self.stats = FilterStats()
+        self._last = None
+        self._skipped = 0
+        self._peak = 0.0
+
+    @staticmethod
+    def thumbnail(frame: MatLike) -> NDArray:
+        h, w = frame.shape[:2]
+        if w > THUMBNAIL_WIDTH:
+            size = (THUMBNAIL_WIDTH, max(1, round(h * THUMBNAIL_WIDTH / w)))
+            # downsample before the color conversion; both are cheaper that way
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def score(self, thumb: NDArray) -> FrameScore:
+        lap = cv2.Laplacian(thumb, cv2.CV_32F)
+        _, std = cv2.meanStdDev(lap)
+        sharpness = float(std[0, 0]) ** 2
+        if self._last is None or self._last.shape != thumb.shape:
+            change = float("inf")
+        else:
+            change = float(cv2.mean(cv2.absdiff(thumb, self._last))[0])
+        return FrameScore(sharpness=sharpness, change=change)
+
+    def accept(self, frame: MatLike) -> bool:
+        start = time.perf_counter_ns()
+        thumb = self.thumbnail(frame)
+        s = self.score(thumb)
+        self.stats.seen += 1
+        self._peak = max(s.sharpness, self._peak * PEAK_DECAY)
+        if (
+            s.sharpness < self.min_sharpness
+            or s.sharpness < self.relative_sharpness * self._peak
+        ):
+            self.stats.blurry += 1
+            ok = False
+        elif s.change < self.min_change and not (
+            self.max_skip > 0 and self._skipped >= self.max_skip
+        ):
+            self.stats.similar += 1
+            self._skipped += 1
+            ok = False
+        else:
+            self._last = thumb
+            self._skipped = 0
+            ok = True
+        self.stats.filter_ms += (time.perf_counter_ns() - start) / 1e6
+        if self.debug:
+            logger.debug(
+                "sharpness={:.1f} change={:.2f} -> {}",
+                s.sharpness,
+                s.change,
+                "keep" if ok else "drop",
+            )
+        return ok
+
+    def filter(self, frames: Iterable[tuple[K, MatLike]]) -> Iterator[tuple[K, MatLike]]:
+        for key, frame in frames:
+            if self.accept(frame):
+                yield key, frame
+
+    def report(self, detect_ms: Optional[float] = None):
+        """
+        Args:
+            detect_ms: mean cost of one detector call, to estimate time saved
+        """
+        s = self.stats
+        if s.seen == 0:
+            return
+        logger.info(
+            "Frame filter: {}/{} frames kept ({} blurry, {} similar dropped, "
+            "{:.1f}x fewer detector calls), {:.2f} ms/frame scoring",
+            s.accepted,
+            s.seen,
+            s.blurry,
+            s.similar,
+            s.seen / max(1, s.accepted),
+            s.filter_ms / s.seen,
+        )
+        if detect_ms is not None:
+            logger.info(
+                "Frame filter: ~{:.1f} s saved at {:.1f} ms/detection",
+                s.saved_ms(detect_ms) / 1e3,
+                detect_ms,
+            )
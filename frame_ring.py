@@ -0,0 +1,373 @@
+"""
+Zero-copy frame transport between a producer (capture/decode) and detection
+worker processes.
+
+Frames are written once into fixed-size slots of a `SharedMemory` ring; only
+`(seq, slot)` pairs travel through the task queue, and only the (small)
+detection results are pickled back.
+"""
+
+import multiprocessing as mp
+import os
+import queue
+from itertools import chain
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Final, Generic, Iterable, Iterator, Optional, TypeVar
+
+import numpy as np
+from loguru import logger
+
+NDArray = np.ndarray
+K = TypeVar("K")
+R = TypeVar("R")
+
+SLOT_FREE: Final[int] = 0
+SLOT_FILLED: Final[int] = 1
+# per slot: state, sequence number
+HEADER_FIELDS: Final[int] = 2
+# frames start on a cache line
+HEADER_ALIGN: Final[int] = 64
+
+
+@dataclass(frozen=True)
+class FrameRingSpec:
+    """
+    everything a worker process needs to attach to a ring (picklable)
+    """
+
+    name: str
+    slots: int
+    shape: tuple[int, ...]
+    dtype: str
+
+    @property
+    def frame_bytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    @property
+    def header_bytes(self) -> int:
+        raw = self.slots * HEADER_FIELDS * np.dtype(np.int64).itemsize
+        return -(-raw // HEADER_ALIGN) * HEADER_ALIGN
+
+    @property
+    def total_bytes(self) -> int:
+        return self.header_bytes + self.slots * self.frame_bytes
+
+
+class FrameRing:
+    """
+    Fixed-size frame slots in shared memory.
+
+    A slot goes FREE -> FILLED in the producer (`acquire` + `publish`) and
+    FILLED -> FREE in whichever worker consumed it (`release`), so no lock is
+    needed as long as there is a single producer.
+    """
+
+    _shm: SharedMemory
+    _owner: bool
+    _cursor: int
+    spec: FrameRingSpec
+    frames: NDArray
+    """
+    (slots, *shape) view of the frame slots
+    """
+    states: NDArray
+    seqs: NDArray
+
+    def __init__(self, spec: FrameRingSpec, shm: SharedMemory, owner: bool):
+        self.spec = spec
+        self._shm = shm
+        self._owner = owner
+        self._cursor = 0
+        header = np.ndarray(
+            (spec.slots, HEADER_FIELDS), dtype=np.int64, buffer=shm.buf
+        )
+        self.states = header[:, 0]
+        self.seqs = header[:, 1]
+        self.frames = np.ndarray(
+            (spec.slots, *spec.shape),
+            dtype=np.dtype(spec.dtype),
+            buffer=shm.buf,
+            offset=spec.header_bytes,
+        )
+
+    @staticmethod
+    def create(slots: int, shape: tuple[int, ...], dtype: Any = np.uint8) -> "FrameRing":
+        assert slots > 0
+        spec = FrameRingSpec("", slots, tuple(shape), np.dtype(dtype).str)
+        shm = SharedMemory(create=True, size=spec.total_bytes)
+        spec = FrameRingSpec(shm.name, slots, tuple(shape), np.dtype(dtype).str)
+        ring = FrameRing(spec, shm, owner=True)
+        ring.states[:] = SLOT_FREE
+        ring.seqs[:] = -1
+        return ring
+
+    @staticmethod
+    def attach(spec: FrameRingSpec) -> "FrameRing":
+        # the creating process owns the segment; do not let this process'
+        # resource tracker unlink it on exit
+        shm = SharedMemory(name=spec.name, track=False)
+        return FrameRing(spec, shm, owner=False)
+
+    @property
+    def occupancy(self) -> int:
+        return int(np.count_nonzero(self.states != SLOT_FREE))
+
+    def acquire(self) -> Optional[int]:
+        """
+        a free slot to write into, or `None` when every slot is in use
+        """
+        slots = self.spec.slots
+        for i in range(slots):
+            slot = (self._cursor + i) % slots
+            if self.states[slot] == SLOT_FREE:
+                self._cursor = (slot + 1) % slots
+                return slot
+        return None
+
+    def publish(self, slot: int, seq: int):
+        self.seqs[slot] = seq
+        self.states[slot] = SLOT_FILLED
+
+    def release(self, slot: int):
+        self.states[slot] = SLOT_FREE
+
+    def close(self):
+        # drop our views before closing the mapping
+        del self.frames, self.states, self.seqs
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+@dataclass
+class RingMetrics:
+    slots: int
+    occupancy: int
+    peak_occupancy: int
+    written: int
+    dropped: int
+    """
+    frames rejected because every slot was in use (non-blocking submit)
+    """
+    completed: int
+
+
+def _worker_main(
+    spec: FrameRingSpec,
+    make_worker: Callable[[], Callable[[NDArray], Any]],
+    tasks: Any,
+    results: Any,
+):
+    ring = FrameRing.attach(spec)
+    fn = make_worker()
+    try:
+        while (task := tasks.get()) is not None:
+            seq, slot = task
+            try:
+                # `fn` must not keep references into the slot; it is reused
+                # as soon as it is released
+                result: Any = fn(ring.frames[slot])
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                result = e
+            ring.release(slot)
+            results.put((seq, result))
+    finally:
+        ring.close()
+
+
+class DetectionPool(Generic[R]):
+    """
+    N worker processes reading frames from a `FrameRing`, results returned
+    in submission order.
+
+    Args:
+        make_worker: picklable factory called once in each worker process,
+            returning the per-frame function (e.g. a bound `detectMarkers`);
+            detectors are not picklable, so they are built on the worker side
+        frame_shape: shape of every submitted frame
+        slots: ring size, defaults to twice the worker count
+        block: when the ring is full, `submit` waits for a free slot (batch)
+            instead of dropping the frame (live)
+    """
+
+    def __init__(
+        self,
+        make_worker: Callable[[], Callable[[NDArray], R]],
+        frame_shape: tuple[int, ...],
+        dtype: Any = np.uint8,
+        workers: Optional[int] = None,
+        slots: Optional[int] = None,
+        block: bool = True,
+    ):
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        if slots is None:
+            slots = workers * 2
+        self._block = block
+        self._ring = FrameRing.create(slots, frame_shape, dtype)
+        ctx = mp.get_context()
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._processes = [
+            ctx.Process(
+                target=_worker_main,
+                args=(self._ring.spec, make_worker, self._tasks, self._results),
+                daemon=True,
+            )
+            for _ in range(workers)
+        ]
+        for p in self._processes:
+            p.start()
+        self._next_seq = 0
+        self._next_out = 0
+        self._pending: dict[int, R] = {}
+        self._peak = 0
+        self._dropped = 0
+        self._completed = 0
+        self._closed = False
+
+    @property
+    def metrics(self) -> RingMetrics:
+        return RingMetrics(
+            slots=self._ring.spec.slots,
+            occupancy=self._ring.occupancy,
+            peak_occupancy=self._peak,
+            written=self._next_seq,
+            dropped=self._dropped,
+            completed=self._completed,
+        )
+
+    @property
+    def in_flight(self) -> int:
+        """
+        submitted frames whose results have not been yielded yet
+        """
+        return self._next_seq - self._next_out
+
+    def _check_workers(self):
+        dead = [p for p in self._processes if not p.is_alive()]
+        if dead:
+            codes = ", ".join(f"{p.pid} ({p.exitcode})" for p in dead)
+            raise RuntimeError(f"detection worker(s) died: {codes}")
+
+    def _collect(self, timeout: Optional[float]) -> bool:
+        try:
+            seq, result = self._results.get(timeout=timeout)
+        except queue.Empty:
+            # a dead worker never posts its frame, so waiting on it would hang
+            self._check_workers()
+            return False
+        if isinstance(result, Exception):
+            raise RuntimeError(f"worker failed on frame {seq}") from result
+        self._pending[seq] = result
+        self._completed += 1
+        return True
+
+    def submit(self, frame: NDArray) -> Optional[int]:
+        """
+        copy `frame` into the ring and queue it
+
+        Returns:
+            the sequence number, or `None` if the frame was dropped
+        """
+        if frame.shape != self._ring.spec.shape:
+            raise ValueError(
+                f"frame shape {frame.shape} != ring shape {self._ring.spec.shape}"
+            )
+        slot = self._ring.acquire()
+        while slot is None:
+            if not self._block:
+                self._dropped += 1
+                return None
+            # slots are released before results are posted, so waiting for
+            # a result is waiting for a slot
+            self._collect(timeout=1.0)
+            slot = self._ring.acquire()
+        seq = self._next_seq
+        self._ring.frames[slot] = frame
+        self._ring.publish(slot, seq)
+        self._tasks.put((seq, slot))
+        self._next_seq += 1
+        self._peak = max(self._peak, self._ring.occupancy)
+        return seq
+
+    def results(self, wait: bool = False) -> Iterator[tuple[int, R]]:
+        """
+        results ready in frame order
+
+        Args:
+            wait: block until every submitted frame has been returned
+        """
+        while self._next_out < self._next_seq:
+            if self._next_out not in self._pending:
+                if not self._collect(timeout=1.0 if wait else 0) and not wait:
+                    return
+                continue
+            seq = self._next_out
+            self._next_out += 1
+            yield seq, self._pending.pop(seq)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for p in self._processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                logger.warning("Detection worker {} did not exit; terminating", p.pid)
+                p.terminate()
+        self._ring.close()
+
+    def __enter__(self) -> "DetectionPool[R]":
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.close()
+
+
+def imap_ordered(
+    frames: Iterable[tuple[K, NDArray]],
+    make_worker: Callable[[], Callable[[NDArray], R]],
+    workers: Optional[int] = None,
+    slots: Optional[int] = None,
+    block: bool = True,
+) -> Iterator[tuple[K, NDArray, R]]:
+    """
+    run `make_worker()` over `(key, frame)` pairs in worker processes and yield
+    `(key, frame, result)` in input order
+
+    The ring is sized from the first frame, so all frames must share its shape.
+    With `block=False` frames arriving while every slot is busy are skipped.
+    """
+    it = iter(frames)
+    first = next(it, None)
+    if first is None:
+        return
+    keyed: dict[int, tuple[K, NDArray]] = {}
+    pool: DetectionPool[R] = DetectionPool(
+        make_worker, first[1].shape, first[1].dtype, workers, slots, block
+    )
+    with pool:
+        for key, frame in chain((first,), it):
+            seq = pool.submit(frame)
+            if seq is not None:
+                keyed[seq] = (key, frame)
+            for seq, result in pool.results():
+                key, frame = keyed.pop(seq)
+                yield key, frame, result
+        for seq, result in pool.results(wait=True):
+            key, frame = keyed.pop(seq)
+            yield key, frame, result
+        m = pool.metrics
+        logger.info(
+            "Frame ring: {} written, {} dropped, peak occupancy {}/{}",
+            m.written,
+            m.dropped,
+            m.peak_occupancy,
+            m.slots,
+        )
+
@@ -0,0 +1,590 @@
+"""
+Every board asset in one pass, in process: each face of the sets in
+`boards.toml` is rendered with OpenCV's board image generation to PNG and
+drawn as a vector PDF (the same geometry, in mm) on a thread pool; the UV
+layout of a set is composed from those rasters and its object model written
+at once.
+
+```
+python gen_boards.py
+python gen_boards.py --set aruco_600x600 --set diamond --dpi 300
+python gen_boards.py --set diamond --write-models
+```
+
+Object models land next to the boards unless `--write-models` puts them at
+their `boards.toml` paths (which `objects.toml` reads), so a plain run never
+replaces a model refined by `refine_object_model.py`.
+
+Replaces `MarkerPrinter.py` (`gen.sh`), `magick convert`
+(`cvt_all_pdfs.sh`) and the PIL composition of `draw_uv.ipynb`. The object
+model comes from the marker corners as laid out, not from detecting them in
+the layout image as `scripts/uv_to_object_points.py` does.
+"""
+
+import os
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final, Optional
+
+import click
+import cv2
+import numpy as np
+import trimesh
+from cv2 import aruco
+from cv2.typing import MatLike
+from jaxtyping import Bool, Float, Int
+from loguru import logger
+
+from aruco_box import DIAMOND_PARAMS, ObjectModel, build_diamond_box_model
+from scripts.uv_to_object_points import (
+    interpolate_uvs_to_3d_trimesh,
+    load_mesh,
+    scale_mesh_for_box_size_mm,
+)
+from stage_timing import StageTimer
+
+NDArray = np.ndarray
+
+BOARDS_TOML: Final[Path] = Path("boards.toml")
+BOARD_FOLDER: Final[Path] = Path("board")
+# the density `cvt_all_pdfs.sh` rasterized at
+DEFAULT_DPI: Final[float] = 100
+MM_PER_INCH: Final[float] = 25.4
+PT_PER_MM: Final[float] = 72 / MM_PER_INCH
+BORDER_BITS: Final[int] = 1
+EMPTY_CELL: Final[int] = -1
+KINDS: Final[tuple[str, ...]] = ("charuco", "aruco", "diamond")
+
+
+@dataclass(frozen=True)
+class BoardSet:
+    """
+    One printed board per face, lengths in mm; a diamond is a 3x3 ChArUco
+    board with the geometry of `aruco_box.DIAMOND_PARAMS`.
+    """
+
+    name: str
+    kind: str
+    dictionary: str
+    size_mm: tuple[float, float]
+    """
+    page (width, height) of one face
+    """
+    grid: tuple[int, int]
+    """
+    squares (charuco, diamond) or markers (aruco) along x and y
+    """
+    square_mm: float
+    marker_mm: float
+    separation_mm: float
+    """
+    gap between the markers of an aruco grid
+    """
+    first_id: int
+    faces: int
+    face_names: tuple[str, ...]
+    layout: Optional[tuple[tuple[int, ...], ...]]
+    """
+    face of each UV canvas cell, `EMPTY_CELL` for none
+    """
+    mesh: Optional[Path]
+    model: Optional[Path]
+
+    @property
+    def markers_per_face(self) -> int:
+        if self.kind == "aruco":
+            return self.grid[0] * self.grid[1]
+        # markers sit on the white squares, the top-left square is black
+        return self.grid[0] * self.grid[1] // 2
+
+    @property
+    def extent_mm(self) -> Float[NDArray, "2"]:
+        grid = np.asarray(self.grid, dtype=np.float64)
+        if self.kind == "aruco":
+            return grid * self.marker_mm + (grid - 1) * self.separation_mm
+        return grid * self.square_mm
+
+    @property
+    def offset_mm(self) -> Float[NDArray, "2"]:
+        """
+        top-left of the board on its page; boards are centered
+        """
+        return (np.asarray(self.size_mm) - self.extent_mm) / 2
+
+    def aruco_dictionary(self) -> aruco.Dictionary:
+        return aruco.getPredefinedDictionary(int(getattr(aruco, self.dictionary)))
+
+    def face_ids(self, face: int) -> Int[NDArray, "M"]:
+        n = self.markers_per_face
+        return np.arange(self.first_id + face * n, self.first_id + (face + 1) * n)
+
+    def board(self, face: int) -> aruco.Board:
+        dictionary = self.aruco_dictionary()
+        ids = self.face_ids(face)
+        if self.kind == "aruco":
+            return aruco.GridBoard(
+                self.grid,
+                self.marker_mm / 1000,
+                self.separation_mm / 1000,
+                dictionary,
+                ids,
+            )
+        return aruco.CharucoBoard(
+            self.grid, self.square_mm / 1000, self.marker_mm / 1000, dictionary, ids
+        )
+
+    def stem(self, face: int) -> str:
+        """
+        the file names of the existing `board/` assets
+        """
+        w, h = self.size_mm
+        nx, ny = self.grid
+        first = self.face_ids(face)[0]
+        if self.kind == "aruco":
+            border = min(self.offset_mm)
+            return (
+                f"aruco_board_{w:g}x{h:g}_border{border:g}_m{self.marker_mm:g}"
+                f"_face{face}_id{first}_{self.dictionary}"
+            )
+        return (
+            f"{self.kind}_{w:g}x{h:g}_{nx}x{ny}_s{self.square_mm:g}_m{self.marker_mm:g}"
+            f"_face{face}_no_{first}_{self.dictionary}"
+        )
+
+
+def read_board_sets(path: Path = BOARDS_TOML) -> dict[str, BoardSet]:
+    with path.open("rb") as f:
+        config = tomllib.load(f)
+    sets: dict[str, BoardSet] = {}
+    for name, entry in config["boards"].items():
+        kind = str(entry["kind"])
+        if kind not in KINDS:
+            raise ValueError(f"board set {name}: unknown kind {kind!r}")
+        faces = int(entry.get("faces", 1))
+        if kind == "diamond":
+            chess = DIAMOND_PARAMS.chess_length * 1000
+            side = 3 * chess + 2 * DIAMOND_PARAMS.border_length * 1000
+            size, grid = (side, side), (3, 3)
+            square, marker = chess, DIAMOND_PARAMS.marker_leghth * 1000
+        else:
+            size = (float(entry["size_mm"][0]), float(entry["size_mm"][1]))
+            nx, ny = entry.get("grid", (1, 1))
+            grid = (int(nx), int(ny))
+            square = float(entry.get("square_mm", 0.0))
+            marker = float(entry["marker_mm"])
+        layout = entry.get("layout")
+        dictionary = str(entry["dictionary"])
+        bits = (
+            aruco.getPredefinedDictionary(int(getattr(aruco, dictionary))).markerSize
+            + 2 * BORDER_BITS
+        )
+        board_set = BoardSet(
+            name=name,
+            kind=kind,
+            dictionary=dictionary,
+            size_mm=size,
+            grid=grid,
+            square_mm=square,
+            marker_mm=marker,
+            # one marker bit by default, the smallest gap OpenCV does not warn about
+            separation_mm=float(entry.get("separation_mm", marker / bits)),
+            first_id=int(entry["first_id"]),
+            faces=faces,
+            face_names=tuple(
+                entry.get("face_names", [f"face{i}" for i in range(faces)])
+            ),
+            layout=(
+                tuple(tuple(int(c) for c in row) for row in layout) if layout else None
+            ),
+            mesh=Path(entry["mesh"]) if "mesh" in entry else None,
+            model=Path(entry["model"]) if "model" in entry else None,
+        )
+        if np.any(board_set.offset_mm < 0):
+            raise ValueError(f"board set {name}: the board does not fit its page")
+        if len(board_set.face_names) != faces:
+            raise ValueError(
+                f"board set {name}: {faces} faces but {len(board_set.face_names)} names"
+            )
+        sets[name] = board_set
+    return sets
+
+
+def face_markers(
+    board_set: BoardSet, board: aruco.Board
+) -> tuple[Int[NDArray, "M"], Float[NDArray, "M 4 2"]]:
+    """
+    ids and TL, TR, BR, BL corners of a face's markers, in mm from the
+    top-left of its page
+    """
+    corners = np.asarray(board.getObjPoints(), dtype=np.float64)[..., :2] * 1000
+    return np.asarray(board.getIds()).reshape(-1), corners + board_set.offset_mm
+
+
+def _runs(black: Bool[NDArray, "R C"]) -> Int[NDArray, "K 3"]:
+    """
+    (row, start, length) of the horizontal runs of `True`
+    """
+    edges = np.diff(np.pad(black, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return np.stack([rows, starts, ends - starts], axis=1)
+
+
+def face_rects(
+    board_set: BoardSet,
+    dictionary: aruco.Dictionary,
+    ids: Int[NDArray, "M"],
+    corners: Float[NDArray, "M 4 2"],
+) -> Float[NDArray, "R 4"]:
+    """
+    the black areas of a face as (x, y, w, h) in mm from the top-left of its
+    page; runs of black marker bits and chess squares are merged per row
+    """
+    rects: list[NDArray] = []
+    if board_set.kind != "aruco":
+        cells = np.ones(board_set.grid[::-1], dtype=bool)
+        centers = corners.mean(axis=1) - board_set.offset_mm
+        x, y = np.floor(centers / board_set.square_mm).astype(int).T
+        cells[y, x] = False
+        runs = _runs(cells).astype(np.float64)
+        origin = board_set.offset_mm
+        rects.append(
+            np.stack(
+                [
+                    origin[0] + runs[:, 1] * board_set.square_mm,
+                    origin[1] + runs[:, 0] * board_set.square_mm,
+                    runs[:, 2] * board_set.square_mm,
+                    np.full(len(runs), board_set.square_mm),
+                ],
+                axis=1,
+            )
+        )
+    bits = dictionary.markerSize + 2 * BORDER_BITS
+    for marker_id, quad in zip(ids, corners):
+        module = (quad[1, 0] - quad[0, 0]) / bits
+        image = aruco.generateImageMarker(
+            dictionary, int(marker_id), bits, borderBits=BORDER_BITS
+        )
+        runs = _runs(image < 128).astype(np.float64)
+        rects.append(
+            np.stack(
+                [
+                    quad[0, 0] + runs[:, 1] * module,
+                    quad[0, 1] + runs[:, 0] * module,
+                    runs[:, 2] * module,
+                    np.full(len(runs), module),
+                ],
+                axis=1,
+            )
+        )
+    return np.concatenate(rects)
+
+
+def write_pdf(
+    path: Path, size_mm: tuple[float, float], rects: Float[NDArray, "R 4"]
+):
+    """
+    a one-page PDF of black rectangles, `rects` as (x, y, w, h) in mm from the
+    top-left
+    """
+    width, height = np.asarray(size_mm) * PT_PER_MM
+    pt = rects * PT_PER_MM
+    # PDF user space has its origin at the bottom-left
+    pt[:, 1] = height - pt[:, 1] - pt[:, 3]
+    ops = "\n".join(f"{x:.3f} {y:.3f} {w:.3f} {h:.3f} re" for x, y, w, h in pt)
+    content = f"0 g\n{ops}\nf\n".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:.3f} {height:.3f}]"
+            " /Contents 4 0 R >>"
+        ).encode(),
+        b"<< /Length %d >>\nstream\n%b\nendstream" % (len(content), content),
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets: list[int] = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%b\nendobj\n" % (i, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    path.write_bytes(out)
+
+
+@dataclass
+class FaceAsset:
+    face: int
+    image: MatLike
+    """
+    the rendered face, grey
+    """
+    ids: Int[NDArray, "M"]
+    corners: Float[NDArray, "M 4 2"]
+    """
+    in mm, see `face_markers`
+    """
+    timings: dict[str, float]
+    """
+    stage -> ms
+    """
+
+
+def render_face(
+    board_set: BoardSet, face: int, dpi: float, folder: Path
+) -> FaceAsset:
+    """
+    `<stem>.png` and `<stem>.pdf` of one face into `folder`
+    """
+    timings: dict[str, float] = {}
+    start = time.perf_counter_ns()
+    board = board_set.board(face)
+    px_per_mm = dpi / MM_PER_INCH
+    size = np.round(np.asarray(board_set.size_mm) * px_per_mm).astype(int)
+    margin = int(board_set.offset_mm.min() * px_per_mm)
+    image = board.generateImage(
+        (int(size[0]), int(size[1])), marginSize=margin, borderBits=BORDER_BITS
+    )
+    ids, corners = face_markers(board_set, board)
+    lap = time.perf_counter_ns()
+    timings["render"] = (lap - start) / 1e6
+
+    stem = board_set.stem(face)
+    cv2.imwrite(str(folder / f"{stem}.png"), image)
+    start, lap = lap, time.perf_counter_ns()
+    timings["png"] = (lap - start) / 1e6
+
+    rects = face_rects(board_set, board.getDictionary(), ids, corners)
+    write_pdf(folder / f"{stem}.pdf", board_set.size_mm, rects)
+    timings["pdf"] = (time.perf_counter_ns() - lap) / 1e6
+    return FaceAsset(face, image, ids, corners, timings)
+
+
+def _layout_frame(
+    board_set: BoardSet, tile: tuple[float, float]
+) -> tuple[float, float, float]:
+    """
+    (side, left, top) of the square UV canvas holding the layout centered,
+    for tiles of (width, height)
+    """
+    assert board_set.layout is not None
+    rows, cols = len(board_set.layout), len(board_set.layout[0])
+    side = max(cols * tile[0], rows * tile[1])
+    return side, (side - cols * tile[0]) / 2, (side - rows * tile[1]) / 2
+
+
+def compose_layout(board_set: BoardSet, assets: dict[int, FaceAsset]) -> MatLike:
+    """
+    the UV texture: face rasters pasted on the layout grid, padded to a square
+    as `draw_uv.ipynb` did
+    """
+    assert board_set.layout is not None
+    height, width = assets[0].image.shape[:2]
+    side, left, top = _layout_frame(board_set, (width, height))
+    canvas = np.full((int(side), int(side)), 255, dtype=np.uint8)
+    for r, row in enumerate(board_set.layout):
+        for c, face in enumerate(row):
+            if face == EMPTY_CELL:
+                continue
+            y = int(top) + r * height
+            x = int(left) + c * width
+            canvas[y : y + height, x : x + width] = assets[face].image
+    return canvas
+
+
+def layout_uv(
+    board_set: BoardSet, assets: dict[int, FaceAsset]
+) -> dict[int, Float[NDArray, "M 4 2"]]:
+    """
+    marker corners of the faces on the layout as UV coordinates (origin at
+    the bottom-left, see `scripts/uv_to_object_points.py`)
+    """
+    assert board_set.layout is not None
+    width, height = board_set.size_mm
+    side, left, top = _layout_frame(board_set, (width, height))
+    uv: dict[int, NDArray] = {}
+    for r, row in enumerate(board_set.layout):
+        for c, face in enumerate(row):
+            if face == EMPTY_CELL:
+                continue
+            origin = (left + c * width, top + r * height)
+            points = (assets[face].corners + origin) / side
+            points[..., 1] = 1 - points[..., 1]
+            uv[face] = points
+    return uv
+
+
+def build_model(
+    board_set: BoardSet,
+    assets: dict[int, FaceAsset],
+    mesh: Optional[trimesh.Trimesh],
+) -> ObjectModel:
+    """
+    the diamond box from its closed form, otherwise the laid-out marker
+    corners mapped through the UV of `mesh` (scaled to the face size)
+    """
+    if board_set.kind == "diamond":
+        return build_diamond_box_model(
+            DIAMOND_PARAMS,
+            {
+                board_set.face_names[f]: tuple(int(i) for i in assets[f].ids)
+                for f in range(board_set.faces)
+            },
+        )
+    assert mesh is not None
+    uv = layout_uv(board_set, assets)
+    faces = sorted(uv)
+    points = interpolate_uvs_to_3d_trimesh(
+        np.concatenate([uv[f] for f in faces]).reshape(-1, 2), mesh
+    )
+    if np.isnan(points).any():
+        raise ValueError(f"board set {board_set.name}: markers outside the mesh UV")
+    return ObjectModel(
+        names=[board_set.face_names[f] for f in faces],
+        faces=np.repeat(np.arange(len(faces)), [len(assets[f].ids) for f in faces]),
+        ids=np.concatenate([assets[f].ids for f in faces]).astype(np.int64),
+        corners=points.reshape(-1, 4, 3),
+    )
+
+
+def _load_box_mesh(board_set: BoardSet) -> Optional[trimesh.Trimesh]:
+    assert board_set.mesh is not None
+    try:
+        mesh = load_mesh(board_set.mesh)
+    except (OSError, ValueError) as e:
+        logger.warning(
+            "No object model for {}: cannot load {} ({})",
+            board_set.name,
+            board_set.mesh,
+            e,
+        )
+        return None
+    except TypeError:
+        logger.error(
+            "No object model for {}: {} holds no triangle mesh",
+            board_set.name,
+            board_set.mesh,
+        )
+        return None
+    return scale_mesh_for_box_size_mm(mesh, board_set.size_mm[0])
+
+
+@click.command(
+    help="render the board sets of boards.toml to PNG and PDF, "
+    "with their UV layouts and object models"
+)
+@click.option(
+    "--boards",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=BOARDS_TOML,
+    show_default=True,
+)
+@click.option(
+    "--set", "names", multiple=True, help="board sets to render; all by default"
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=BOARD_FOLDER,
+    show_default=True,
+    help="faces go to <output-dir>/<set>/, layouts to "
+    "<output-dir>/<set>_uv_layout.png, object models to <output-dir>/<model name>",
+)
+@click.option(
+    "--write-models",
+    is_flag=True,
+    help="write object models to the `model` paths of boards.toml instead, "
+    "replacing those (possibly refined) models",
+)
+@click.option("--dpi", type=float, default=DEFAULT_DPI, show_default=True)
+@click.option(
+    "--workers", type=int, default=os.cpu_count() or 1, show_default=True
+)
+@click.option(
+    "--timings",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="also write the stage timings (.json or .csv)",
+)
+def main(
+    boards: Path,
+    names: tuple[str, ...],
+    output_dir: Path,
+    dpi: float,
+    workers: int,
+    write_models: bool,
+    timings: Optional[Path],
+):
+    sets = read_board_sets(boards)
+    unknown = set(names) - sets.keys()
+    if unknown:
+        raise click.BadParameter(
+            f"unknown board sets: {sorted(unknown)}", param_hint="--set"
+        )
+    selected = [sets[n] for n in names] if names else list(sets.values())
+    timer = StageTimer()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        pending = []
+        for board_set in selected:
+            folder = output_dir / board_set.name
+            folder.mkdir(parents=True, exist_ok=True)
+            pending.extend(
+                (board_set, pool.submit(render_face, board_set, face, dpi, folder))
+                for face in range(board_set.faces)
+            )
+        rendered: dict[str, dict[int, FaceAsset]] = {}
+        for board_set, future in pending:
+            asset = future.result()
+            rendered.setdefault(board_set.name, {})[asset.face] = asset
+            for stage, ms in asset.timings.items():
+                timer.record(stage, ms, board_set.name)
+
+    for board_set in selected:
+        assets = rendered[board_set.name]
+        if board_set.layout is not None:
+            with timer.span("layout", board_set.name):
+                layout = compose_layout(board_set, assets)
+                cv2.imwrite(str(output_dir / f"{board_set.name}_uv_layout.png"), layout)
+        if board_set.model is None:
+            continue
+        mesh = None
+        if board_set.kind != "diamond":
+            mesh = _load_box_mesh(board_set)
+            if mesh is None:
+                continue
+        model_path = (
+            board_set.model if write_models else output_dir / board_set.model.name
+        )
+        with timer.span("model", board_set.name):
+            model = build_model(board_set, assets, mesh)
+            model_path.parent.mkdir(parents=True, exist_ok=True)
+            model.to_parquet(model_path)
+        logger.info(
+            "Saved object model of {} ({} markers) to {}",
+            board_set.name,
+            len(model),
+            model_path,
+        )
+
+    timer.log()
+    logger.info(
+        "{} faces of {} board sets at {:g} dpi in {:.2f} s",
+        sum(s.faces for s in selected),
+        len(selected),
+        dpi,
+        time.perf_counter() - start,
+    )
+    if timings is not None:
+        timer.dump(timings)
+
+
+if __name__ == "__main__":
+    main()
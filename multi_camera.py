@@ -0,0 +1,576 @@
+"""
+Every camera of the rig at once: one detection/pose worker process per
+camera, pinned to its own core, results merged into one stream ordered by
+capture time.
+
+Cameras come from `videos.toml` (`name`, `port`, or the guessed
+`unconfirmed_port` with `--unconfirmed-ports`); a worker loads
+`output/<name>.parquet` (see `--calibration-dir`) as its calibration and the
+detector profile of the same name. Live workers decode the camera's RTP
+stream with GStreamer; with `--video-dir` they read the camera's recorded
+videos instead (headless stand in for the rig).
+
+```
+python multi_camera.py --publish udp://127.0.0.1:5700
+python multi_camera.py --video-dir dumped/rig --take 0 --output output/rig_poses.parquet
+```
+
+Back-pressure is per worker: a worker holds at most `--depth` results the
+merger has not taken yet. Live workers skip frames (`grab` without
+`retrieve`) while they are out of credit, so a slow camera never delays the others; file workers
+wait instead, so that no frame is lost.
+"""
+
+import heapq
+import multiprocessing as mp
+import os
+import queue
+import time
+import tomllib
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Final, Iterator, Optional
+
+import awkward as ak
+import click
+import cv2
+import numpy as np
+from loguru import logger
+
+from detector_params import load_detector_parameters
+from object_registry import ObjectRegistry
+from pnp_solvers import load_pnp_policy
+from pose_stream import PosePublisher
+from stage_timing import StageTimer
+from undistort import UndistortMaps, load_or_build_maps
+
+NDArray = np.ndarray
+
+RIG_TOML: Final[Path] = Path("videos.toml")
+CALIBRATION_FOLDER: Final[Path] = Path("output")
+OBJECTS_TOML: Final[Path] = Path("objects.toml")
+# results a worker may have in flight before it has to skip or wait
+QUEUE_DEPTH: Final[int] = 4
+# a result is held back at most this long waiting for slower cameras; should
+# exceed the worst per-frame processing time, or results come out of order
+MERGE_WINDOW_MS: Final[float] = 100.0
+REPORT_INTERVAL_S: Final[float] = 5.0
+
+
+@dataclass(frozen=True)
+class CameraSpec:
+    key: str
+    name: str
+    port: Optional[int]
+    """
+    live stream port; `None` until the camera's port is confirmed
+    """
+    calibration: Path
+    videos: tuple[str, ...] = ()
+    unconfirmed_port: Optional[int] = None
+    """
+    guessed port, used only with `--unconfirmed-ports`
+    """
+
+
+def read_rig(
+    path: Path = RIG_TOML, calibration_folder: Path = CALIBRATION_FOLDER
+) -> list[CameraSpec]:
+    with path.open("rb") as f:
+        config = tomllib.load(f)
+    return [
+        CameraSpec(
+            key=key,
+            name=str(entry["name"]),
+            port=int(entry["port"]) if "port" in entry else None,
+            calibration=calibration_folder / f"{entry['name']}.parquet",
+            videos=tuple(entry.get("videos", ())),
+            unconfirmed_port=(
+                int(entry["unconfirmed_port"]) if "unconfirmed_port" in entry else None
+            ),
+        )
+        for key, entry in config["cameras"].items()
+    ]
+
+
+def rtp_pipeline(port: int) -> str:
+    """
+    the decode branch of `run_capture.DumpCommand`, ending in an appsink that
+    keeps only the newest frame
+    """
+    return (
+        f"udpsrc port={port} "
+        "! application/x-rtp,encoding-name=H265,payload=96 "
+        "! rtph265depay ! h265parse ! decodebin ! videoconvert "
+        "! video/x-raw,format=BGR ! appsink drop=true max-buffers=1 sync=false"
+    )
+
+
+@dataclass
+class SourceSpec:
+    """
+    picklable description of where a worker reads its frames
+    """
+
+    video: Optional[Path] = None
+    """
+    file stand-in; `None` reads the live stream of the camera
+    """
+    realtime: bool = False
+    """
+    pace a file at its frame rate and drop like a live source
+    """
+    loop: bool = False
+
+
+@dataclass
+class CameraResult:
+    camera: int
+    frame_id: int
+    capture_ns: int
+    process_ms: float
+    poses: list[tuple[int, NDArray, NDArray, float, int]]
+    """
+    (object id, rvec, tvec, quality, points)
+    """
+    skipped: int
+    """
+    frames skipped for lack of credit since the previous result
+    """
+
+    def __lt__(self, other: "CameraResult") -> bool:
+        return (self.capture_ns, self.camera) < (other.capture_ns, other.camera)
+
+
+@dataclass
+class _WorkerEnd:
+    camera: int
+    error: Optional[str] = None
+
+
+def _open_source(spec: CameraSpec, source: SourceSpec) -> cv2.VideoCapture:
+    if source.video is None:
+        return cv2.VideoCapture(rtp_pipeline(spec.port), cv2.CAP_GSTREAMER)
+    return cv2.VideoCapture(str(source.video))
+
+
+def _grab(cap: cv2.VideoCapture, source: SourceSpec) -> Iterator[int]:
+    """
+    capture ns of every grabbed frame; the caller `retrieve`s the frames it
+    has the capacity for
+    """
+    period_ns = 0
+    if source.video is not None and source.realtime:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        period_ns = int(1e9 / fps) if fps > 0 else 0
+    start = time.monotonic_ns()
+    index = 0
+    rewound = False
+    while True:
+        if period_ns:
+            delay = start + index * period_ns - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+        if not cap.grab():
+            # a rewind that yields no frame would otherwise retry forever
+            if source.loop and source.video is not None and index > 0 and not rewound:
+                rewound = True
+                if cap.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    continue
+            if rewound:
+                logger.warning("Cannot rewind {}; stopping", source.video)
+            return
+        rewound = False
+        index += 1
+        yield time.monotonic_ns()
+
+
+def _camera_worker(
+    index: int,
+    spec: CameraSpec,
+    source: SourceSpec,
+    objects_toml: Path,
+    core: Optional[int],
+    credits: Any,
+    results: Any,
+    stop: Any,
+    max_frames: Optional[int],
+):
+    if core is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {core})
+    # one core per camera; OpenCV's own thread pool would only contend
+    cv2.setNumThreads(1)
+    # file sources wait for credit, live sources skip frames without it
+    block = source.video is not None and not source.realtime
+    try:
+        registry = ObjectRegistry.from_toml(
+            objects_toml, load_detector_parameters(spec.name), policy=load_pnp_policy()
+        )
+        cap = _open_source(spec, source)
+        if not cap.isOpened():
+            raise RuntimeError(f"cannot open the source of camera {spec.name}")
+        maps: Optional[UndistortMaps] = None
+        timer = StageTimer(enabled=False)
+        skipped = 0
+        frame_id = 0
+        for capture_ns in _grab(cap, source):
+            if stop.is_set() or (max_frames is not None and frame_id >= max_frames):
+                break
+            if not credits.acquire(block=block):
+                skipped += 1
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                credits.release()
+                continue
+            start = time.perf_counter_ns()
+            if maps is None:
+                maps = load_or_build_maps(spec.calibration, frame.shape[:2][::-1])
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            poses = registry.solve(registry.detect(grey, timer), maps, timer)
+            results.put(
+                CameraResult(
+                    index,
+                    frame_id,
+                    capture_ns,
+                    (time.perf_counter_ns() - start) / 1e6,
+                    [
+                        (p.object_id, p.rvec.ravel(), p.tvec.ravel(), p.quality, p.points)
+                        for p in poses
+                    ],
+                    skipped,
+                )
+            )
+            skipped = 0
+            frame_id += 1
+        cap.release()
+        registry.close()
+        results.put(_WorkerEnd(index))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        results.put(_WorkerEnd(index, repr(e)))
+
+
+class TimeOrderedMerge:
+    """
+    k-way merge of per-camera result streams (each already in capture order)
+
+    A result is released once every running camera has something queued
+    behind it, or once it is older than `window_ns`; a stalled camera thus
+    costs the others at most `window_ns` of latency.
+    """
+
+    def __init__(self, cameras: int, window_ns: int):
+        self.window_ns = window_ns
+        self._heap: list[CameraResult] = []
+        self._queued = np.zeros(cameras, dtype=np.int64)
+        self._running = np.ones(cameras, dtype=bool)
+        self.late = 0
+        """
+        results released after a later capture had already gone out
+        """
+        self._last_ns = -1
+
+    def push(self, result: CameraResult):
+        heapq.heappush(self._heap, result)
+        self._queued[result.camera] += 1
+
+    def finish(self, camera: int):
+        self._running[camera] = False
+
+    def pop_ready(self, now_ns: int) -> Iterator[CameraResult]:
+        while self._heap:
+            waiting = self._running & (self._queued == 0)
+            head = self._heap[0]
+            if np.any(waiting) and now_ns - head.capture_ns < self.window_ns:
+                return
+            heapq.heappop(self._heap)
+            self._queued[head.camera] -= 1
+            if head.capture_ns < self._last_ns:
+                self.late += 1
+            self._last_ns = max(self._last_ns, head.capture_ns)
+            yield head
+
+
+@dataclass
+class CameraStats:
+    name: str
+    frames: int = 0
+    skipped: int = 0
+    poses: int = 0
+    window_frames: int = 0
+    process_ms: list[float] = field(default_factory=list)
+
+
+def run_rig(
+    cameras: list[CameraSpec],
+    sources: list[SourceSpec],
+    objects_toml: Path = OBJECTS_TOML,
+    depth: int = QUEUE_DEPTH,
+    pin: bool = True,
+    max_frames: Optional[int] = None,
+    window_ms: float = MERGE_WINDOW_MS,
+) -> Iterator[CameraResult]:
+    """
+    start one worker per camera and yield their results in capture order
+    """
+    ctx = mp.get_context()
+    results = ctx.Queue()
+    stop = ctx.Event()
+    credits = [ctx.Semaphore(depth) for _ in cameras]
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if pin and len(cores) < len(cameras):
+        logger.warning(
+            "{} cameras on {} cores; workers share cores", len(cameras), len(cores)
+        )
+    workers = [
+        ctx.Process(
+            target=_camera_worker,
+            args=(
+                i,
+                spec,
+                source,
+                objects_toml,
+                cores[i % len(cores)] if pin and cores else None,
+                credits[i],
+                results,
+                stop,
+                max_frames,
+            ),
+            daemon=True,
+            name=f"camera-{spec.name}",
+        )
+        for i, (spec, source) in enumerate(zip(cameras, sources))
+    ]
+    for w in workers:
+        w.start()
+    merge = TimeOrderedMerge(len(cameras), int(window_ms * 1e6))
+    running = len(workers)
+    try:
+        while running > 0:
+            try:
+                item = results.get(timeout=window_ms / 1e3)
+            except queue.Empty:
+                item = None
+            if isinstance(item, _WorkerEnd):
+                running -= 1
+                merge.finish(item.camera)
+                if item.error is not None:
+                    logger.error("Camera {} failed: {}", cameras[item.camera].name, item.error)
+            elif item is not None:
+                merge.push(item)
+            for r in merge.pop_ready(time.monotonic_ns()):
+                credits[r.camera].release()
+                yield r
+        # every worker is done; flush what is left
+        yield from merge.pop_ready(np.iinfo(np.int64).max)
+    finally:
+        stop.set()
+        # unblock workers waiting for credit
+        for c in credits:
+            for _ in range(depth):
+                c.release()
+        for w in workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                logger.warning("Worker {} did not exit; terminating", w.name)
+                w.terminate()
+        if merge.late:
+            logger.warning("{} results merged out of capture order", merge.late)
+
+
+def _report(stats: list[CameraStats], elapsed_s: float, total: bool = False):
+    per_camera = ", ".join(
+        f"{s.name} {(s.frames if total else s.window_frames) / elapsed_s:.1f}"
+        for s in stats
+    )
+    frames = sum(s.frames if total else s.window_frames for s in stats)
+    logger.info(
+        "{}fps {:.1f} aggregate ({})",
+        "overall " if total else "",
+        frames / elapsed_s,
+        per_camera,
+    )
+
+
+@click.command(help="detect and solve poses on every camera of the rig at once")
+@click.option(
+    "--rig",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=RIG_TOML,
+    show_default=True,
+)
+@click.option(
+    "--objects",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=OBJECTS_TOML,
+    show_default=True,
+)
+@click.option(
+    "--calibration-dir",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    default=CALIBRATION_FOLDER,
+    show_default=True,
+    help="holds <camera name>.parquet",
+)
+@click.option(
+    "--camera",
+    "only",
+    type=str,
+    multiple=True,
+    help="camera names to run (default: all)",
+)
+@click.option(
+    "--video-dir",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="read each camera's recorded videos from here instead of its port",
+)
+@click.option(
+    "--take",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="which video of each camera; cameras with fewer videos are skipped",
+)
+@click.option("--realtime", is_flag=True, help="pace videos at their frame rate, drop like live")
+@click.option("--loop", is_flag=True, help="restart videos at their end")
+@click.option(
+    "--unconfirmed-ports",
+    is_flag=True,
+    help="stream live from the guessed `unconfirmed_port` of cameras without a `port`",
+)
+@click.option("--max-frames", type=int, help="per camera")
+@click.option("--depth", type=int, default=QUEUE_DEPTH, show_default=True)
+@click.option("--pin/--no-pin", default=True, show_default=True)
+@click.option("--window-ms", type=float, default=MERGE_WINDOW_MS, show_default=True)
+@click.option("--publish", type=str, help="pose stream address, see pose_stream.py")
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path), help="parquet")
+def main(
+    rig: Path,
+    objects: Path,
+    calibration_dir: Path,
+    only: tuple[str, ...],
+    video_dir: Optional[Path],
+    take: int,
+    realtime: bool,
+    loop: bool,
+    unconfirmed_ports: bool,
+    max_frames: Optional[int],
+    depth: int,
+    pin: bool,
+    window_ms: float,
+    publish: Optional[str],
+    output: Optional[Path],
+):
+    cameras = [c for c in read_rig(rig, calibration_dir) if not only or c.name in only]
+    if not cameras:
+        raise click.UsageError("no camera selected")
+    if video_dir is None:
+        unconfirmed = [c for c in cameras if c.port is None]
+        if unconfirmed and not unconfirmed_ports:
+            raise click.UsageError(
+                f"no confirmed port for {', '.join(c.name for c in unconfirmed)} "
+                f"in {rig}; set `port`, or pass --unconfirmed-ports to use the guess"
+            )
+        for c in unconfirmed:
+            if c.unconfirmed_port is None:
+                raise click.UsageError(f"camera {c.name} has no port in {rig}")
+            logger.warning(
+                "Camera {} streams from the unconfirmed port {}",
+                c.name,
+                c.unconfirmed_port,
+            )
+        cameras = [
+            c if c.port is not None else replace(c, port=c.unconfirmed_port)
+            for c in cameras
+        ]
+        sources = [SourceSpec() for _ in cameras]
+    else:
+        for c in cameras:
+            if take >= len(c.videos):
+                logger.warning(
+                    "Camera {} has {} video(s), no take {}; skipping",
+                    c.name,
+                    len(c.videos),
+                    take,
+                )
+        cameras = [c for c in cameras if take < len(c.videos)]
+        if not cameras:
+            raise click.BadParameter(
+                f"no selected camera has a take {take}", param_hint="--take"
+            )
+        sources = [
+            SourceSpec(video_dir / c.videos[take], realtime=realtime, loop=loop)
+            for c in cameras
+        ]
+    for c, s in zip(cameras, sources):
+        logger.info(
+            "Camera {} ({}): {}",
+            c.key,
+            c.name,
+            s.video if s.video is not None else f"port {c.port}",
+        )
+
+    publishers = (
+        [PosePublisher(publish, i) for i in range(len(cameras))]
+        if publish is not None
+        else []
+    )
+    stats = [CameraStats(c.name) for c in cameras]
+    records: list[dict[str, Any]] = []
+    start = last_report = time.monotonic()
+    try:
+        for r in run_rig(
+            cameras, sources, objects, depth, pin, max_frames, window_ms
+        ):
+            s = stats[r.camera]
+            s.frames += 1
+            s.window_frames += 1
+            s.skipped += r.skipped
+            s.poses += len(r.poses)
+            s.process_ms.append(r.process_ms)
+            for object_id, rvec, tvec, quality, points in r.poses:
+                if publishers:
+                    publishers[r.camera].publish(
+                        r.frame_id, r.capture_ns, rvec, tvec, quality, points, object_id
+                    )
+                if output is not None:
+                    records.append(
+                        {
+                            "camera": cameras[r.camera].name,
+                            "frame": r.frame_id,
+                            "capture_ns": r.capture_ns,
+                            "object_id": object_id,
+                            "rvec": rvec,
+                            "tvec": tvec,
+                            "quality": quality,
+                        }
+                    )
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL_S:
+                _report(stats, now - last_report)
+                for s in stats:
+                    s.window_frames = 0
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    _report(stats, time.monotonic() - start, total=True)
+    for s in stats:
+        ms = np.array(s.process_ms) if s.process_ms else np.zeros(1)
+        logger.info(
+            "  {}: {} frames, {} skipped, {} poses, detect+solve p50 {:.2f} ms p95 {:.2f} ms",
+            s.name,
+            s.frames,
+            s.skipped,
+            s.poses,
+            *np.percentile(ms, (50, 95)),
+        )
+    for p in publishers:
+        p.close()
+    if output is not None and records:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        ak.to_parquet(ak.Array(records), output)
+        logger.info("Saved {} poses to {}", len(records), output)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,307 @@
+"""
+Several tracked objects (boxes, boards) from one detection pass per
+dictionary.
+
+Each frame runs `detectMarkers` once per dictionary in use, undistorts all
+detected corners in one call, partitions them by id into per-object
+correspondence sets and solves every visible object's pose.
+
+Objects are listed in a TOML file:
+
+```toml
+[objects.standard_box]
+id = 0
+dictionary = "DICT_APRILTAG_36h11"
+model = "output/standard_box_markers.parquet"
+```
+
+`model = "diamond"` builds `aruco_box.build_diamond_box_model()` instead of
+reading a parquet.
+"""
+
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final, Optional
+
+import numpy as np
+from cv2 import aruco
+from cv2.typing import MatLike
+from jaxtyping import Float, Int
+from loguru import logger
+
+from aruco_box import ObjectModel, build_diamond_box_model
+from pnp_solvers import PnPPolicy
+from pose_stream import pose_quality
+from stage_timing import StageTimer
+from undistort import UndistortMaps
+
+NDArray = np.ndarray
+
+BUILTIN_MODELS: Final = {"diamond": build_diamond_box_model}
+
+
+def model_dictionary(path: Path, model_ref: str) -> Optional[str]:
+    """
+    dictionary name of the object whose `model` is `model_ref`, if listed
+    """
+    with path.open("rb") as f:
+        config = tomllib.load(f)
+    for entry in config["objects"].values():
+        ref = str(entry["model"])
+        if ref == model_ref or (
+            ref not in BUILTIN_MODELS and Path(ref) == Path(model_ref)
+        ):
+            return str(entry["dictionary"])
+    return None
+
+
+@dataclass
+class TrackedObject:
+    name: str
+    object_id: int
+    """
+    `object_id` of its pose records (see `pose_stream.py`)
+    """
+    dictionary: int
+    model: ObjectModel
+    min_markers: int = 1
+    """
+    markers needed before a pose is attempted
+    """
+
+
+@dataclass
+class ObjectPose:
+    name: str
+    object_id: int
+    rvec: NDArray
+    tvec: NDArray
+    quality: float
+    """
+    reprojection RMS in pixels
+    """
+    points: int
+    solver: str = ""
+    """
+    the `pnp_solvers.SOLVERS` entry that produced the pose
+    """
+
+
+@dataclass
+class Detections:
+    dictionary: int
+    corners: Float[NDArray, "N 4 2"]
+    ids: Int[NDArray, "N"]
+
+
+class _DictionaryGroup:
+    """
+    the objects sharing one dictionary: one detector and one dense id table
+    mapping every id to its owner object and model row
+    """
+
+    def __init__(
+        self,
+        dictionary: int,
+        members: list[int],
+        objects: list[TrackedObject],
+        detector_params: aruco.DetectorParameters,
+    ):
+        self.dictionary = dictionary
+        self.members = members
+        self.detector = aruco.ArucoDetector(
+            aruco.getPredefinedDictionary(dictionary), detectorParams=detector_params
+        )
+        size = max(int(objects[i].model.ids.max(initial=-1)) for i in members) + 2
+        # the last slot stays -1; `clip` sends unknown ids there
+        self.owner = np.full(size, -1, dtype=np.intp)
+        self.row = np.full(size, -1, dtype=np.intp)
+        for i in members:
+            ids = objects[i].model.ids
+            taken = self.owner[ids] >= 0
+            if np.any(taken):
+                other = objects[int(self.owner[ids[taken][0]])].name
+                raise ValueError(
+                    f"marker ids {ids[taken].tolist()} of {objects[i].name!r} "
+                    f"are already used by {other!r}"
+                )
+            self.owner[ids] = i
+            self.row[ids] = np.arange(len(ids))
+
+
+class ObjectRegistry:
+    """
+    Args:
+        workers: solve the objects of a frame on this many threads
+            (`solvePnP` releases the GIL); only pays off with many objects
+            visible at once, 0 solves inline
+        policy: picks the PnP solver per object and frame (see
+            `pnp_solvers.load_pnp_policy`)
+    """
+
+    objects: list[TrackedObject]
+
+    def __init__(
+        self,
+        objects: list[TrackedObject],
+        detector_params: Optional[aruco.DetectorParameters] = None,
+        workers: int = 0,
+        policy: Optional[PnPPolicy] = None,
+    ):
+        if detector_params is None:
+            detector_params = aruco.DetectorParameters()
+        self.objects = objects
+        self.policy = policy if policy is not None else PnPPolicy()
+        by_dictionary: dict[int, list[int]] = {}
+        for i, obj in enumerate(objects):
+            by_dictionary.setdefault(obj.dictionary, []).append(i)
+        self.groups = [
+            _DictionaryGroup(d, members, objects, detector_params)
+            for d, members in by_dictionary.items()
+        ]
+        self._executor = ThreadPoolExecutor(workers) if workers > 0 else None
+
+    @staticmethod
+    def from_toml(
+        path: Path,
+        detector_params: Optional[aruco.DetectorParameters] = None,
+        workers: int = 0,
+        policy: Optional[PnPPolicy] = None,
+    ) -> "ObjectRegistry":
+        with path.open("rb") as f:
+            config = tomllib.load(f)
+        objects: list[TrackedObject] = []
+        for name, entry in config["objects"].items():
+            model_ref = str(entry["model"])
+            if model_ref in BUILTIN_MODELS:
+                model = BUILTIN_MODELS[model_ref]()
+            else:
+                model = ObjectModel.from_parquet(Path(model_ref))
+            objects.append(
+                TrackedObject(
+                    name=name,
+                    object_id=int(entry["id"]),
+                    dictionary=int(getattr(aruco, entry["dictionary"])),
+                    model=model,
+                    min_markers=int(entry.get("min_markers", 1)),
+                )
+            )
+            logger.info(
+                "Tracking {} (id {}): {} markers, {}",
+                name,
+                entry["id"],
+                len(model),
+                entry["dictionary"],
+            )
+        return ObjectRegistry(objects, detector_params, workers, policy)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def detect(self, grey: MatLike, timer: StageTimer) -> list[Detections]:
+        """
+        one `detectMarkers` per dictionary in use
+        """
+        out: list[Detections] = []
+        for g in self.groups:
+            stage = (
+                "detectMarkers"
+                if len(self.groups) == 1
+                else f"detectMarkers[{g.dictionary}]"
+            )
+            with timer.span(stage):
+                # pylint: disable-next=unpacking-non-sequence
+                corners, ids, _rejected = g.detector.detectMarkers(grey)
+            if ids is None:
+                continue
+            out.append(
+                Detections(
+                    g.dictionary,
+                    np.reshape(corners, (-1, 4, 2)),
+                    np.reshape(ids, -1),
+                )
+            )
+        return out
+
+    def _partition(
+        self, g: _DictionaryGroup, ids: NDArray, normalized: NDArray
+    ) -> list[tuple[int, NDArray, NDArray]]:
+        """
+        (object index, object points, normalized image points) of every
+        object with at least `min_markers` detections
+        """
+        owner = np.take(g.owner, ids, mode="clip")
+        order = np.argsort(owner, kind="stable")
+        owner = owner[order]
+        starts = np.searchsorted(owner, g.members)
+        ends = np.searchsorted(owner, g.members, side="right")
+        out = []
+        for i, start, end in zip(g.members, starts, ends):
+            if end - start < self.objects[i].min_markers:
+                continue
+            sel = order[start:end]
+            rows = np.take(g.row, ids[sel])
+            out.append(
+                (
+                    i,
+                    self.objects[i].model.corners[rows].reshape(-1, 3),
+                    normalized[sel].reshape(-1, 2),
+                )
+            )
+        return out
+
+    def solve(
+        self,
+        detections: list[Detections],
+        maps: UndistortMaps,
+        timer: StageTimer,
+    ) -> list[ObjectPose]:
+        """
+        poses of every object visible in this frame's detections
+        """
+        tasks: list[tuple[int, NDArray, NDArray]] = []
+        for det in detections:
+            g = next(g for g in self.groups if g.dictionary == det.dictionary)
+            with timer.span("undistortPoints"):
+                normalized = maps.undistort_points(det.corners).reshape(-1, 4, 2)
+            with timer.span("partition"):
+                tasks.extend(self._partition(g, det.ids, normalized))
+        focal = float(maps.camera_matrix[0, 0])
+
+        def run(task: tuple[int, NDArray, NDArray]):
+            i, object_points, image_points = task
+            result = self.policy.solve(object_points, image_points)
+            if not result.ok:
+                return i, None, result
+            obj = self.objects[i]
+            pose = ObjectPose(
+                obj.name,
+                obj.object_id,
+                result.rvec,
+                result.tvec,
+                pose_quality(
+                    object_points, image_points, result.rvec, result.tvec, focal
+                ),
+                len(object_points),
+                result.solver,
+            )
+            return i, pose, result
+
+        if self._executor is not None and len(tasks) > 1:
+            results = list(self._executor.map(run, tasks))
+        else:
+            results = [run(t) for t in tasks]
+        poses: list[ObjectPose] = []
+        for i, pose, result in results:
+            # recorded here rather than in the workers; `StageTimer` is not
+            # thread safe
+            timer.record(
+                f"solvePnP[{self.objects[i].name}/{result.solver}]",
+                result.elapsed_ms,
+            )
+            if pose is not None:
+                poses.append(pose)
+        return poses
@@ -0,0 +1,432 @@
+"""
+Calibration while the capture loop keeps running.
+
+The capture loop only hands frames over (`submit` never blocks); a detection
+thread turns them into board views kept in a bounded, diversity-binned
+`ViewReservoir`, and a solver thread periodically re-runs `calibrateCamera`
+warm-started from the last intrinsics, publishing a `CalibrationStatus` the
+overlay reads. `detectBoard` and `calibrateCamera` release the GIL, so
+neither thread holds the capture loop back.
+"""
+
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Final, Optional, cast
+
+import awkward as ak
+import cv2
+import numpy as np
+from cv2 import aruco
+from cv2.typing import MatLike
+from jaxtyping import Float, Int
+from loguru import logger
+
+from calib_diagnostics import Observations, outlier_views
+
+NDArray = np.ndarray
+
+# a view with fewer corners adds little and destabilizes the first solves
+MIN_VIEW_CORNERS: Final[int] = 8
+MIN_SOLVE_VIEWS: Final[int] = 6
+# image cells for the coverage map
+COVERAGE_GRID: Final[tuple[int, int]] = (8, 6)
+# edge length ratio beyond which a board counts as tilted that way
+TILT_RATIO: Final[float] = 1.15
+# sqrt(board area / image area) bin edges
+SCALE_EDGES: Final[tuple[float, ...]] = (0.3, 0.55)
+POSITION_BINS: Final[int] = 3
+
+ViewKey = tuple[int, int, int, int, int]
+
+
+@dataclass
+class BoardView:
+    object_points: Float[NDArray, "N 3"]
+    image_points: Float[NDArray, "N 2"]
+    key: ViewKey
+    """
+    (column, row, scale, horizontal tilt, vertical tilt) bin
+    """
+    stamp: float
+
+
+def board_outline(board: aruco.CharucoBoard) -> Float[NDArray, "4 2"]:
+    w, h = board.getChessboardSize()
+    s = board.getSquareLength()
+    return np.array([(0, 0), (w * s, 0), (w * s, h * s), (0, h * s)], np.float32)
+
+
+def view_key(
+    object_points: Float[NDArray, "N 3"],
+    image_points: Float[NDArray, "N 2"],
+    outline: Float[NDArray, "4 2"],
+    image_size: tuple[int, int],
+) -> Optional[ViewKey]:
+    """
+    where the whole board sits in the image, how large it is and which way it
+    is tilted, from the homography of the detected corners; needs no
+    intrinsics
+    """
+    H, _ = cv2.findHomography(object_points[:, :2], image_points)
+    if H is None:
+        return None
+    quad = cv2.perspectiveTransform(outline[np.newaxis], H)[0]
+    w, h = image_size
+    center = quad.mean(axis=0)
+    col = int(np.clip(center[0] / w * POSITION_BINS, 0, POSITION_BINS - 1))
+    row = int(np.clip(center[1] / h * POSITION_BINS, 0, POSITION_BINS - 1))
+    area = abs(cv2.contourArea(quad))
+    scale = int(np.searchsorted(SCALE_EDGES, np.sqrt(area / (w * h))))
+    edges = np.linalg.norm(quad - np.roll(quad, -1, axis=0), axis=1)
+    # top, right, bottom, left
+
+    def tilt(a: float, b: float) -> int:
+        r = a / max(b, 1e-6)
+        return 0 if r < 1 / TILT_RATIO else 2 if r > TILT_RATIO else 1
+
+    return (col, row, scale, tilt(edges[3], edges[1]), tilt(edges[0], edges[2]))
+
+
+class ViewReservoir:
+    """
+    At most `capacity` views, at most `per_bin` in each `view_key` bin.
+
+    A view of a new (or sparse) bin evicts one from the most crowded bin once
+    full; within a full bin a view with more corners replaces the one with the
+    fewest. Memory is bounded by `capacity` and poses stay spread out, rather
+    than being dominated by wherever the board was held longest.
+    """
+
+    capacity: int
+    per_bin: int
+    bins: dict[ViewKey, list[BoardView]]
+    generation: int
+    """
+    bumped on every change, so the solver can tell there is something new
+    """
+
+    def __init__(self, capacity: int = 60, per_bin: int = 3, seed: int = 0):
+        self.capacity = capacity
+        self.per_bin = per_bin
+        self.bins = {}
+        self.generation = 0
+        self._size = 0
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, view: BoardView) -> bool:
+        b = self.bins.setdefault(view.key, [])
+        if len(b) < self.per_bin:
+            if self._size >= self.capacity:
+                crowded = max(self.bins.values(), key=len)
+                if len(crowded) <= len(b) + 1:
+                    return False
+                crowded.pop(int(self._rng.integers(len(crowded))))
+                self._size -= 1
+            b.append(view)
+            self._size += 1
+        else:
+            worst = min(range(len(b)), key=lambda i: len(b[i].image_points))
+            if len(view.image_points) <= len(b[worst].image_points):
+                return False
+            b[worst] = view
+        self.generation += 1
+        return True
+
+    def remove(self, views: list[BoardView]):
+        ids = {id(v) for v in views}
+        for key, b in self.bins.items():
+            kept = [v for v in b if id(v) not in ids]
+            self._size -= len(b) - len(kept)
+            self.bins[key] = kept
+        self.generation += 1
+
+    def views(self) -> list[BoardView]:
+        return [v for b in self.bins.values() for v in b]
+
+    @property
+    def filled_bins(self) -> int:
+        return sum(1 for b in self.bins.values() if b)
+
+
+@dataclass(frozen=True)
+class CalibrationStatus:
+    """
+    one published solve; replaced as a whole, never mutated
+    """
+
+    camera_matrix: Optional[Float[NDArray, "3 3"]] = None
+    distortion_coefficients: Optional[Float[NDArray, "1 D"]] = None
+    rms: float = float("nan")
+    views: int = 0
+    bins: int = 0
+    worst_view_rms: float = float("nan")
+    coverage: float = 0.0
+    """
+    fraction of `COVERAGE_GRID` cells holding at least one corner
+    """
+    coverage_map: Int[NDArray, "R C"] = field(
+        default_factory=lambda: np.zeros(COVERAGE_GRID[::-1], dtype=np.int32)
+    )
+    solve_ms: float = 0.0
+    generation: int = 0
+    """
+    number of solves so far
+    """
+
+
+def coverage_of(
+    views: list[BoardView], image_size: tuple[int, int]
+) -> Int[NDArray, "R C"]:
+    cols, rows = COVERAGE_GRID
+    w, h = image_size
+    if not views:
+        return np.zeros((rows, cols), dtype=np.int32)
+    points = np.concatenate([v.image_points for v in views])
+    cx = np.clip((points[:, 0] / w * cols).astype(np.intp), 0, cols - 1)
+    cy = np.clip((points[:, 1] / h * rows).astype(np.intp), 0, rows - 1)
+    return np.bincount(cy * cols + cx, minlength=rows * cols).reshape(rows, cols)
+
+
+class OnlineCalibrator:
+    """
+    ```
+    calibrator = OnlineCalibrator(create_board(), (w, h))
+    calibrator.start()
+    for frame in frames:
+        calibrator.submit(frame)
+        calibrator.draw(frame)
+    calibrator.stop()
+    calibrator.save(path)
+    ```
+
+    Args:
+        solve_interval_s: minimum time between solves
+        prune: drop outlier views (see `calib_diagnostics.outlier_views`) from
+            the reservoir after each solve
+    """
+
+    board: aruco.CharucoBoard
+    image_size: tuple[int, int]
+    reservoir: ViewReservoir
+    submitted: int
+    skipped: int
+    """
+    frames not detected on because the detection thread was still busy
+    """
+
+    def __init__(
+        self,
+        board: aruco.CharucoBoard,
+        image_size: tuple[int, int],
+        detector_params: Optional[aruco.DetectorParameters] = None,
+        capacity: int = 60,
+        per_bin: int = 3,
+        solve_interval_s: float = 2.0,
+        flags: int = 0,
+        prune: bool = True,
+    ):
+        self.board = board
+        self.image_size = image_size
+        self.reservoir = ViewReservoir(capacity, per_bin)
+        self.solve_interval_s = solve_interval_s
+        self.flags = flags
+        self.prune = prune
+        self.submitted = 0
+        self.skipped = 0
+        self._detector = aruco.CharucoDetector(
+            board,
+            detectorParams=(
+                detector_params
+                if detector_params is not None
+                else aruco.DetectorParameters()
+            ),
+        )
+        self._outline = board_outline(board)
+        self._frames: queue.Queue[MatLike] = queue.Queue(maxsize=1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._status = CalibrationStatus()
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def status(self) -> CalibrationStatus:
+        return self._status
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._detect_loop, name="calib-detect", daemon=True),
+            threading.Thread(target=self._solve_loop, name="calib-solve", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=10)
+        self._threads = []
+
+    def submit(self, frame: MatLike) -> bool:
+        """
+        offer a frame to the detection thread; never blocks
+
+        Returns:
+            whether the frame was taken (it must not be modified afterwards)
+        """
+        self.submitted += 1
+        try:
+            self._frames.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.skipped += 1
+            return False
+
+    def _detect_loop(self):
+        while not self._stop.is_set():
+            try:
+                frame = self._frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+            # pylint: disable-next=unpacking-non-sequence
+            ch_corners, ch_ids, _, _ = self._detector.detectBoard(grey)
+            if ch_corners is None or len(ch_corners) < MIN_VIEW_CORNERS:
+                continue
+            # pylint: disable-next=unpacking-non-sequence
+            op, ip = self.board.matchImagePoints(ch_corners, ch_ids)
+            op = np.reshape(op, (-1, 3)).astype(np.float32)
+            ip = np.reshape(ip, (-1, 2)).astype(np.float32)
+            key = view_key(op, ip, self._outline, self.image_size)
+            if key is None:
+                continue
+            with self._lock:
+                self.reservoir.add(BoardView(op, ip, key, time.monotonic()))
+
+    def _solve_loop(self):
+        solved_generation = -1
+        while not self._stop.wait(self.solve_interval_s):
+            with self._lock:
+                if self.reservoir.generation == solved_generation:
+                    continue
+                solved_generation = self.reservoir.generation
+                views = self.reservoir.views()
+                bins = self.reservoir.filled_bins
+            if len(views) < MIN_SOLVE_VIEWS:
+                continue
+            try:
+                self._solve(views, bins)
+            except cv2.error as e:
+                logger.warning("Online calibration solve failed: {}", e)
+
+    def _solve(self, views: list[BoardView], bins: int):
+        last = self._status
+        object_points = [v.object_points for v in views]
+        image_points = [v.image_points for v in views]
+        start = time.perf_counter()
+        if last.camera_matrix is None:
+            rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
+                object_points,
+                image_points,
+                self.image_size,
+                None,  # type: ignore
+                None,  # type: ignore
+                flags=self.flags,
+            )
+        else:
+            assert last.distortion_coefficients is not None
+            rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(
+                object_points,
+                image_points,
+                self.image_size,
+                last.camera_matrix.copy(),
+                last.distortion_coefficients.copy(),
+                flags=self.flags | cv2.CALIB_USE_INTRINSIC_GUESS,
+            )
+        solve_ms = (time.perf_counter() - start) * 1e3
+        errors = Observations.stack(object_points, image_points).errors(
+            rvecs, tvecs, mtx, dist
+        )
+        coverage_map = coverage_of(views, self.image_size)
+        self._status = CalibrationStatus(
+            camera_matrix=mtx,
+            distortion_coefficients=dist,
+            rms=float(rms),
+            views=len(views),
+            bins=bins,
+            worst_view_rms=float(errors.view_rms.max()),
+            coverage=float(np.count_nonzero(coverage_map) / coverage_map.size),
+            coverage_map=coverage_map,
+            solve_ms=solve_ms,
+            generation=last.generation + 1,
+        )
+        logger.info(
+            "Online calibration #{}: rms={:.3f} views={} bins={} coverage={:.0%} ({:.0f} ms)",
+            self._status.generation,
+            rms,
+            len(views),
+            bins,
+            self._status.coverage,
+            solve_ms,
+        )
+        if self.prune and len(views) > MIN_SOLVE_VIEWS:
+            bad = outlier_views(errors.view_rms)
+            if np.any(bad):
+                with self._lock:
+                    self.reservoir.remove([v for v, b in zip(views, bad) if b])
+
+    def draw(self, frame: MatLike, origin: tuple[int, int] = (10, 20)) -> MatLike:
+        """
+        the coverage grid (cells without corners tinted red) and the latest
+        solve as text
+        """
+        s = self._status
+        cols, rows = COVERAGE_GRID
+        h, w = frame.shape[:2]
+        for r, c in zip(*np.nonzero(s.coverage_map == 0)):
+            x0, y0 = int(c * w / cols), int(r * h / rows)
+            x1, y1 = int((c + 1) * w / cols), int((r + 1) * h / rows)
+            cell = frame[y0:y1, x0:x1]
+            cell[..., 2] = cell[..., 2] // 2 + 127
+        lines = [
+            f"views {len(self.reservoir)}/{self.reservoir.capacity} "
+            f"bins {s.bins} coverage {s.coverage:.0%}",
+            f"rms {s.rms:.3f} worst {s.worst_view_rms:.2f} "
+            f"solve #{s.generation} {s.solve_ms:.0f}ms",
+        ]
+        if s.camera_matrix is not None:
+            m = s.camera_matrix
+            lines.append(
+                f"f {m[0, 0]:.1f} {m[1, 1]:.1f} c {m[0, 2]:.1f} {m[1, 2]:.1f}"
+            )
+        x, y = origin
+        for line in lines:
+            cv2.putText(
+                frame, line, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2
+            )
+            y += 22
+        return frame
+
+    def save(self, path: Path) -> bool:
+        """
+        write the latest intrinsics in the format of `cali.py`
+        """
+        s = self._status
+        if s.camera_matrix is None:
+            logger.warning("No online calibration to save yet")
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        parameters = {
+            "camera_matrix": s.camera_matrix,
+            "distortion_coefficients": cast(NDArray, s.distortion_coefficients),
+            "rms": s.rms,
+        }
+        ak.to_parquet([parameters], path)
+        logger.info("Saved online calibration (rms={:.3f}) to {}", s.rms, path)
+        return True
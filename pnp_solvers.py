@@ -0,0 +1,197 @@
+"""
+The `solvePnP` variants we use, and the policy picking one per solve.
+
+Every solve here runs on undistorted normalized coordinates (identity camera
+matrix, no distortion, see `UndistortMaps.undistort_points`).
+
+The policy is a list of rules keyed by coplanarity and point count; the
+defaults below are replaced by the table `bench_pnp.py --save` measures on
+our correspondences (`output/pnp_policy.json`).
+"""
+
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Final, Optional
+
+import cv2
+import numpy as np
+import orjson
+from jaxtyping import Float
+from loguru import logger
+
+NDArray = np.ndarray
+
+IDENTITY_CAMERA_MATRIX: Final[NDArray] = np.eye(3, dtype=np.float64)
+POLICY_PATH: Final[Path] = Path("output") / "pnp_policy.json"
+# smallest / largest eigenvalue of the point covariance below which a point
+# set counts as planar
+PLANAR_TOLERANCE: Final[float] = 1e-6
+# RANSAC inlier threshold in normalized units (~2px at a 1000px focal length)
+RANSAC_THRESHOLD: Final[float] = 2e-3
+FALLBACK_SOLVER: Final[str] = "sqpnp"
+
+
+@dataclass(frozen=True)
+class Solver:
+    name: str
+    flag: int
+    ransac: bool = False
+    planar_only: bool = False
+    exact_points: Optional[int] = None
+
+    def applicable(self, points: int, planar: bool) -> bool:
+        if self.planar_only and not planar:
+            return False
+        if self.exact_points is not None and points != self.exact_points:
+            return False
+        return points >= 4
+
+    def __call__(
+        self, object_points: NDArray, image_points: NDArray
+    ) -> tuple[bool, NDArray, NDArray]:
+        if self.ransac:
+            ok, rvec, tvec, _inliers = cv2.solvePnPRansac(
+                object_points,
+                image_points,
+                IDENTITY_CAMERA_MATRIX,
+                None,
+                reprojectionError=RANSAC_THRESHOLD,
+                flags=self.flag,
+            )
+        else:
+            ok, rvec, tvec = cv2.solvePnP(
+                object_points,
+                image_points,
+                IDENTITY_CAMERA_MATRIX,
+                None,
+                flags=self.flag,
+            )
+        return bool(ok), rvec, tvec
+
+
+# `SOLVEPNP_IPPE_SQUARE` is left out: it needs the 4 corners of one marker in
+# its own centered frame, not model coordinates
+SOLVERS: Final[dict[str, Solver]] = {
+    s.name: s
+    for s in (
+        Solver("sqpnp", cv2.SOLVEPNP_SQPNP),
+        Solver("ippe", cv2.SOLVEPNP_IPPE, planar_only=True),
+        Solver("epnp", cv2.SOLVEPNP_EPNP),
+        Solver("iterative", cv2.SOLVEPNP_ITERATIVE),
+        Solver("ap3p", cv2.SOLVEPNP_AP3P, exact_points=4),
+        Solver("ransac_sqpnp", cv2.SOLVEPNP_SQPNP, ransac=True),
+        Solver("ransac_epnp", cv2.SOLVEPNP_EPNP, ransac=True),
+    )
+}
+
+
+def is_planar(object_points: Float[NDArray, "N 3"]) -> bool:
+    pts = np.asarray(object_points, dtype=np.float64).reshape(-1, 3)
+    centered = pts - pts.mean(axis=0)
+    eig = np.linalg.eigvalsh(centered.T @ centered)
+    return bool(eig[0] <= PLANAR_TOLERANCE * eig[2])
+
+
+@dataclass(frozen=True)
+class PnPRule:
+    planar: bool
+    max_points: int
+    """
+    the rule covers point counts up to this (inclusive)
+    """
+    solver: str
+    refine: bool = False
+    """
+    polish with `solvePnPRefineLM` afterwards
+    """
+
+
+@dataclass
+class PnPResult:
+    ok: bool
+    rvec: NDArray
+    tvec: NDArray
+    solver: str
+    """
+    the solver that produced the pose (`+lm` when refined)
+    """
+    elapsed_ms: float
+
+
+DEFAULT_RULES: Final[tuple[PnPRule, ...]] = (
+    PnPRule(planar=True, max_points=1 << 30, solver="ippe"),
+    PnPRule(planar=False, max_points=1 << 30, solver="sqpnp"),
+)
+
+
+class PnPPolicy:
+    """
+    Picks the first rule matching a correspondence set's coplanarity and
+    point count; falls back to `FALLBACK_SOLVER` when the chosen solver
+    fails or no rule matches.
+    """
+
+    rules: list[PnPRule]
+
+    def __init__(self, rules: Optional[list[PnPRule]] = None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+
+    def choose(self, points: int, planar: bool) -> PnPRule:
+        for rule in self.rules:
+            if rule.planar == planar and points <= rule.max_points:
+                if SOLVERS[rule.solver].applicable(points, planar):
+                    return rule
+        return PnPRule(planar, points, FALLBACK_SOLVER)
+
+    def solve(
+        self,
+        object_points: Float[NDArray, "N 3"],
+        image_points: Float[NDArray, "N 2"],
+    ) -> PnPResult:
+        start = time.perf_counter_ns()
+        object_points = np.asarray(object_points, dtype=np.float64).reshape(-1, 3)
+        image_points = np.asarray(image_points, dtype=np.float64).reshape(-1, 2)
+        rule = self.choose(len(object_points), is_planar(object_points))
+        name = rule.solver
+        ok, rvec, tvec = SOLVERS[name](object_points, image_points)
+        if not ok and name != FALLBACK_SOLVER:
+            name = FALLBACK_SOLVER
+            ok, rvec, tvec = SOLVERS[name](object_points, image_points)
+        if ok and rule.refine:
+            rvec, tvec = cv2.solvePnPRefineLM(
+                object_points, image_points, IDENTITY_CAMERA_MATRIX, None, rvec, tvec
+            )
+            name += "+lm"
+        return PnPResult(
+            ok, rvec, tvec, name, (time.perf_counter_ns() - start) / 1e6
+        )
+
+    def save(self, path: Path = POLICY_PATH, metrics: Optional[Any] = None) -> Path:
+        """
+        Args:
+            metrics: stored next to the rules for reference (the benchmark)
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile: dict[str, Any] = {"rules": [asdict(r) for r in self.rules]}
+        if metrics is not None:
+            profile["metrics"] = metrics
+        path.write_bytes(orjson.dumps(profile, option=orjson.OPT_INDENT_2))
+        return path
+
+
+def load_pnp_policy(path: Path = POLICY_PATH) -> PnPPolicy:
+    """
+    the benchmarked policy (see `bench_pnp.py`), or the defaults when there
+    is none
+    """
+    if not path.exists():
+        logger.info("No PnP policy at {}; using defaults", path)
+        return PnPPolicy()
+    profile = orjson.loads(path.read_bytes())
+    rules = [PnPRule(**r) for r in profile["rules"]]
+    unknown = {r.solver for r in rules} - SOLVERS.keys()
+    if unknown:
+        raise ValueError(f"unknown solvers in {path}: {sorted(unknown)}")
+    logger.info("Loaded PnP policy {}", path)
+    return PnPPolicy(rules)
@@ -0,0 +1,394 @@
+"""
+Poses out to other processes (robot controller, logger, visualizer) as fixed
+size binary datagrams over local UDP or a Unix datagram socket.
+
+One datagram is one `POSE_RECORD`; there is no framing, no handshake and no
+back-pressure: a publisher never blocks the detection loop, a slow
+subscriber just loses records (counted on both ends).
+
+```
+python pose_stream.py subscribe --address udp://127.0.0.1:5700
+python pose_stream.py bench --cameras 6 --rate 60
+```
+"""
+
+import errno
+import multiprocessing as mp
+import socket
+import struct
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final, Iterator, Optional
+
+import click
+import cv2
+import numpy as np
+from loguru import logger
+
+NDArray = np.ndarray
+
+DEFAULT_ADDRESS: Final[str] = "udp://127.0.0.1:5700"
+MAGIC: Final[bytes] = b"POS2"
+# magic, camera id, object id, frame id, capture ns, publish ns, rvec, tvec,
+# quality (reprojection RMS in px), points, flags, sequence; little endian,
+# no padding
+POSE_RECORD: Final[struct.Struct] = struct.Struct("<4sHHQqq3d3dfHHI")
+SEQUENCE_MODULUS: Final[int] = 1 << 32
+# a record this many sequence numbers behind the last one is late (reordered);
+# further back, the publisher restarted
+REORDER_WINDOW: Final[int] = 64
+# `quality` of a pose whose error was not measured
+UNKNOWN_QUALITY: Final[float] = float("nan")
+RECEIVE_BUFFER_BYTES: Final[int] = 1 << 20
+
+
+@dataclass
+class PoseRecord:
+    camera_id: int
+    object_id: int
+    frame_id: int
+    capture_ns: int
+    """
+    `time.monotonic_ns()` when the frame was read; comparable across
+    processes of the same host
+    """
+    publish_ns: int
+    rvec: tuple[float, float, float]
+    tvec: tuple[float, float, float]
+    quality: float
+    points: int
+    flags: int = 0
+    sequence: int = 0
+    """
+    per publisher, +1 per record sent or dropped; frames without a pose (or
+    skipped under back-pressure) publish nothing and leave no gap
+    """
+
+    @staticmethod
+    def unpack(buffer: bytes | bytearray | memoryview) -> "PoseRecord":
+        (
+            magic,
+            camera_id,
+            object_id,
+            frame_id,
+            capture_ns,
+            publish_ns,
+            r0,
+            r1,
+            r2,
+            t0,
+            t1,
+            t2,
+            quality,
+            points,
+            flags,
+            sequence,
+        ) = POSE_RECORD.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError(f"not a pose record: {magic!r}")
+        return PoseRecord(
+            camera_id,
+            object_id,
+            frame_id,
+            capture_ns,
+            publish_ns,
+            (r0, r1, r2),
+            (t0, t1, t2),
+            quality,
+            points,
+            flags,
+            sequence,
+        )
+
+
+def pose_quality(
+    object_points: NDArray,
+    normalized_points: NDArray,
+    rvec: NDArray,
+    tvec: NDArray,
+    focal_length: float,
+) -> float:
+    """
+    reprojection RMS in pixels of a pose solved on normalized coordinates
+    """
+    projected, _ = cv2.projectPoints(
+        object_points, rvec, tvec, np.eye(3), None  # type: ignore
+    )
+    d = np.reshape(projected, (-1, 2)) - np.reshape(normalized_points, (-1, 2))
+    return float(np.sqrt(np.mean(np.sum(d * d, axis=1)))) * focal_length
+
+
+def parse_address(address: str) -> tuple[int, str | tuple[str, int]]:
+    """
+    `udp://host:port` or `unix:///path/to.sock` -> (family, sockaddr)
+    """
+    if address.startswith("udp://"):
+        host, _, port = address[len("udp://") :].rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://") :]
+    raise ValueError(f"unsupported pose stream address: {address}")
+
+
+class PosePublisher:
+    """
+    Packs into one preallocated buffer and sends without blocking; a record
+    the socket cannot take right away is dropped.
+    """
+
+    sent: int
+    dropped: int
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, camera_id: int = 0):
+        self.camera_id = camera_id
+        family, self._target = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._buffer = bytearray(POSE_RECORD.size)
+        self._sequence = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(
+        self,
+        frame_id: int,
+        capture_ns: int,
+        rvec: NDArray,
+        tvec: NDArray,
+        quality: float = UNKNOWN_QUALITY,
+        points: int = 0,
+        object_id: int = 0,
+        flags: int = 0,
+    ) -> bool:
+        r = np.ravel(rvec)
+        t = np.ravel(tvec)
+        POSE_RECORD.pack_into(
+            self._buffer,
+            0,
+            MAGIC,
+            self.camera_id,
+            object_id,
+            frame_id,
+            capture_ns,
+            time.monotonic_ns(),
+            r[0],
+            r[1],
+            r[2],
+            t[0],
+            t[1],
+            t[2],
+            quality,
+            points,
+            flags,
+            self._sequence,
+        )
+        self._sequence = (self._sequence + 1) % SEQUENCE_MODULUS
+        try:
+            self._sock.sendto(self._buffer, self._target)
+        except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+            # no subscriber (unix) or a full socket buffer
+            self.dropped += 1
+            return False
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def close(self):
+        self._sock.close()
+
+
+class PoseSubscriber:
+    """
+    Binds the stream address and yields records as they arrive; also the
+    reference for consumers written in other languages (read 92-byte
+    datagrams, see `POSE_RECORD`).
+    """
+
+    received: int
+    lost: int
+    """
+    gaps in the record sequence of each publisher (sender address and camera
+    id); a publisher restart resets its sequence and is not counted
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        family, self._address = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        if family == socket.AF_UNIX:
+            path = Path(str(self._address))
+            if path.exists():
+                path.unlink()
+        self._sock.bind(self._address)
+        self._buffer = bytearray(POSE_RECORD.size)
+        self._last_sequence: dict[tuple[object, int], int] = {}
+        self.received = 0
+        self.lost = 0
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[PoseRecord]:
+        self._sock.settimeout(timeout)
+        try:
+            n, sender = self._sock.recvfrom_into(self._buffer)
+        except (socket.timeout, BlockingIOError):
+            return None
+        if n != POSE_RECORD.size:
+            logger.warning("Dropping malformed pose datagram of {} bytes", n)
+            return None
+        try:
+            record = PoseRecord.unpack(self._buffer)
+        except ValueError as e:
+            logger.warning("Dropping datagram from {}: {}", sender, e)
+            return None
+        # unbound unix senders have no address; their camera id tells them apart
+        key = (sender or None, record.camera_id)
+        last = self._last_sequence.get(key)
+        if last is None:
+            self._last_sequence[key] = record.sequence
+        else:
+            behind = (last - record.sequence) % SEQUENCE_MODULUS
+            gap = (record.sequence - last - 1) % SEQUENCE_MODULUS
+            if behind <= REORDER_WINDOW:
+                pass  # late or duplicated, already counted as lost
+            elif gap < SEQUENCE_MODULUS // 2:
+                self.lost += gap
+                self._last_sequence[key] = record.sequence
+            else:
+                logger.info(
+                    "Camera {} publisher restarted (sequence {} -> {})",
+                    record.camera_id,
+                    last,
+                    record.sequence,
+                )
+                self._last_sequence[key] = record.sequence
+        self.received += 1
+        return record
+
+    def __iter__(self) -> Iterator[PoseRecord]:
+        while True:
+            record = self.receive()
+            if record is not None:
+                yield record
+
+    def close(self):
+        self._sock.close()
+        if self._sock.family == socket.AF_UNIX:
+            Path(str(self._address)).unlink(missing_ok=True)
+
+
+def _bench_publisher(address: str, camera_id: int, rate: float, duration: float):
+    publisher = PosePublisher(address, camera_id)
+    period_ns = int(1e9 / rate)
+    rng = np.random.default_rng(camera_id)
+    rvec = rng.normal(size=3)
+    tvec = rng.normal(size=3)
+    start = time.monotonic_ns()
+    frame_id = 0
+    while (now := time.monotonic_ns()) - start < duration * 1e9:
+        publisher.publish(frame_id, now, rvec, tvec, 0.5, 24)
+        frame_id += 1
+        next_ns = start + frame_id * period_ns
+        delay = next_ns - time.monotonic_ns()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+    publisher.close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help="print received poses and per-camera rates")
+@click.option("--address", type=str, default=DEFAULT_ADDRESS, show_default=True)
+@click.option("--quiet", is_flag=True, help="only log the rates")
+def subscribe(address: str, quiet: bool):
+    subscriber = PoseSubscriber(address)
+    counts: dict[int, int] = {}
+    last_log = time.monotonic()
+    logger.info("Listening on {}", address)
+    try:
+        for r in subscriber:
+            counts[r.camera_id] = counts.get(r.camera_id, 0) + 1
+            if not quiet:
+                latency_ms = (time.monotonic_ns() - r.capture_ns) / 1e6
+                logger.info(
+                    "cam {} obj {} frame {} rvec=({:.3f}, {:.3f}, {:.3f}) "
+                    "tvec=({:.3f}, {:.3f}, {:.3f}) q={:.2f}px {:.2f}ms",
+                    r.camera_id,
+                    r.object_id,
+                    r.frame_id,
+                    *r.rvec,
+                    *r.tvec,
+                    r.quality,
+                    latency_ms,
+                )
+            now = time.monotonic()
+            if now - last_log >= 5.0:
+                rates = ", ".join(
+                    f"cam {c}: {n / (now - last_log):.1f} Hz"
+                    for c, n in sorted(counts.items())
+                )
+                logger.info("{} ({} lost)", rates, subscriber.lost)
+                counts.clear()
+                last_log = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+
+@cli.command(help="publish-to-receive latency with several simulated cameras")
+@click.option("--address", type=str, default=DEFAULT_ADDRESS, show_default=True)
+@click.option("--cameras", type=int, default=6, show_default=True)
+@click.option("--rate", type=float, default=60.0, show_default=True, help="Hz per camera")
+@click.option("--duration", type=float, default=5.0, show_default=True, help="seconds")
+def bench(address: str, cameras: int, rate: float, duration: float):
+    subscriber = PoseSubscriber(address)
+    ctx = mp.get_context()
+    publishers = [
+        ctx.Process(target=_bench_publisher, args=(address, i, rate, duration))
+        for i in range(cameras)
+    ]
+    for p in publishers:
+        p.start()
+    latencies: list[int] = []
+    deadline = time.monotonic() + duration + 1.0
+    while time.monotonic() < deadline:
+        r = subscriber.receive(timeout=0.2)
+        if r is not None:
+            latencies.append(time.monotonic_ns() - r.publish_ns)
+    for p in publishers:
+        p.join()
+    subscriber.close()
+    expected = int(cameras * rate * duration)
+    if not latencies:
+        logger.error("No pose received")
+        return
+    us = np.array(latencies) / 1e3
+    p50, p95, p99 = np.percentile(us, (50, 95, 99))
+    logger.info(
+        "{} cameras x {:.0f} Hz on {} ({} bytes/record): {}/{} received, {} lost",
+        cameras,
+        rate,
+        address,
+        POSE_RECORD.size,
+        len(latencies),
+        expected,
+        subscriber.lost,
+    )
+    logger.info(
+        "publish -> receive us: p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}",
+        p50,
+        p95,
+        p99,
+        us.max(),
+    )
+
+
+if __name__ == "__main__":
+    cli()
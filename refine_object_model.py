@@ -0,0 +1,464 @@
+"""
+Re-survey an object model (e.g. `output/standard_box_markers.parquet`) from
+recorded frames of the physical object.
+
+Every face is kept rigid (the print is trusted) but its placement on the
+object is re-estimated: per-frame poses and per-face rigid corrections are
+refined jointly on undistorted normalized corners. The best observed face is
+held fixed as the reference.
+
+```
+python refine_object_model.py --video box_cam0.mp4 --calibration output/cam0.parquet \
+    --video box_cam1.mp4 --calibration output/cam1.parquet \
+    --output output/standard_box_markers.refined.parquet
+```
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final, Iterator, Optional
+
+import click
+import cv2
+import numpy as np
+from cv2 import aruco
+from jaxtyping import Float, Int
+from loguru import logger
+
+from aruco_box import ObjectModel, build_diamond_box_model
+from calib_diagnostics import project_points_batch, rodrigues_batch
+from detector_params import load_detector_parameters
+from object_registry import model_dictionary
+from undistort import POINT_CRITERIA, read_camera_calibration
+
+NDArray = np.ndarray
+
+IDENTITY_CAMERA_MATRIX: Final[NDArray] = np.eye(3, dtype=np.float64)
+NO_DISTORTION: Final[NDArray] = np.zeros(5)
+# frames whose initial RMS is this many times the median are dropped
+OUTLIER_FRAME_FACTOR: Final[float] = 5.0
+FINITE_DIFFERENCE_STEP: Final[float] = 1e-6
+OBJECTS_TOML: Final[Path] = Path("objects.toml")
+
+
+@dataclass
+class MarkerObservations:
+    """
+    every matched marker of every frame, sorted by frame
+    """
+
+    frame: Int[NDArray, "M"]
+    row: Int[NDArray, "M"]
+    """
+    model row of the marker
+    """
+    image: Float[NDArray, "M 4 2"]
+    """
+    undistorted normalized corners
+    """
+    focal: Float[NDArray, "M"]
+    """
+    focal length of the observing camera, to report residuals in pixels
+    """
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def select(self, mask: NDArray) -> "MarkerObservations":
+        return MarkerObservations(
+            self.frame[mask], self.row[mask], self.image[mask], self.focal[mask]
+        )
+
+
+def project(
+    corners: Float[NDArray, "R 4 3"],
+    obs: MarkerObservations,
+    rvecs: Float[NDArray, "F 3"],
+    tvecs: Float[NDArray, "F 3"],
+) -> Float[NDArray, "M 4 2"]:
+    points = corners[obs.row].reshape(-1, 3).astype(np.float64)
+    view_index = np.repeat(obs.frame, 4)
+    projected = project_points_batch(
+        points, view_index, rvecs, tvecs, IDENTITY_CAMERA_MATRIX, NO_DISTORTION
+    )
+    return projected.reshape(-1, 4, 2)
+
+
+def rms_px(
+    corners: NDArray, obs: MarkerObservations, rvecs: NDArray, tvecs: NDArray
+) -> float:
+    d = (project(corners, obs, rvecs, tvecs) - obs.image) * obs.focal[:, None, None]
+    return float(np.sqrt(np.mean(np.sum(d * d, axis=-1))))
+
+
+def move_faces(
+    corners: Float[NDArray, "R 4 3"],
+    faces: Int[NDArray, "R"],
+    params: Float[NDArray, "F 6"],
+    centers: Float[NDArray, "F 3"],
+) -> Float[NDArray, "R 4 3"]:
+    """
+    rotate every face by `params[:, :3]` about its center, then translate it
+    by `params[:, 3:]`
+    """
+    R = rodrigues_batch(params[:, :3])[faces]
+    c = centers[faces][:, np.newaxis]
+    return (
+        np.einsum("rij,rkj->rki", R, corners - c) + c + params[faces, np.newaxis, 3:]
+    )
+
+
+def initial_frame_poses(
+    corners: NDArray, obs: MarkerObservations, frames: int
+) -> tuple[NDArray, NDArray]:
+    starts = np.searchsorted(obs.frame, np.arange(frames))
+    ends = np.searchsorted(obs.frame, np.arange(frames), side="right")
+    # frames `solvePnP` cannot pose stay NaN
+    rvecs = np.full((frames, 3), np.nan)
+    tvecs = np.full((frames, 3), np.nan)
+    for k, (s, e) in enumerate(zip(starts, ends)):
+        ok, rvec, tvec = cv2.solvePnP(
+            corners[obs.row[s:e]].reshape(-1, 3).astype(np.float64),
+            obs.image[s:e].reshape(-1, 2),
+            IDENTITY_CAMERA_MATRIX,
+            None,
+            flags=cv2.SOLVEPNP_SQPNP,
+        )
+        if ok:
+            rvecs[k] = rvec.ravel()
+            tvecs[k] = tvec.ravel()
+    return rvecs, tvecs
+
+
+@dataclass
+class RefinementResult:
+    model: ObjectModel
+    rms_before: float
+    rms_after: float
+    face_rms_before: dict[str, float]
+    face_rms_after: dict[str, float]
+    face_params: Float[NDArray, "F 6"]
+    """
+    rotation vector and translation (m) applied to each face
+    """
+    frames: int
+    reference: str
+
+
+def refine_model(
+    model: ObjectModel,
+    obs: MarkerObservations,
+    frames: int,
+    iterations: int = 50,
+    tolerance: float = 1e-6,
+) -> RefinementResult:
+    """
+    Levenberg-Marquardt over every frame pose and every face placement at
+    once.
+
+    A point depends on exactly one frame and one face, so perturbing one
+    parameter of all frames (or all faces) together yields a whole column
+    block of the Jacobian: 12 batched projections per iteration. The frame
+    blocks of the normal equations are eliminated with the Schur complement,
+    leaving a (6 F, 6 F) system whatever the number of frames.
+    """
+    corners = model.corners.astype(np.float64)
+    rvecs, tvecs = initial_frame_poses(corners, obs, frames)
+
+    # drop frames the initial model cannot explain at all (misdetections)
+    d = (project(corners, obs, rvecs, tvecs) - obs.image) * obs.focal[:, None, None]
+    per_frame = np.sqrt(
+        np.bincount(obs.frame, np.sum(d * d, axis=(1, 2)), minlength=frames)
+        / (np.bincount(obs.frame, minlength=frames) * 4)
+    )
+    # unposed frames are NaN; left in, they would make the median NaN and
+    # every frame fail the test
+    finite = np.isfinite(per_frame)
+    if not np.any(finite):
+        raise ValueError("no frame could be posed with the initial model")
+    keep = finite & (per_frame <= OUTLIER_FRAME_FACTOR * np.median(per_frame[finite]))
+    if not np.all(keep):
+        logger.info("Dropping {} outlier frame(s)", int(np.count_nonzero(~keep)))
+        obs = obs.select(keep[obs.frame])
+        # renumber the frames left so that every frame index has points
+        obs.frame = (np.cumsum(keep) - 1)[obs.frame]
+        rvecs, tvecs = rvecs[keep], tvecs[keep]
+        frames = int(np.count_nonzero(keep))
+
+    faces = model.faces[obs.row]
+    n_faces = len(model.names)
+
+    def face_rms(c: NDArray, rv: NDArray, tv: NDArray) -> dict[str, float]:
+        return {
+            name: rms_px(c, obs.select(faces == f), rv, tv)
+            for f, name in enumerate(model.names)
+            if np.any(faces == f)
+        }
+
+    rms_before = rms_px(corners, obs, rvecs, tvecs)
+    face_rms_before = face_rms(corners, rvecs, tvecs)
+
+    reference = int(np.argmax(np.bincount(faces, minlength=n_faces)))
+    centers = np.stack(
+        [corners[model.faces == f].reshape(-1, 3).mean(axis=0) for f in range(n_faces)]
+    )
+    params = np.zeros((n_faces, 6))
+    point_face = np.repeat(faces, 4)
+    # `reduceat` offsets of every frame's points (obs is sorted by frame)
+    frame_starts = np.searchsorted(np.repeat(obs.frame, 4), np.arange(frames))
+    free = np.ones(n_faces * 6, dtype=bool)
+    free[reference * 6 : reference * 6 + 6] = False
+    free &= np.repeat(np.bincount(faces, minlength=n_faces) > 0, 6)
+
+    def residual(p: NDArray, rv: NDArray, tv: NDArray) -> NDArray:
+        moved = move_faces(corners, model.faces, p, centers)
+        return (project(moved, obs, rv, tv) - obs.image).reshape(-1, 2)
+
+    r = residual(params, rvecs, tvecs)
+    cost = float(np.sum(r * r))
+    lam = 1e-3
+    for it in range(iterations):
+        h = FINITE_DIFFERENCE_STEP
+        J_frame = np.empty((len(r), 2, 6))
+        J_face = np.empty((len(r), 2, 6))
+        for j in range(6):
+            step = np.zeros(6)
+            step[j] = h
+            J_frame[:, :, j] = (
+                residual(params, rvecs + step[:3], tvecs + step[3:]) - r
+            ) / h
+            J_face[:, :, j] = (residual(params + step, rvecs, tvecs) - r) / h
+        # spread each point's face block into its columns of the face system
+        J_faces = np.zeros((len(r), 2, n_faces, 6))
+        J_faces[np.arange(len(r)), :, point_face] = J_face
+        J_faces = J_faces.reshape(len(r), 2, -1)[:, :, free]
+
+        U = np.add.reduceat(np.einsum("pai,paj->pij", J_frame, J_frame), frame_starts)
+        W = np.add.reduceat(np.einsum("pai,paj->pij", J_frame, J_faces), frame_starts)
+        g_frame = np.add.reduceat(np.einsum("pai,pa->pi", J_frame, r), frame_starts)
+        V = np.einsum("pai,paj->ij", J_faces, J_faces)
+        g_face = np.einsum("pai,pa->i", J_faces, r)
+
+        improved = False
+        for _ in range(10):
+            U_damped = U + lam * (U * np.eye(6))
+            V_damped = V + lam * np.diag(np.diag(V))
+            U_inv = np.linalg.inv(U_damped)
+            WtU = np.einsum("kia,kij->kaj", W, U_inv)
+            S = V_damped - np.einsum("kaj,kjb->ab", WtU, W)
+            b = -g_face + np.einsum("kaj,kj->a", WtU, g_frame)
+            d_face = np.linalg.solve(S, b)
+            d_frame = -np.einsum(
+                "kij,kj->ki", U_inv, g_frame + np.einsum("kja,a->kj", W, d_face)
+            )
+            candidate = params.copy()
+            candidate.reshape(-1)[free] += d_face
+            rv = rvecs + d_frame[:, :3]
+            tv = tvecs + d_frame[:, 3:]
+            r_new = residual(candidate, rv, tv)
+            cost_new = float(np.sum(r_new * r_new))
+            if cost_new < cost:
+                improved = cost - cost_new > tolerance * cost
+                params, rvecs, tvecs, r, cost = candidate, rv, tv, r_new, cost_new
+                lam = max(lam / 10, 1e-9)
+                break
+            lam *= 10
+        logger.debug("Iteration {}: cost {:.6e}, lambda {:.0e}", it, cost, lam)
+        if not improved:
+            break
+
+    refined = move_faces(corners, model.faces, params, centers)
+    return RefinementResult(
+        model=ObjectModel(
+            names=list(model.names),
+            faces=model.faces.copy(),
+            ids=model.ids.copy(),
+            corners=refined.astype(np.float32),
+        ),
+        rms_before=rms_before,
+        rms_after=rms_px(refined, obs, rvecs, tvecs),
+        face_rms_before=face_rms_before,
+        face_rms_after=face_rms(refined, rvecs, tvecs),
+        face_params=params,
+        frames=frames,
+        reference=model.names[reference],
+    )
+
+
+def read_frames(video: Path, stride: int) -> Iterator[NDArray]:
+    cap = cv2.VideoCapture(str(video))
+    index = 0
+    try:
+        while True:
+            if index % stride != 0:
+                if not cap.grab():
+                    break
+            else:
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                yield frame
+            index += 1
+    finally:
+        cap.release()
+
+
+def collect_observations(
+    model: ObjectModel,
+    sources: list[tuple[Path, Path]],
+    detector: aruco.ArucoDetector,
+    stride: int,
+    min_faces: int,
+    max_frames: Optional[int],
+) -> tuple[MarkerObservations, int]:
+    """
+    frames seeing at least `min_faces` faces; a frame of a single face
+    constrains nothing about the placement of the faces relative to each
+    other
+    """
+    frame_ids: list[NDArray] = []
+    rows: list[NDArray] = []
+    images: list[NDArray] = []
+    focals: list[NDArray] = []
+    frames = 0
+    for video, calibration in sources:
+        camera_matrix, dist = read_camera_calibration(calibration)
+        camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        for frame in read_frames(video, stride):
+            if max_frames is not None and frames >= max_frames:
+                break
+            grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            # pylint: disable-next=unpacking-non-sequence
+            corners, ids, _rejected = detector.detectMarkers(grey)
+            if ids is None:
+                continue
+            _, image_points, hit = model.match(ids, corners)
+            if len(np.unique(model.faces[hit])) < min_faces:
+                continue
+            normalized = cv2.undistortPointsIter(
+                image_points.reshape(-1, 1, 2),
+                camera_matrix,
+                dist,
+                None,
+                None,
+                POINT_CRITERIA,
+            )
+            frame_ids.append(np.full(len(hit), frames))
+            rows.append(hit.copy())
+            images.append(normalized.reshape(-1, 4, 2).astype(np.float64))
+            focals.append(np.full(len(hit), camera_matrix[0, 0]))
+            frames += 1
+        logger.info("{}: {} usable frames so far", video, frames)
+    if frames == 0:
+        raise click.ClickException("no frame sees enough faces of the model")
+    return (
+        MarkerObservations(
+            np.concatenate(frame_ids),
+            np.concatenate(rows),
+            np.concatenate(images),
+            np.concatenate(focals),
+        ),
+        frames,
+    )
+
+
+@click.command(help="re-estimate the face placement of an object model")
+@click.option(
+    "--model",
+    "model_ref",
+    type=str,
+    default=str(Path("output") / "standard_box_markers.parquet"),
+    show_default=True,
+    help='object model parquet, or "diamond"',
+)
+@click.option(
+    "--video",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    multiple=True,
+    required=True,
+)
+@click.option(
+    "--calibration",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    multiple=True,
+    required=True,
+    help="one per --video, or a single one for all",
+)
+@click.option(
+    "--dictionary",
+    type=str,
+    help=f"defaults to the dictionary of the model's object in {OBJECTS_TOML}",
+)
+@click.option("--camera", type=str, help="detector profile name")
+@click.option("--stride", type=int, default=1, show_default=True)
+@click.option("--max-frames", type=int)
+@click.option("--min-faces", type=int, default=2, show_default=True)
+@click.option("--iterations", type=int, default=50, show_default=True)
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    required=True,
+)
+def main(
+    model_ref: str,
+    video: tuple[Path, ...],
+    calibration: tuple[Path, ...],
+    dictionary: Optional[str],
+    camera: Optional[str],
+    stride: int,
+    max_frames: Optional[int],
+    min_faces: int,
+    iterations: int,
+    output: Path,
+):
+    if len(calibration) not in (1, len(video)):
+        raise click.UsageError("pass one --calibration, or one per --video")
+    model = (
+        build_diamond_box_model()
+        if model_ref == "diamond"
+        else ObjectModel.from_parquet(Path(model_ref))
+    )
+    if dictionary is None:
+        dictionary = model_dictionary(OBJECTS_TOML, model_ref)
+        if dictionary is None:
+            raise click.UsageError(
+                f"{model_ref} is not an object of {OBJECTS_TOML}; pass --dictionary"
+            )
+        logger.info("Detecting {} markers", dictionary)
+    detector = aruco.ArucoDetector(
+        aruco.getPredefinedDictionary(getattr(aruco, dictionary)),
+        detectorParams=load_detector_parameters(camera),
+    )
+    calibrations = calibration if len(calibration) > 1 else calibration * len(video)
+    obs, frames = collect_observations(
+        model, list(zip(video, calibrations)), detector, stride, min_faces, max_frames
+    )
+    logger.info("{} marker observations in {} frames", len(obs), frames)
+    result = refine_model(model, obs, frames, iterations)
+    logger.info(
+        "RMS {:.3f} px -> {:.3f} px over {} frames (reference face {})",
+        result.rms_before,
+        result.rms_after,
+        result.frames,
+        result.reference,
+    )
+    for f, name in enumerate(model.names):
+        if name not in result.face_rms_before:
+            logger.info("  face {}: not observed", name)
+            continue
+        rvec, tvec = result.face_params[f, :3], result.face_params[f, 3:]
+        logger.info(
+            "  face {}: {:.3f} -> {:.3f} px, moved {:.2f} mm / {:.3f} deg",
+            name,
+            result.face_rms_before[name],
+            result.face_rms_after[name],
+            np.linalg.norm(tvec) * 1e3,
+            np.degrees(np.linalg.norm(rvec)),
+        )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    result.model.to_parquet(output)
+    logger.info("Saved refined model to {}", output)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
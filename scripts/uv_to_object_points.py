@@ -8,11 +8,13 @@
 #   "awkward",
 #   "orjson",
 #   "click",
+#   "loguru",
 # ]
 # ///
 
 from __future__ import annotations
 
+import sys
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, cast
@@ -26,6 +28,10 @@ import trimesh
 from cv2 import aruco
 from numpy.typing import NDArray
 
+# run as `scripts/uv_to_object_points.py`, the repo root is not on the path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from detector_params import load_detector_parameters  # noqa: E402
+
 
 @dataclass
 class Marker:
@@ -49,6 +55,7 @@ def flip_y(point: NDArray[Any], y_max: float = 1.0) -> NDArray[np.float64]:
 def detect_markers_as_uv(
     input_image: Path,
     dictionary: int,
+    detector_params: aruco.DetectorParameters | None = None,
 ) -> list[Marker]:
     frame = cv2.imread(str(input_image))
     if frame is None:
@@ -56,7 +63,9 @@ def detect_markers_as_uv(
 
     detector = aruco.ArucoDetector(
         dictionary=aruco.getPredefinedDictionary(dictionary),
-        detectorParams=aruco.DetectorParameters(),
+        detectorParams=(
+            aruco.DetectorParameters() if detector_params is None else detector_params
+        ),
     )
     grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
     markers, ids, _ = detector.detectMarkers(grey)
@@ -154,6 +163,17 @@ def scale_mesh_for_box_size_mm(
     return scaled
 
 
+def load_mesh(path: Path) -> trimesh.Trimesh:
+    loaded = trimesh.load_mesh(path)
+    if isinstance(loaded, trimesh.Scene):
+        if not loaded.geometry:
+            raise ValueError("Scene has no geometry")
+        loaded = list(loaded.geometry.values())[0]
+    if not isinstance(loaded, trimesh.Trimesh):
+        raise TypeError("Expected Trimesh or Scene with Trimesh geometry")
+    return loaded
+
+
 def marker_to_3d_coords(marker: Marker, mesh: trimesh.Trimesh) -> NDArray[np.float64]:
     return interpolate_uvs_to_3d_trimesh(marker.corners, mesh)
 
@@ -182,6 +202,12 @@ def parse_dictionary(value: str) -> int:
 @click.option(
     "--dictionary", type=str, default="DICT_APRILTAG_36H11", show_default=True
 )
+@click.option(
+    "--detector-profile",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="DetectorParameters profile JSON (output/detector_params/<camera>.json)",
+)
 @click.option("--box-size-mm", type=float, default=600.0, show_default=True)
 @click.option("--unit-box-side", type=float, default=2.0, show_default=True)
 @click.option(
@@ -200,30 +226,23 @@ def main(
     input_image: Path,
     mesh: Path,
     dictionary: str,
+    detector_profile: Path | None,
     box_size_mm: float,
     unit_box_side: float,
     output_json: Path,
     output_parquet: Path,
 ) -> None:
     dictionary_value = parse_dictionary(dictionary)
-    output_markers = detect_markers_as_uv(input_image, dictionary_value)
+    output_markers = detect_markers_as_uv(
+        input_image, dictionary_value, load_detector_parameters(None, detector_profile)
+    )
 
     output_json.parent.mkdir(parents=True, exist_ok=True)
     output_json.write_bytes(
         orjson.dumps(output_markers, option=orjson.OPT_SERIALIZE_NUMPY)
     )
 
-    loaded = trimesh.load_mesh(mesh)
-    if isinstance(loaded, trimesh.Scene):
-        if not loaded.geometry:
-            raise ValueError("Scene has no geometry")
-        mesh = list(loaded.geometry.values())[0]
-    else:
-        mesh = loaded
-    if not isinstance(mesh, trimesh.Trimesh):
-        raise TypeError("Expected Trimesh or Scene with Trimesh geometry")
-
-    mesh = scale_mesh_for_box_size_mm(mesh, box_size_mm, unit_box_side)
+    mesh = scale_mesh_for_box_size_mm(load_mesh(mesh), box_size_mm, unit_box_side)
     id_to_3d_coords = {
         marker.id: marker_to_3d_coords(marker, mesh) for marker in output_markers
     }
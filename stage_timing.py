@@ -0,0 +1,220 @@
+import csv
+import time
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Final, Optional
+
+import cv2
+import numpy as np
+import orjson
+from cv2.typing import MatLike
+from loguru import logger
+
+NDArray = np.ndarray
+
+DEFAULT_CAMERA: Final[str] = "default"
+PERCENTILES: Final[tuple[float, ...]] = (50, 95, 99)
+# shared by every disabled span, so a disabled timer allocates nothing
+_NULL_SPAN: Final[AbstractContextManager[None]] = nullcontext()
+
+
+class LatencyWindow:
+    """
+    the last `size` samples of one stage, in milliseconds
+    """
+
+    samples: NDArray
+    count: int
+    """
+    total samples ever recorded (may exceed `size`)
+    """
+
+    def __init__(self, size: int):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.count = 0
+
+    def add(self, ms: float):
+        self.samples[self.count % len(self.samples)] = ms
+        self.count += 1
+
+    @property
+    def values(self) -> NDArray:
+        return self.samples[: min(self.count, len(self.samples))]
+
+
+class _Span:
+    """
+    reusable timing context of one (camera, stage); not reentrant
+    """
+
+    __slots__ = ("_window", "_start")
+
+    def __init__(self, window: LatencyWindow):
+        self._window = window
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+
+    def __exit__(self, *exc: Any):
+        self._window.add((time.perf_counter_ns() - self._start) / 1e6)
+
+
+@dataclass
+class StageStats:
+    camera: str
+    stage: str
+    count: int
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+class StageTimer:
+    """
+    Named spans with rolling p50/p95/p99 per stage and per camera.
+
+    ```
+    timer = StageTimer()
+    with timer.span("detectMarkers"):
+        markers, ids, _ = detector.detectMarkers(grey)
+    timer.maybe_log()
+    ```
+
+    When disabled, `span` hands back one shared no-op context manager.
+    """
+
+    enabled: bool
+    camera: str
+    """
+    camera of spans that do not name one
+    """
+    window: int
+    log_interval_s: float
+    _windows: dict[tuple[str, str], LatencyWindow]
+    _spans: dict[tuple[str, str], _Span]
+    _last_log: float
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        camera: str = DEFAULT_CAMERA,
+        window: int = 512,
+        log_interval_s: float = 5.0,
+    ):
+        """
+        Args:
+            window: samples kept per stage for the percentiles
+            log_interval_s: period of `maybe_log`
+        """
+        self.enabled = enabled
+        self.camera = camera
+        self.window = window
+        self.log_interval_s = log_interval_s
+        self._windows = {}
+        self._spans = {}
+        self._last_log = time.monotonic()
+
+    def _window_of(self, key: tuple[str, str]) -> LatencyWindow:
+        w = self._windows.get(key)
+        if w is None:
+            w = self._windows[key] = LatencyWindow(self.window)
+        return w
+
+    def span(
+        self, stage: str, camera: Optional[str] = None
+    ) -> AbstractContextManager[None]:
+        if not self.enabled:
+            return _NULL_SPAN
+        key = (self.camera if camera is None else camera, stage)
+        s = self._spans.get(key)
+        if s is None:
+            s = self._spans[key] = _Span(self._window_of(key))
+        return s
+
+    def record(self, stage: str, ms: float, camera: Optional[str] = None):
+        """
+        add a sample measured elsewhere (e.g. in a worker process)
+        """
+        if self.enabled:
+            self._window_of((self.camera if camera is None else camera, stage)).add(ms)
+
+    def stats(self, camera: Optional[str] = None) -> list[StageStats]:
+        """
+        stages in first-seen order, optionally of one camera only
+        """
+        out: list[StageStats] = []
+        for (cam, stage), w in self._windows.items():
+            if camera is not None and cam != camera:
+                continue
+            values = w.values
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, PERCENTILES)
+            out.append(
+                StageStats(
+                    camera=cam,
+                    stage=stage,
+                    count=w.count,
+                    mean_ms=float(np.mean(values)),
+                    p50_ms=float(p50),
+                    p95_ms=float(p95),
+                    p99_ms=float(p99),
+                    max_ms=float(np.max(values)),
+                )
+            )
+        return out
+
+    def log(self):
+        for camera in dict.fromkeys(cam for cam, _ in self._windows):
+            parts = [
+                f"{s.stage} {s.p50_ms:.2f}/{s.p95_ms:.2f}/{s.p99_ms:.2f}"
+                for s in self.stats(camera)
+            ]
+            logger.info("[{}] p50/p95/p99 ms: {}", camera, ", ".join(parts))
+
+    def maybe_log(self):
+        """
+        `log` at most once per `log_interval_s`
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval_s:
+            self._last_log = now
+            self.log()
+
+    def dump(self, path: Path):
+        """
+        write the current stats as `.json` or `.csv` (by suffix)
+        """
+        rows = [asdict(s) for s in self.stats()]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".csv":
+            with path.open("w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(StageStats.__annotations__))
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            path.write_bytes(orjson.dumps(rows, option=orjson.OPT_INDENT_2))
+        logger.info("Saved stage timings to {}", path)
+
+    def draw(
+        self,
+        frame: MatLike,
+        camera: Optional[str] = None,
+        origin: tuple[int, int] = (10, 20),
+        color: tuple[int, int, int] = (255, 255, 255),
+    ) -> MatLike:
+        """
+        p50/p95/p99 of each stage as text in the top-left corner
+        """
+        x, y = origin
+        for s in self.stats(self.camera if camera is None else camera):
+            text = f"{s.stage}: {s.p50_ms:.1f}/{s.p95_ms:.1f}/{s.p99_ms:.1f}ms"
+            cv2.putText(frame, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+            y += 18
+        return frame
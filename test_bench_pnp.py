@@ -0,0 +1,63 @@
+import numpy as np
+
+from aruco_box import build_diamond_box_model
+from bench_pnp import (
+    ADEQUATE_SLACK_DEG,
+    SYNTHETIC_FOCAL,
+    SolverStats,
+    pick,
+    run_solver,
+    synthetic_scenes,
+)
+from pnp_solvers import SOLVERS
+
+
+def stats(solver: str, failure_rate: float, p95_error: float, median_us: float):
+    return SolverStats(
+        solver=solver,
+        planar=True,
+        points=4,
+        scenes=40,
+        median_us=median_us,
+        p95_us=median_us,
+        failure_rate=failure_rate,
+        p50_error=p95_error,
+        p95_error=p95_error,
+    )
+
+
+def test_pick_when_best_error_and_best_failure_disagree():
+    # the lowest error and the lowest failure rate come from different
+    # solvers and no solver is within reach of both
+    candidates = [
+        stats("reliable", 0.0, 1.0, 50.0),
+        stats("accurate", 0.5, 0.1, 10.0),
+    ]
+    assert pick(candidates, ADEQUATE_SLACK_DEG).solver == "reliable"
+
+
+def test_pick_falls_back_to_lowest_error():
+    candidates = [
+        stats("unmeasured", 0.0, float("nan"), 5.0),
+        stats("measured", 0.1, 0.2, 50.0),
+    ]
+    assert pick(candidates, ADEQUATE_SLACK_DEG).solver == "measured"
+
+
+def test_pick_returns_a_solver_for_every_scene():
+    model = build_diamond_box_model()
+    rng = np.random.default_rng(0)
+    for planar in (True, False):
+        for markers in range(1 if planar else 2, 4):
+            scenes = list(synthetic_scenes(model, markers, planar, 10, 0.5, rng))
+            if not scenes:
+                continue
+            candidates = [
+                s
+                for name in SOLVERS
+                for refine in (False, True)
+                if (s := run_solver(name, refine, scenes, SYNTHETIC_FOCAL))
+                is not None
+            ]
+            chosen = pick(candidates, ADEQUATE_SLACK_DEG)
+            assert chosen in candidates
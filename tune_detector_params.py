@@ -0,0 +1,462 @@
+import time
+from dataclasses import dataclass
+from itertools import product
+from pathlib import Path
+from typing import Any, Final, Iterable, Optional
+
+import awkward as ak
+import click
+import cv2
+import numpy as np
+from cv2 import aruco
+from jaxtyping import Float, Int
+from loguru import logger
+
+from detector_params import (
+    parameters_from_dict,
+    parameters_to_dict,
+    save_detector_profile,
+)
+
+NDArray = np.ndarray
+
+# thorough (slow) settings whose detections stand in for ground truth on
+# recorded footage
+REFERENCE_PARAMETERS: Final[dict[str, Any]] = {
+    "adaptiveThreshWinSizeMin": 3,
+    "adaptiveThreshWinSizeMax": 53,
+    "adaptiveThreshWinSizeStep": 4,
+    "minMarkerPerimeterRate": 0.01,
+    "cornerRefinementMethod": aruco.CORNER_REFINE_SUBPIX,
+    "cornerRefinementWinSize": 5,
+}
+
+# (min, max, step) of the adaptive threshold window sweep
+THRESHOLD_WINDOWS: Final[tuple[tuple[int, int, int], ...]] = (
+    (3, 23, 10),
+    (3, 13, 10),
+    (5, 21, 8),
+    (3, 33, 15),
+    (7, 7, 10),
+)
+CORNER_REFINEMENTS: Final[tuple[int, ...]] = (
+    aruco.CORNER_REFINE_NONE,
+    aruco.CORNER_REFINE_SUBPIX,
+    aruco.CORNER_REFINE_CONTOUR,
+)
+MIN_PERIMETER_RATES: Final[tuple[float, ...]] = (0.03, 0.015)
+USE_ARUCO3: Final[tuple[bool, ...]] = (False, True)
+
+
+@dataclass
+class Frame:
+    grey: NDArray
+    ids: Optional[Int[NDArray, "N"]] = None
+    """
+    ground truth ids; `None` for recorded frames
+    """
+    corners: Optional[Float[NDArray, "N 4 2"]] = None
+
+
+@dataclass
+class Trial:
+    parameters: dict[str, Any]
+    ms_per_frame: float
+    recall: float
+    """
+    matched markers over expected (ground truth or reference) markers
+    """
+    corner_error_px: float
+    """
+    RMS distance of matched corners from the expected corners
+    """
+    false_positives: int
+    pareto: bool = False
+
+
+Detection = tuple[Int[NDArray, "N"], Float[NDArray, "N 4 2"]]
+
+
+def candidate_parameters() -> list[dict[str, Any]]:
+    candidates: list[dict[str, Any]] = []
+    for (w_min, w_max, w_step), refine, rate, aruco3 in product(
+        THRESHOLD_WINDOWS, CORNER_REFINEMENTS, MIN_PERIMETER_RATES, USE_ARUCO3
+    ):
+        values: dict[str, Any] = {
+            "adaptiveThreshWinSizeMin": w_min,
+            "adaptiveThreshWinSizeMax": w_max,
+            "adaptiveThreshWinSizeStep": w_step,
+            "cornerRefinementMethod": refine,
+            "minMarkerPerimeterRate": rate,
+            "useAruco3Detection": aruco3,
+        }
+        candidates.append(parameters_to_dict(parameters_from_dict(values)))
+    return candidates
+
+
+def sample_video_frames(path: Path, count: int) -> list[Frame]:
+    """
+    `count` grey frames evenly spread over the video
+    """
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Failed to open video: {path}")
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    stride = max(1, total // count) if total > 0 else 1
+    frames: list[Frame] = []
+    index = 0
+    while len(frames) < count:
+        # `grab` skips the decode-to-BGR of frames we do not keep
+        if not cap.grab():
+            break
+        if index % stride == 0:
+            ret, frame = cap.retrieve()
+            if ret:
+                frames.append(Frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)))
+        index += 1
+    cap.release()
+    return frames
+
+
+def sample_image_frames(paths: Iterable[Path], count: int) -> list[Frame]:
+    paths = sorted(paths)
+    stride = max(1, len(paths) // count)
+    frames: list[Frame] = []
+    for path in paths[::stride][:count]:
+        grey = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+        if grey is None:
+            logger.warning("Failed to read image {}", path)
+            continue
+        frames.append(Frame(grey))
+    return frames
+
+
+def synthetic_frames(
+    dictionary: aruco.Dictionary,
+    count: int,
+    image_size: tuple[int, int] = (1280, 720),
+    grid: tuple[int, int] = (6, 4),
+    seed: int = 0,
+) -> list[Frame]:
+    """
+    a grid of markers under random perspective, blur, noise and lighting,
+    with exact ground truth corners
+
+    Args:
+        image_size: (width, height)
+        grid: markers per (row, column)
+    """
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    cols, rows = grid
+    cell = min(width // (cols + 1), height // (rows + 1))
+    side = int(cell * 0.75)
+    canvas = np.full((height, width), 255, dtype=np.uint8)
+    ids = np.arange(cols * rows, dtype=np.int32)
+    corners = np.empty((len(ids), 4, 2), dtype=np.float32)
+    ox = (width - cols * cell) // 2
+    oy = (height - rows * cell) // 2
+    for i in ids:
+        x = ox + (i % cols) * cell + (cell - side) // 2
+        y = oy + (i // cols) * cell + (cell - side) // 2
+        canvas[y : y + side, x : x + side] = aruco.generateImageMarker(
+            dictionary, int(i), side
+        )
+        # pixel centers are integers, so the marker edges lie half a pixel out
+        corners[i] = np.array(
+            [
+                (x - 0.5, y - 0.5),
+                (x + side - 0.5, y - 0.5),
+                (x + side - 0.5, y + side - 0.5),
+                (x - 0.5, y + side - 0.5),
+            ]
+        )
+    src = np.float32([(0, 0), (width, 0), (width, height), (0, height)])
+    frames: list[Frame] = []
+    for _ in range(count):
+        scale = rng.uniform(0.35, 1.0)
+        jitter = rng.normal(0, 0.08, (4, 2)) * (width, height)
+        center = np.array((width, height)) / 2 + rng.uniform(-0.2, 0.2, 2) * (
+            width,
+            height,
+        )
+        dst = ((src - np.array((width, height)) / 2) * scale + center + jitter).astype(
+            np.float32
+        )
+        homography = cv2.getPerspectiveTransform(src, dst)
+        grey = cv2.warpPerspective(canvas, homography, (width, height), borderValue=128)
+        gradient = np.linspace(rng.uniform(0.5, 1.0), rng.uniform(0.5, 1.0), width)
+        grey = (grey * gradient[np.newaxis, :]).astype(np.uint8)
+        sigma = rng.uniform(0.1, 1.5)
+        grey = cv2.GaussianBlur(grey, (0, 0), sigma)
+        noise = rng.normal(0, rng.uniform(1, 6), grey.shape)
+        grey = np.clip(grey + noise, 0, 255).astype(np.uint8)
+        warped = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), homography)
+        warped = warped.reshape(-1, 4, 2)
+        inside = np.all(
+            (warped >= 0) & (warped < np.array((width, height))), axis=(1, 2)
+        )
+        frames.append(Frame(grey, ids[inside], warped[inside]))
+    return frames
+
+
+def detect(detector: aruco.ArucoDetector, grey: NDArray) -> Detection:
+    # pylint: disable-next=unpacking-non-sequence
+    markers, ids, _rejected = detector.detectMarkers(grey)
+    if ids is None:
+        return np.empty((0,), dtype=np.int32), np.empty((0, 4, 2), dtype=np.float32)
+    return np.reshape(ids, (-1,)), np.reshape(markers, (-1, 4, 2))
+
+
+def compare(found: Detection, expected: Detection) -> tuple[int, int, NDArray]:
+    """
+    Returns:
+        matched count, false positive count, squared corner distances of matches
+    """
+    found_ids, found_corners = found
+    expected_ids, expected_corners = expected
+    _, fi, ei = np.intersect1d(found_ids, expected_ids, return_indices=True)
+    sq = np.sum((found_corners[fi] - expected_corners[ei]) ** 2, axis=-1).ravel()
+    return len(fi), len(found_ids) - len(fi), sq
+
+
+def evaluate(
+    dictionary: aruco.Dictionary,
+    parameters: dict[str, Any],
+    frames: list[Frame],
+    expected: list[Detection],
+    repeat: int,
+) -> Trial:
+    detector = aruco.ArucoDetector(
+        dictionary=dictionary, detectorParams=parameters_from_dict(parameters)
+    )
+    results: list[Detection] = []
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [detect(detector, frame.grey) for frame in frames]
+        best = min(best, time.perf_counter() - start)
+    matched = 0
+    total = 0
+    false_positives = 0
+    sq_sum = 0.0
+    sq_count = 0
+    for found, exp in zip(results, expected):
+        m, fp, sq = compare(found, exp)
+        matched += m
+        false_positives += fp
+        total += len(exp[0])
+        sq_sum += float(np.sum(sq))
+        sq_count += len(sq)
+    return Trial(
+        parameters=parameters,
+        ms_per_frame=best * 1000 / max(1, len(frames)),
+        recall=matched / total if total > 0 else 0.0,
+        corner_error_px=(
+            float(np.sqrt(sq_sum / sq_count)) if sq_count > 0 else float("nan")
+        ),
+        false_positives=false_positives,
+    )
+
+
+def mark_pareto_front(trials: list[Trial]):
+    """
+    flag trials not dominated in (ms/frame, -recall, corner error)
+    """
+    costs = np.array(
+        [
+            (t.ms_per_frame, -t.recall, np.nan_to_num(t.corner_error_px, nan=np.inf))
+            for t in trials
+        ]
+    )
+    for i, trial in enumerate(trials):
+        dominated = np.all(costs <= costs[i], axis=1) & np.any(costs < costs[i], axis=1)
+        trial.pareto = not bool(np.any(dominated))
+
+
+def choose(
+    trials: list[Trial], recall_tolerance: float, max_error_px: float
+) -> Trial:
+    """
+    the fastest Pareto-optimal trial within `recall_tolerance` of the best
+    recall and under `max_error_px`; the best recall when none qualifies
+    """
+    best_recall = max(t.recall for t in trials)
+    ok = [
+        t
+        for t in trials
+        if t.pareto
+        and t.recall >= best_recall - recall_tolerance
+        and t.corner_error_px <= max_error_px
+    ]
+    if not ok:
+        logger.warning("No trial meets the corner error bound; picking the best recall")
+        return max(trials, key=lambda t: (t.recall, -t.ms_per_frame))
+    return min(ok, key=lambda t: t.ms_per_frame)
+
+
+def parse_dictionary(value: str) -> int:
+    if not hasattr(aruco, value):
+        raise ValueError(f"Unknown aruco dictionary name: {value}")
+    return int(getattr(aruco, value))
+
+
+@click.command(
+    help="Sweep ArUco DetectorParameters over sample footage and save the chosen profile"
+)
+@click.option(
+    "--video",
+    "videos",
+    type=click.Path(exists=True, path_type=Path),
+    multiple=True,
+    help="recorded video to sample frames from",
+)
+@click.option(
+    "--images",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="folder of dumped frames (jpg/jpeg/png)",
+)
+@click.option(
+    "--synthetic",
+    type=int,
+    default=0,
+    show_default=True,
+    help="number of rendered frames with exact ground truth",
+)
+@click.option("--sample", type=int, default=60, show_default=True)
+@click.option("--dictionary", type=str, default="DICT_4X4_50", show_default=True)
+@click.option("--camera", type=str, help="save the chosen profile for this camera")
+@click.option("--repeat", type=int, default=3, show_default=True)
+@click.option("--recall-tolerance", type=float, default=0.01, show_default=True)
+@click.option(
+    "--max-error-px",
+    type=float,
+    default=0.5,
+    show_default=True,
+    help="bound on the RMS corner error against the ground truth or reference",
+)
+@click.option(
+    "--output",
+    type=click.Path(path_type=Path),
+    default=Path("output/detector_params_sweep.parquet"),
+    show_default=True,
+)
+def main(
+    videos: tuple[Path, ...],
+    images: Optional[Path],
+    synthetic: int,
+    sample: int,
+    dictionary: str,
+    camera: Optional[str],
+    repeat: int,
+    recall_tolerance: float,
+    max_error_px: float,
+    output: Path,
+):
+    aruco_dict = aruco.getPredefinedDictionary(parse_dictionary(dictionary))
+    recorded: list[Frame] = []
+    for video in videos:
+        recorded.extend(sample_video_frames(video, sample))
+    if images is not None:
+        recorded.extend(
+            sample_image_frames(
+                (p for p in images.iterdir() if p.suffix in (".jpg", ".jpeg", ".png")),
+                sample,
+            )
+        )
+    frames = recorded + synthetic_frames(aruco_dict, synthetic)
+    if not frames:
+        raise click.UsageError("no frames; pass --video, --images or --synthetic")
+    logger.info(
+        "Tuning on {} recorded and {} synthetic frames", len(recorded), synthetic
+    )
+
+    reference = aruco.ArucoDetector(
+        dictionary=aruco_dict,
+        detectorParams=parameters_from_dict(REFERENCE_PARAMETERS),
+    )
+    expected: list[Detection] = []
+    for frame in frames:
+        if frame.ids is not None and frame.corners is not None:
+            expected.append((frame.ids, frame.corners))
+        else:
+            expected.append(detect(reference, frame.grey))
+
+    default = parameters_to_dict(aruco.DetectorParameters())
+    candidates = candidate_parameters()
+    if default not in candidates:
+        candidates.insert(0, default)
+    trials: list[Trial] = []
+    for i, parameters in enumerate(candidates):
+        trial = evaluate(aruco_dict, parameters, frames, expected, repeat)
+        trials.append(trial)
+        logger.debug(
+            "[{}/{}] {:.2f}ms recall={:.3f} error={:.3f}px",
+            i + 1,
+            len(candidates),
+            trial.ms_per_frame,
+            trial.recall,
+            trial.corner_error_px,
+        )
+    mark_pareto_front(trials)
+    baseline = trials[candidates.index(default)]
+    chosen = choose(trials, recall_tolerance, max_error_px)
+
+    for trial in sorted((t for t in trials if t.pareto), key=lambda t: t.ms_per_frame):
+        p = trial.parameters
+        logger.info(
+            "{} {:6.2f}ms recall={:.3f} error={:.3f}px fp={} win=({},{},{}) refine={} perimeter={} aruco3={}",
+            "*" if trial is chosen else " ",
+            trial.ms_per_frame,
+            trial.recall,
+            trial.corner_error_px,
+            trial.false_positives,
+            p["adaptiveThreshWinSizeMin"],
+            p["adaptiveThreshWinSizeMax"],
+            p["adaptiveThreshWinSizeStep"],
+            p["cornerRefinementMethod"],
+            p["minMarkerPerimeterRate"],
+            p["useAruco3Detection"],
+        )
+    logger.info(
+        "defaults: {:.2f}ms recall={:.3f} error={:.3f}px; chosen: {:.2f}ms recall={:.3f} error={:.3f}px",
+        baseline.ms_per_frame,
+        baseline.recall,
+        baseline.corner_error_px,
+        chosen.ms_per_frame,
+        chosen.recall,
+        chosen.corner_error_px,
+    )
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    rows = [
+        {
+            **t.parameters,
+            "ms_per_frame": t.ms_per_frame,
+            "recall": t.recall,
+            "corner_error_px": t.corner_error_px,
+            "false_positives": t.false_positives,
+            "pareto": t.pareto,
+        }
+        for t in trials
+    ]
+    ak.to_parquet(rows, output)
+    logger.info("Saved sweep to {}", output)
+
+    if camera is not None:
+        path = save_detector_profile(
+            camera,
+            parameters_from_dict(chosen.parameters),
+            {
+                "dictionary": dictionary,
+                "frames": len(frames),
+                "ms_per_frame": chosen.ms_per_frame,
+                "recall": chosen.recall,
+                "corner_error_px": chosen.corner_error_px,
+            },
+        )
+        logger.info("Saved profile for {} to {}", camera, path)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
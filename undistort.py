@@ -0,0 +1,220 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, cast
+
+import awkward as ak
+import cv2
+import numpy as np
+from cv2.typing import MatLike
+from jaxtyping import Float, Int
+from loguru import logger
+
+NDArray = np.ndarray
+
+# `cv2.undistortPoints` stops after 5 iterations, which leaves ~0.3px of error
+# near the border for our wide lenses; iterate until converged instead
+POINT_CRITERIA = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 50, 1e-9)
+
+
+def read_camera_calibration(path: Path) -> tuple[MatLike, MatLike]:
+    """
+    read the camera matrix and distortion coefficients written by `cali.py`
+    """
+    cal = ak.from_parquet(path)[0]
+    camera_matrix = cast(MatLike, ak.to_numpy(cal["camera_matrix"]))
+    distortion_coefficients = cast(MatLike, ak.to_numpy(cal["distortion_coefficients"]))
+    return camera_matrix, distortion_coefficients
+
+
+def maps_path_for(calibration_path: Path) -> Path:
+    """
+    `output/c-af_03.parquet` -> `output/c-af_03.undistort.parquet`
+    """
+    return calibration_path.with_name(f"{calibration_path.stem}.undistort.parquet")
+
+
+@dataclass
+class UndistortMaps:
+    """
+    Undistortion tables of one camera at one resolution.
+
+    `map1`/`map2` are the fixed-point (`CV_16SC2` + `CV_16UC1`) maps consumed by
+    `cv2.remap`, so an undistorted preview is a single lookup per frame.
+
+    Detected corners go the other way through `undistort_points`, which yields
+    normalized coordinates so PnP can run without a distortion model.
+    """
+
+    image_size: tuple[int, int]
+    """
+    (width, height)
+    """
+    camera_matrix: Float[NDArray, "3 3"]
+    distortion_coefficients: Float[NDArray, "1 N"]
+    new_camera_matrix: Float[NDArray, "3 3"]
+    """
+    camera matrix of the undistorted (remapped) image
+    """
+    alpha: float
+    """
+    the `getOptimalNewCameraMatrix` scaling `new_camera_matrix` was built with
+    """
+    map1: Int[NDArray, "H W 2"]
+    map2: Int[NDArray, "H W"]
+
+    @staticmethod
+    def build(
+        camera_matrix: MatLike,
+        distortion_coefficients: MatLike,
+        image_size: tuple[int, int],
+        alpha: float = 0.0,
+    ) -> "UndistortMaps":
+        """
+        Args:
+            image_size: (width, height)
+            alpha: free scaling parameter of `getOptimalNewCameraMatrix`;
+                0 keeps only valid pixels, 1 keeps all source pixels
+        """
+        mtx = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+        dist = np.asarray(distortion_coefficients, dtype=np.float64).reshape(1, -1)
+        width, height = image_size
+        new_mtx, _roi = cv2.getOptimalNewCameraMatrix(
+            mtx, dist, (width, height), alpha, (width, height)
+        )
+        map1, map2 = cv2.initUndistortRectifyMap(
+            mtx, dist, None, new_mtx, (width, height), cv2.CV_16SC2
+        )
+        return UndistortMaps(
+            image_size=(width, height),
+            camera_matrix=mtx,
+            distortion_coefficients=dist,
+            new_camera_matrix=new_mtx,
+            alpha=float(alpha),
+            map1=map1,
+            map2=map2,
+        )
+
+    def matches(
+        self,
+        camera_matrix: MatLike,
+        distortion_coefficients: MatLike,
+        image_size: tuple[int, int],
+        alpha: float = 0.0,
+    ) -> bool:
+        """
+        whether the tables were built from this calibration at this resolution
+        and scaling
+        """
+        dist = np.asarray(distortion_coefficients, dtype=np.float64).reshape(1, -1)
+        return (
+            tuple(self.image_size) == tuple(image_size)
+            and self.alpha == float(alpha)
+            and self.distortion_coefficients.shape == dist.shape
+            and np.allclose(self.camera_matrix, np.asarray(camera_matrix).reshape(3, 3))
+            and np.allclose(self.distortion_coefficients, dist)
+        )
+
+    def remap(self, frame: MatLike) -> MatLike:
+        """
+        undistort a whole frame; the result follows `new_camera_matrix`
+        """
+        return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR)
+
+    def undistort_points(
+        self, points: Float[NDArray, "... 2"]
+    ) -> Float[NDArray, "... 2"]:
+        """
+        distorted pixel coordinates to normalized camera coordinates (`z=1`)
+
+        Use the result with an identity camera matrix and no distortion, e.g.
+        `cv2.solvePnP(ops, normalized, np.eye(3), None)`.
+        """
+        pts = np.asarray(points, dtype=np.float64)
+        normalized = cv2.undistortPointsIter(
+            pts.reshape(-1, 1, 2),
+            self.camera_matrix,
+            self.distortion_coefficients,
+            None,
+            None,
+            POINT_CRITERIA,
+        )
+        return normalized.reshape(pts.shape)
+
+    def undistort_points_to_pixels(
+        self, points: Float[NDArray, "... 2"]
+    ) -> Float[NDArray, "... 2"]:
+        """
+        distorted pixel coordinates to pixel coordinates of the remapped frame
+        """
+        normalized = self.undistort_points(points)
+        k = self.new_camera_matrix
+        out = np.empty_like(normalized)
+        out[..., 0] = normalized[..., 0] * k[0, 0] + k[0, 2]
+        out[..., 1] = normalized[..., 1] * k[1, 1] + k[1, 2]
+        return out
+
+    def save(self, path: Path):
+        record = {
+            "image_size": np.array(self.image_size, dtype=np.int32)[np.newaxis],
+            "camera_matrix": self.camera_matrix[np.newaxis],
+            "distortion_coefficients": self.distortion_coefficients[np.newaxis],
+            "new_camera_matrix": self.new_camera_matrix[np.newaxis],
+            "alpha": np.array([self.alpha], dtype=np.float64),
+            "map1": self.map1[np.newaxis],
+            "map2": self.map2[np.newaxis],
+        }
+        ak.to_parquet(ak.Array(record), path)
+
+    @staticmethod
+    def load(path: Path) -> "UndistortMaps":
+        rec = ak.from_parquet(path)[0]
+
+        def arr(key: str) -> NDArray:
+            return cast(NDArray, ak.to_numpy(rec[key]))
+
+        width, height = arr("image_size").tolist()
+        return UndistortMaps(
+            image_size=(int(width), int(height)),
+            camera_matrix=arr("camera_matrix"),
+            distortion_coefficients=arr("distortion_coefficients"),
+            new_camera_matrix=arr("new_camera_matrix"),
+            # caches written before `alpha` was stored never match
+            alpha=float(rec["alpha"]) if "alpha" in rec.fields else float("nan"),
+            map1=arr("map1"),
+            map2=arr("map2"),
+        )
+
+
+def load_or_build_maps(
+    calibration_path: Path,
+    image_size: tuple[int, int],
+    maps_path: Optional[Path] = None,
+    alpha: float = 0.0,
+) -> UndistortMaps:
+    """
+    load the cached tables persisted next to `calibration_path`, rebuilding and
+    persisting them when missing or stale (different calibration, resolution or
+    `alpha`)
+
+    Args:
+        image_size: (width, height)
+    """
+    camera_matrix, distortion_coefficients = read_camera_calibration(calibration_path)
+    if maps_path is None:
+        maps_path = maps_path_for(calibration_path)
+    if maps_path.exists():
+        try:
+            maps = UndistortMaps.load(maps_path)
+            if maps.matches(
+                camera_matrix, distortion_coefficients, image_size, alpha
+            ):
+                return maps
+            logger.info("Stale undistortion maps in {}; rebuilding", maps_path)
+        except Exception as e:
+            logger.warning("Failed to load undistortion maps {}: {}", maps_path, e)
+    maps = UndistortMaps.build(
+        camera_matrix, distortion_coefficients, image_size, alpha=alpha
+    )
+    maps.save(maps_path)
+    logger.info("Saved undistortion maps to {}", maps_path)
+    return maps